@@ -0,0 +1,74 @@
+"""
+mhchem benchmark: \ce/\pu converted in the same scan as the siunitx and
+physics commands vs the old two-pass route, where the converted text went
+through the separate chemistry tool's own regex pass afterwards. Also
+compares the mixed chem+units document with a units-only document of the
+same size, so the cost of the extra commands in the single pass shows.
+
+    python -m app.benchmarks.bench_chem [--size 2] [--commands-per-kb 4] [--repeat 5]
+"""
+import argparse
+import re
+
+from app.benchmarks.bench_units import best_of
+from app.benchmarks.corpus import SAMPLE_COMMANDS, make_synthetic
+from app.converter import COMMANDS, LatexConverter, build_token_pattern
+
+CHEM_COMMANDS = (r"\ce{H2O}", r"\ce{2H2 + O2 -> 2H2O}", r"\ce{SO4^2- + Ba^2+ -> BaSO4 v}",
+                 r"\ce{Hg^2+ ->[I-] HgI2}", r"\ce{Zn^2+ <=>[+ 2OH-][+ 2H+] Zn(OH)2 v}",
+                 r"\ce{KCr(SO4)2*12H2O}", r"\ce{^{227}_{90}Th}", r"\ce{[Pt(\eta^2-C2H4)Cl3]-}",
+                 r"\pu{123 kJ/mol}", r"\pu{1.2e3 kg m-3}")
+_LEGACY_CE_PATTERN = re.compile(r"\\ce\{([^\}]+)\}")
+
+
+def legacy_chem_pass(text):
+    """The separate chemistry tool's pass (MhChemStrategy), run over the whole text again."""
+    def replace(match):
+        formula = re.sub(r"([A-Za-z])(\d+)", r"\1_{\2}", match.group(1))
+        formula = re.sub(r"([A-Za-z\}])\+", r"\1^{+}", formula)
+        formula = re.sub(r"([A-Za-z\}])\-", r"\1^{-}", formula)
+        formula = re.sub(r"\^(\d+[-+])", r"^{\1}", formula)
+        formula = formula.replace("->", r"\rightarrow").replace("<=>", r"\rightleftharpoons")
+        return r"\mathrm{" + formula + "}"
+    return _LEGACY_CE_PATTERN.sub(replace, text)
+
+
+def siunitx_only_converter():
+    """A LatexConverter whose scanner skips \\ce and \\pu, as before mhchem support."""
+    converter = LatexConverter()
+    converter.token_pattern = build_token_pattern([name for name in COMMANDS if name not in ("ce", "pu")])
+    return converter
+
+
+def two_pass(text):
+    # siunitx/physics first, then the chemistry tool tokenizes and writes
+    # the document a second time
+    return legacy_chem_pass(siunitx_only_converter().convert(text))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=float, default=2, help="document size in MB")
+    parser.add_argument("--commands-per-kb", type=float, default=4.0)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    size = int(args.size * 1e6)
+    mixed = make_synthetic(size, args.commands_per_kb, commands=SAMPLE_COMMANDS + CHEM_COMMANDS)
+    units_only = make_synthetic(size, args.commands_per_kb)
+    megabytes = len(mixed.encode("utf-8")) / 1e6
+    chem = sum(mixed.count(name) for name in ("\\ce{", "\\pu{"))
+
+    rows = [
+        ("units-only, one pass", best_of(args.repeat, lambda: LatexConverter().convert(units_only))),
+        ("chem+units, one pass", best_of(args.repeat, lambda: LatexConverter().convert(mixed))),
+        ("chem+units, two passes", best_of(args.repeat, lambda: two_pass(mixed))),
+    ]
+    print(f"{megabytes:.1f} MB, {chem} \\ce/\\pu commands")
+    base = rows[0][1]
+    for name, seconds in rows:
+        print(f"{name:<24} {seconds * 1000:9.1f} ms  {megabytes / seconds:7.1f} MB/s  x{seconds / base:.2f}")
+
+
+if __name__ == "__main__":
+    main()
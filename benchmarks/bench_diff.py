@@ -0,0 +1,61 @@
+"""
+Diff engine benchmark: difflib.HtmlDiff vs FastHtmlDiff on converted
+synthetic documents of increasing size.
+
+    python -m app.benchmarks.bench_diff [--sizes 1000 10000 100000] [--difflib-max 20000]
+"""
+import argparse
+import difflib
+import random
+import time
+
+from app.converter import LatexConverter
+from app.diffing import FastHtmlDiff
+
+_WORDS = ("the", "neutron", "density", "flux", "measured", "energy", "of", "sample",
+          "$x$", "\\cite{ref}", "with", "a", "detector", "\\emph{high}", "resolution")
+_COMMANDS = (r"\SI{100}{\volt}", r"\qty{1382.44}{\kilo\electronvolt}", r"\num{1.5e3}",
+             r"\si{\kelvin\per\watt}", r"\SIrange{0}{5}{\volt}", r"\pdv{f}{x}")
+
+
+def make_document(lines, command_every=7, seed=0):
+    """Paragraph-style LaTeX lines (up to ~600 chars); every command_every-th line gets a command."""
+    rng = random.Random(seed)
+    out = []
+    for i in range(lines):
+        words = [rng.choice(_WORDS) for _ in range(rng.randint(5, 90))]
+        if i % command_every == 0:
+            words.insert(rng.randrange(len(words)), rng.choice(_COMMANDS))
+        out.append(" ".join(words))
+    return "\n".join(out)
+
+
+def time_engine(engine, fromlines, tolines):
+    start = time.perf_counter()
+    engine.make_file(fromlines, tolines, fromdesc='Original', todesc='Converted', context=True, numlines=5)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--difflib-max", type=int, default=20000,
+                        help="skip difflib.HtmlDiff above this many lines (it is quadratic)")
+    args = parser.parse_args()
+
+    converter = LatexConverter()
+    print(f"{'lines':>8} {'HtmlDiff':>12} {'FastHtmlDiff':>14} {'speedup':>8}")
+    for size in args.sizes:
+        text = make_document(size)
+        fromlines = text.splitlines()
+        tolines = converter.convert(text).splitlines()
+        fast = time_engine(FastHtmlDiff(), fromlines, tolines)
+        if size <= args.difflib_max:
+            slow = time_engine(difflib.HtmlDiff(), fromlines, tolines)
+            print(f"{size:>8} {slow:>11.3f}s {fast:>13.3f}s {slow / fast:>7.1f}x")
+        else:
+            print(f"{size:>8} {'skipped':>12} {fast:>13.3f}s {'-':>8}")
+
+
+if __name__ == "__main__":
+    main()
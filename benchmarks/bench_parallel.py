@@ -0,0 +1,71 @@
+"""
+Intra-document parallel conversion: LatexConverter.convert_parallel on one
+large synthetic document with 1, 2, 4 and 8 worker processes, against a
+plain convert(). Each worker count gets its own pool, warmed with one
+discarded run, so the times are steady-state conversions and not process
+start-up. Every output is checked against the serial one.
+
+Speedup is capped by the CPUs this machine actually has (printed first):
+with fewer cores than workers the extra processes only add pickling and
+scheduling overhead.
+
+    python -m app.benchmarks.bench_parallel [--size 8] [--workers 1 2 4 8] [--repeat 3]
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from app.benchmarks.corpus import make_synthetic
+from app.converter import LatexConverter, split_chunks
+
+# Preamble with a stateful command, so the chunk holding it is converted in
+# the parent like in a real paper
+_PREAMBLE = "\\documentclass{article}\n\\usepackage[arrows=font]{mhchem}\n\\begin{document}\n\n"
+
+
+def best_of(repeat, func):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=float, default=8, help="document size in MB")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--commands-per-kb", type=float, default=4.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    document = _PREAMBLE + make_synthetic(int(args.size * (1 << 20)), args.commands_per_kb) + "\n\\end{document}\n"
+    print(f"{os.cpu_count()} CPUs, {len(document) / 1e6:.1f} M characters, "
+          f"{len(split_chunks(document))} chunks at the minimum chunk size")
+
+    serial, expected = best_of(args.repeat, lambda: LatexConverter().convert(document))
+    print(f"{'workers':<10} {'seconds':>9} {'MB/s':>8} {'speedup':>8}")
+    print(f"{'serial':<10} {serial:>9.3f} {len(document) / serial / 1e6:>8.1f} {1.0:>8.2f}")
+    mismatched = []
+    for workers in args.workers:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            def run():
+                return LatexConverter().convert_parallel(document, pool, workers, min_chars=0)
+            run()  # starts the workers and warms their converters
+            seconds, output = best_of(args.repeat, run)
+        if output != expected:
+            mismatched.append(workers)
+        print(f"{workers:<10} {seconds:>9.3f} {len(document) / seconds / 1e6:>8.1f} {serial / seconds:>8.2f}"
+              f"{'  MISMATCH' if output != expected else ''}")
+    if mismatched:
+        print(f"\nOutput differs from convert() with {mismatched} workers")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
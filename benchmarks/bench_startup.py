@@ -0,0 +1,110 @@
+"""
+Cold-start benchmark: what a fresh process pays before its first result.
+Each run starts a new interpreter and times importing app.pipeline (what
+every pool worker imports), importing app.main when FastAPI is installed,
+constructing a LatexConverter, the first convert_package() of a sample
+document (the /upload pipeline, run first so it pays for building the
+shared tables) and then a convert() of it. The web framework
+modules app.main uses are imported first and timed on their own, so the
+app.main budget covers only this app's code: FastAPI alone takes several
+hundred ms that no change here can remove. Reports the median of --runs
+and fails when an app stage is over its budget.
+
+    python -m app.benchmarks.bench_startup [--runs 7] [--budget-import-ms 150] [--budget-first-ms 100]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from app.benchmarks.corpus import PACKAGE_DIR
+
+# Run in the child interpreter; prints {stage: milliseconds} as JSON
+_CHILD = r"""
+import importlib.util, json, sys, time
+timings = {}
+start = time.perf_counter()
+from app import pipeline
+timings["import app.pipeline"] = time.perf_counter() - start
+if importlib.util.find_spec("fastapi") is not None:
+    start = time.perf_counter()
+    import aiofiles, fastapi, fastapi.responses, fastapi.staticfiles, fastapi.templating, starlette.concurrency
+    timings["import fastapi (not budgeted)"] = time.perf_counter() - start
+    start = time.perf_counter()
+    import app.main
+    timings["import app.main"] = time.perf_counter() - start
+from app.converter import LatexConverter
+start = time.perf_counter()
+converter = LatexConverter()
+timings["LatexConverter()"] = time.perf_counter() - start
+text = open(sys.argv[1], encoding="utf-8").read()
+start = time.perf_counter()
+pipeline.convert_package(text, "sample2.tex")
+timings["first convert_package"] = time.perf_counter() - start
+start = time.perf_counter()
+converter.convert(text)
+timings["warm convert"] = time.perf_counter() - start
+print(json.dumps({name: seconds * 1000 for name, seconds in timings.items()}))
+"""
+
+
+class ChildFailed(Exception):
+    """The child interpreter exited with an error; the message is its stderr."""
+
+
+def run_child(sample_path):
+    """One fresh interpreter; returns {stage: milliseconds} plus its total wall time."""
+    # Run from the folder holding app/, like the server: main.py mounts
+    # app/static relative to the working directory
+    root = os.path.dirname(PACKAGE_DIR)
+    env = dict(os.environ, PYTHONPATH=root)
+    result = subprocess.run([sys.executable, "-c", _CHILD, sample_path], cwd=root, env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ChildFailed(result.stderr.strip())
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--budget-import-ms", type=float, default=150,
+                        help="budget for importing each app module, framework excluded")
+    parser.add_argument("--budget-first-ms", type=float, default=100,
+                        help="budget for constructing a converter plus the first convert_package")
+    args = parser.parse_args(argv)
+
+    sample_path = os.path.join(PACKAGE_DIR, "sample2.tex")
+    try:
+        # One discarded run so the OS file cache is warm for all measured ones
+        run_child(sample_path)
+        runs = [run_child(sample_path) for _ in range(args.runs)]
+    except ChildFailed as e:
+        print(f"Benchmark interpreter failed:\n{e}", file=sys.stderr)
+        return 1
+    medians = {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+
+    budgets = {name: args.budget_import_ms for name in medians if name.startswith("import app")}
+    first_request = medians["LatexConverter()"] + medians["first convert_package"]
+    over = []
+    print(f"{'stage':<28} {'median ms':>10} {'budget':>8}")
+    for name, ms in medians.items():
+        budget = budgets.get(name)
+        flag = budget is not None and ms > budget
+        if flag:
+            over.append(name)
+        print(f"{name:<28} {ms:>10.1f} {budget if budget is not None else '':>8}{'  OVER' if flag else ''}")
+    flag = first_request > args.budget_first_ms
+    if flag:
+        over.append("first request")
+    print(f"{'first request':<28} {first_request:>10.1f} {args.budget_first_ms:>8g}{'  OVER' if flag else ''}")
+    if over:
+        print(f"\nOver budget: {', '.join(over)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""
+Regression benchmark for the conversion pipeline: LatexConverter.convert,
+_map_unit, _parse_number and the diff and ZIP stages behind /upload, on the
+sample documents and synthetic 1/10/100 MB documents.
+
+Records time per stage (best of --repeat runs), convert throughput and
+peak traced memory, and compares them with a stored baseline; any stage
+slower or bigger than baseline * (1 + --threshold), plus a small absolute
+slack for noise, fails the run.
+
+    python -m app.benchmarks.bench_suite --save-baseline     # on the reference build
+    python -m app.benchmarks.bench_suite [--sizes 1 10] [--threshold 0.25]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from app import pipeline
+from app.benchmarks.corpus import load_samples, make_synthetic
+from app.converter import LatexConverter
+from app.diffing import FastHtmlDiff
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+_UNITS = (r"\kilo\meter\per\second", r"\milli\gram", r"\kilo\electronvolt", r"\kelvin\per\watt",
+          r"\newton\meter", r"\micro\second\squared", r"\mega\hertz", "kg.m/s^2", r"\ohm")
+_NUMBERS = ("1.5e3", "-3.2e-5", "1382.44", "6.02214076e23", "12", "0.000314", "1e-9", "+-0.5")
+_MICRO_CALLS = 10_000
+# Absolute slack on top of --threshold so millisecond stages do not fail
+# on timer noise alone
+_SLACK = {"seconds": 0.002, "peak_kb": 64}
+
+
+def measure(func, repeat):
+    """Best wall time of repeat calls, then one more call under tracemalloc for the peak."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": round(best, 6), "peak_kb": round(peak / 1024, 1)}
+
+
+def bench_document(name, text, repeat):
+    """convert (cold memo), diff and zip stages for one document."""
+    results = {}
+    megabytes = len(text.encode("utf-8")) / 1e6
+
+    def convert():
+        LatexConverter().convert(text)
+    stats = measure(convert, repeat)
+    stats["mb_per_s"] = round(megabytes / stats["seconds"], 2)
+    results[f"convert/{name}"] = stats
+
+    converted, edits = LatexConverter().convert(text, return_edits=True)
+
+    def diff():
+        FastHtmlDiff().make_file_from_edits(text, edits, fromdesc='Original', todesc='Converted', numlines=5)
+    results[f"diff/{name}"] = measure(diff, repeat)
+
+    diff_html = FastHtmlDiff().make_file_from_edits(text, edits, fromdesc='Original', todesc='Converted', numlines=5)
+    entries = [("converted.tex", converted, pipeline.ZIP_LEVEL_TEX),
+               ("diff.html", diff_html, pipeline.ZIP_LEVEL_DIFF)]
+
+    def zip_archive():
+        for _ in pipeline.iter_zip(entries):
+            pass
+    results[f"zip/{name}"] = measure(zip_archive, repeat)
+    return results
+
+
+def bench_helpers(repeat):
+    """_map_unit and _parse_number, _MICRO_CALLS calls each."""
+    converter = LatexConverter()
+    units = [_UNITS[i % len(_UNITS)] for i in range(_MICRO_CALLS)]
+    numbers = [_NUMBERS[i % len(_NUMBERS)] for i in range(_MICRO_CALLS)]
+
+    def map_units():
+        for unit in units:
+            converter._map_unit(unit)
+
+    def parse_numbers():
+        for number in numbers:
+            converter._parse_number(number)
+    return {
+        f"map_unit/x{_MICRO_CALLS}": measure(map_units, repeat),
+        f"parse_number/x{_MICRO_CALLS}": measure(parse_numbers, repeat),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Prints each metric against the baseline; returns the names of the regressions."""
+    regressions = []
+    print(f"{'stage':<32} {'seconds':>10} {'base':>10} {'peak KB':>11} {'base':>11}  {'MB/s':>7}")
+    for name, stats in results.items():
+        base = baseline.get(name, {})
+        flags = []
+        for metric, slack in _SLACK.items():
+            if metric in base and stats[metric] > base[metric] * (1 + threshold) + slack:
+                flags.append(metric)
+        if flags:
+            regressions.append(f"{name} ({', '.join(flags)})")
+        print(f"{name:<32} {stats['seconds']:>10.4f} {base.get('seconds', float('nan')):>10.4f} "
+              f"{stats['peak_kb']:>11.1f} {base.get('peak_kb', float('nan')):>11.1f}  "
+              f"{stats.get('mb_per_s', ''):>7}{'  REGRESSION' if flags else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 10, 100],
+                        help="synthetic document sizes in MB")
+    parser.add_argument("--commands-per-kb", type=float, default=2.0)
+    parser.add_argument("--unbalanced-every", type=int, default=50,
+                        help="stray '{' in every Nth paragraph (0: none)")
+    parser.add_argument("--long-line-every", type=int, default=100,
+                        help="one ~20 kB line in every Nth paragraph (0: none)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slowdown / memory growth over the baseline (0.25 = 25%%)")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store this run as the new baseline instead of comparing")
+    args = parser.parse_args(argv)
+
+    documents = load_samples()
+    for size in args.sizes:
+        documents[f"synthetic-{size:g}MB"] = make_synthetic(
+            int(size * 1e6), args.commands_per_kb, args.unbalanced_every, args.long_line_every)
+
+    results = bench_helpers(args.repeat)
+    for name, text in documents.items():
+        results.update(bench_document(name, text, args.repeat))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        compare(results, {}, args.threshold)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    else:
+        print(f"No baseline at {args.baseline}; run with --save-baseline first.")
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
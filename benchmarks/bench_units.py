@@ -0,0 +1,118 @@
+"""
+Unit lexer benchmark: the per-character tokenizer _tokenize_unit used to
+be vs the compiled-pattern lexer, plus _map_unit and convert() on
+unit-heavy documents where every \qty has its own number, so the command
+memo never hits. In the "distinct" document every unit argument differs
+too; in the "repeated" one they come from a pool of --distinct units, as
+in a real paper.
+
+    python -m app.benchmarks.bench_units [--units 20000] [--distinct 300] [--repeat 5]
+"""
+import argparse
+import random
+import time
+
+from app.converter import LatexConverter
+from app.units import PREFIX_SYMBOLS, PREFIXABLE_UNIT_SYMBOLS, UNIT_MAP
+
+_MODIFIERS = (r"\per", r"\square", r"\cubic", r"\squared", r"\cubed", r"\tothe{3}", r"\raiseto{2}")
+
+
+def legacy_tokenize_unit(converter, unit_str):
+    """The character loop _tokenize_unit ran before the compiled lexer, for comparison."""
+    tokens = []
+    i = 0
+    n = len(unit_str)
+    while i < n:
+        char = unit_str[i]
+        if char == '\\':
+            j = i + 1
+            while j < n and unit_str[j].isalpha():
+                j += 1
+            tokens.append(('CMD', unit_str[i:j]))
+            i = j
+        elif char == '{':
+            arg, end = converter._extract_braced_content(unit_str, i)
+            if arg is not None:
+                tokens.append(('ARG', arg))
+                i = end + 1
+            else:
+                tokens.append(('TEXT', char))
+                i += 1
+        elif char.isspace():
+            i += 1
+        else:
+            tokens.append(('TEXT', char))
+            i += 1
+    return tokens
+
+
+def make_units(count, seed=0):
+    """Unit arguments of 2-6 parts: prefix x unit pairs, plain units and modifiers."""
+    rng = random.Random(seed)
+    prefixes = sorted(PREFIX_SYMBOLS)
+    units = sorted(PREFIXABLE_UNIT_SYMBOLS)
+    plain = sorted(UNIT_MAP)
+    out = []
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(1, 3)):
+            roll = rng.random()
+            if roll < 0.2:
+                parts.append(rng.choice(_MODIFIERS[:3]))
+            if roll < 0.6:
+                parts.append(rng.choice(prefixes) + rng.choice(units))
+            else:
+                parts.append(rng.choice(plain))
+            if roll > 0.85:
+                parts.append(rng.choice(_MODIFIERS[3:]))
+        out.append("".join(parts))
+    return out
+
+
+def map_units(converter, units):
+    return [converter._map_unit(unit) for unit in units]
+
+
+def make_qty_document(units):
+    return "\n".join(f"Measured \\qty{{{i}}}{{{unit}}} here." for i, unit in enumerate(units))
+
+
+def best_of(repeat, func):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--units", type=int, default=20000, help="number of unit arguments")
+    parser.add_argument("--distinct", type=int, default=300, help="unit pool size for the repeated document")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    converter = LatexConverter()
+    units = make_units(args.units)
+    characters = sum(map(len, units))
+    pool = make_units(args.distinct, seed=1)
+    repeated = [pool[i % len(pool)] for i in range(args.units)]
+    document = make_qty_document(units)
+    repeated_document = make_qty_document(repeated)
+
+    rows = [
+        ("tokenize (legacy loop)", best_of(args.repeat, lambda: [legacy_tokenize_unit(converter, u) for u in units])),
+        ("tokenize (compiled)", best_of(args.repeat, lambda: [converter._tokenize_unit(u) for u in units])),
+        ("_map_unit (cold)", best_of(args.repeat, lambda: map_units(LatexConverter(), units))),
+        ("convert distinct", best_of(args.repeat, lambda: LatexConverter().convert(document))),
+        ("convert repeated", best_of(args.repeat, lambda: LatexConverter().convert(repeated_document))),
+    ]
+    print(f"{args.units} unit arguments, {characters / 1e3:.0f} k characters")
+    for name, seconds in rows:
+        print(f"{name:<24} {seconds * 1000:9.1f} ms  {args.units / seconds / 1e3:8.1f} k units/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmark inputs: the checked-in sample documents and synthetic documents
+of a given size with tunable command density, unbalanced braces and long
+lines.
+"""
+import os
+import random
+
+from app.benchmarks.bench_diff import make_document
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_FILES = ("sample2.tex", "sample tex")
+
+SAMPLE_COMMANDS = (r"\SI{100}{\volt}", r"\qty{1382.44}{\kilo\electronvolt}", r"\num{1.5e3}",
+                   r"\si{\kelvin\per\watt}", r"\SIrange{0}{5}{\volt}", r"\pdv{f}{x}",
+                   r"\numlist{1;2;3}", r"\ang{12;30;0}", r"\qty[mode=text]{3.2(4)e-5}{\milli\gram}",
+                   r"\complexnum{1+2i}", r"\braket{a}{b}", r"\dv[2]{f}{t}")
+
+
+def load_samples():
+    """Returns {file name: text} for the sample documents shipped with the app."""
+    samples = {}
+    for name in SAMPLE_FILES:
+        with open(os.path.join(PACKAGE_DIR, name), encoding="utf-8") as f:
+            samples[name] = f.read()
+    return samples
+
+
+def make_synthetic(size_bytes, commands_per_kb=2.0, unbalanced_every=0, long_line_every=0, seed=0,
+                   commands=SAMPLE_COMMANDS):
+    """
+    Synthetic LaTeX of about size_bytes characters. Paragraph lines come from
+    make_document(); commands (drawn from commands) are sprinkled in at
+    commands_per_kb. Every
+    unbalanced_every-th paragraph gets a stray '{' and every
+    long_line_every-th paragraph is one ~20 kB line (0 disables either).
+    """
+    rng = random.Random(seed)
+    # A pool of plain lines reused at random keeps 100 MB documents cheap to build
+    pool = make_document(2000, command_every=1 << 30, seed=seed).split("\n")
+    out = []
+    size = 0
+    paragraph = 0
+    while size < size_bytes:
+        paragraph += 1
+        if long_line_every and paragraph % long_line_every == 0:
+            lines = [" ".join(rng.choice(pool) for _ in range(60))]
+        else:
+            lines = [rng.choice(pool) for _ in range(rng.randint(2, 8))]
+        text = "\n".join(lines)
+        for _ in range(_spread(rng, commands_per_kb * len(text) / 1024)):
+            at = text.find(" ", rng.randrange(len(text)))
+            if at != -1:
+                text = f"{text[:at]} {rng.choice(commands)}{text[at:]}"
+        if unbalanced_every and paragraph % unbalanced_every == 0:
+            at = text.find(" ", rng.randrange(len(text)))
+            if at != -1:
+                text = f"{text[:at]} {{{text[at:]}"
+        out.append(text)
+        size += len(text) + 2
+    return "\n\n".join(out)
+
+
+def _spread(rng, mean):
+    # Integer part of mean plus one more with probability of the remainder
+    count = int(mean)
+    return count + (rng.random() < mean - count)
@@ -0,0 +1,191 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Bounded least-recently-used cache with hit/miss/eviction counters.
+    get() returns default on a miss; the least recently used entry is
+    evicted once more than maxsize entries are stored. maxsize=0 disables
+    caching (every get is a miss, put is a no-op).
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+# Folder names source_version() produces
+_VERSION_PATTERN = re.compile(r'[0-9a-f]{16}')
+
+
+def source_version(*modules):
+    """
+    Short hash of the given modules' source files (a module or the path of
+    its file). Results computed by that code are keyed with it, so editing
+    converter.py or units.py invalidates them without a manual flush.
+    """
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(getattr(module, "__file__", module), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+class ResultCache:
+    """
+    Two-tier cache of finished results (bytes) keyed by content hash.
+    The memory tier is an LRU bounded by the total size of its values;
+    the optional disk tier keeps every entry under disk_dir/<version>/ so
+    it survives restarts. Folders left by other versions are removed when
+    the cache is created.
+    """
+    def __init__(self, max_bytes=256 << 20, disk_dir=None, version=""):
+        self.max_bytes = max_bytes
+        self.version = version
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size_bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.disk_dir = None
+        if disk_dir:
+            self.disk_dir = os.path.join(disk_dir, version or "default")
+            os.makedirs(self.disk_dir, exist_ok=True)
+            for name in os.listdir(disk_dir):
+                stale = os.path.join(disk_dir, name)
+                if stale != self.disk_dir and _VERSION_PATTERN.fullmatch(name) and os.path.isdir(stale):
+                    shutil.rmtree(stale, ignore_errors=True)
+
+    def __len__(self):
+        return len(self._data)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), "rb") as f:
+                    value = f.read()
+            except OSError:
+                value = None
+            if value:
+                self._remember(key, value)
+                with self._lock:
+                    self.disk_hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def put(self, key, value):
+        # An empty result is never a finished one, and once stored it would
+        # be served until the code version changes
+        if not value:
+            return
+        self._remember(key, value)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = f"{path}.{os.getpid()}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(value)
+                os.replace(temp_path, path)
+            except OSError as e:
+                print(f"Could not write result cache entry: {e}")
+
+    def _remember(self, key, value):
+        if not value or len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size_bytes -= len(old)
+            self._data[key] = value
+            self.size_bytes += len(value)
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size_bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size_bytes = 0
+            self.hits = self.disk_hits = self.misses = self.evictions = 0
+        if self.disk_dir:
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._data),
+            "size_bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "disk_dir": self.disk_dir,
+            "version": self.version,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
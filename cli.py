@@ -0,0 +1,214 @@
+"""
+Batch mode for nightly runs: converts every .tex file under a folder
+across a pool of worker processes, without the web server. Each result is
+written next to its input as <name>_converted.tex (and <name>_diff.html
+with --diff). A manifest of input hashes is kept in the folder, so the
+next run skips files that have not changed since. The exit status is 1
+when any file failed to convert.
+
+    python -m app.cli chapters/ [-j 4] [--diff] [--force]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from app import pipeline
+from app.project import sha256_file
+
+MANIFEST_NAME = ".latex_manifest.json"
+# Marks the .tex files this tool writes; they are never inputs
+_OUTPUT_SUFFIX = "_converted"
+
+
+def find_sources(root):
+    """Every .tex file under root (relative paths, sorted), skipping hidden folders and our own outputs."""
+    sources = []
+    for folder, dirs, files in os.walk(root):
+        dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+        for name in files:
+            name_root, ext = os.path.splitext(name)
+            if ext.lower() == ".tex" and not name_root.endswith(_OUTPUT_SUFFIX):
+                sources.append(os.path.relpath(os.path.join(folder, name), root))
+    return sorted(sources)
+
+
+def output_paths(path):
+    """(converted .tex, diff .html) written next to path."""
+    name_root, ext = os.path.splitext(path)
+    return f"{name_root}{_OUTPUT_SUFFIX}{ext}", f"{name_root}_diff.html"
+
+
+def manifest_settings(diff):
+    """Everything besides the input bytes that shapes the outputs; a change reconverts every file."""
+    return {"version": pipeline.CACHE_VERSION, "diff_engine": pipeline.DIFF_ENGINE, "diff": diff}
+
+
+def load_manifest(path, settings):
+    """{relative path: input sha256} from the last run, or {} when it used other settings."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("settings") != settings:
+        return {}
+    return manifest.get("files", {})
+
+
+def save_manifest(path, settings, files):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"settings": settings, "files": files}, f, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def convert_file(path, relative, digest, diff, workers=1):
+    """
+    Pool job for one file: converts path and writes the outputs next to it.
+    Returns a record with the sha256 it was read with, the time taken and
+    whether anything changed, or the error that stopped it. workers > 1
+    splits the file itself across processes (see convert_parallel).
+    """
+    start = time.perf_counter()
+    record = {"file": relative, "sha256": digest}
+    try:
+        with open(path, "rb") as f:
+            content_str = f.read().decode("utf-8")
+    except UnicodeDecodeError as e:
+        record["error"] = f"not UTF-8 encoded (byte {e.start})"
+    except OSError as e:
+        record["error"] = str(e)
+    else:
+        converted_path, diff_path = output_paths(path)
+        if diff:
+            converted_str, diff_html = pipeline.convert_document(content_str, workers)
+            with open(diff_path, "w", encoding="utf-8") as f:
+                f.write(diff_html)
+        else:
+            converted_str = pipeline.get_converter().convert_parallel(content_str, workers=workers)
+        with open(converted_path, "w", encoding="utf-8", newline="") as f:
+            f.write(converted_str)
+        record["changed"] = converted_str != content_str
+    record["seconds"] = round(time.perf_counter() - start, 4)
+    return record
+
+
+class Progress:
+    """
+    One status line on a terminal (rewritten in place), one line per file
+    otherwise so cron logs stay readable.
+    """
+    def __init__(self, total, stream=sys.stderr):
+        self.total = total
+        self.done = 0
+        self.stream = stream
+        self.interactive = stream.isatty()
+        self.started = time.perf_counter()
+
+    def update(self, record):
+        self.done += 1
+        rate = self.done / max(time.perf_counter() - self.started, 1e-9)
+        state = "failed" if "error" in record else f"{record['seconds']:.3f}s"
+        line = f"[{self.done}/{self.total}] {rate:5.1f} files/s  {state:8}  {record['file']}"
+        if self.interactive:
+            self.stream.write(f"\r\033[K{line}")
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    def close(self):
+        if self.interactive and self.done:
+            self.stream.write("\n")
+            self.stream.flush()
+
+
+def convert_tree(root, workers=None, diff=False, force=False, progress=None):
+    """
+    Converts every changed .tex file under root and returns (records,
+    skipped). records holds one entry per file converted or failed (see
+    convert_file; a file that cannot even be read gets an error record
+    too), skipped the relative paths the manifest showed as unchanged. workers=1 converts in this process; when only one file
+    needs converting, its chunks are spread over the workers instead.
+    """
+    settings = manifest_settings(diff)
+    manifest_path = os.path.join(root, MANIFEST_NAME)
+    previous = {} if force else load_manifest(manifest_path, settings)
+
+    jobs = []
+    skipped = []
+    unreadable = []
+    for relative in find_sources(root):
+        path = os.path.join(root, relative)
+        try:
+            with open(path, "rb") as f:
+                digest = sha256_file(f.read())
+        except OSError as e:
+            # Unreadable or gone since the walk: report it, convert the rest
+            unreadable.append({"file": relative, "sha256": None, "error": str(e), "seconds": 0.0})
+            continue
+        if previous.get(relative) == digest and os.path.exists(output_paths(path)[0]):
+            skipped.append(relative)
+        else:
+            jobs.append((path, relative, digest, diff))
+
+    progress = progress or Progress(len(jobs) + len(unreadable))
+    records = []
+    try:
+        for record in unreadable:
+            records.append(record)
+            progress.update(record)
+        if len(jobs) == 1:
+            # One (possibly huge) file: its paragraphs get the workers instead
+            records.append(convert_file(*jobs[0], workers=workers or os.cpu_count() or 1))
+            progress.update(records[-1])
+        elif workers == 1 or not jobs:
+            for job in jobs:
+                records.append(convert_file(*job))
+                progress.update(records[-1])
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=pipeline.init_worker) as pool:
+                futures = [pool.submit(convert_file, *job) for job in jobs]
+                for future in as_completed(futures):
+                    records.append(future.result())
+                    progress.update(records[-1])
+    finally:
+        progress.close()
+        # Files that converted are recorded even when the run is interrupted
+        files = {relative: previous[relative] for relative in skipped}
+        files.update((record["file"], record["sha256"]) for record in records if "error" not in record)
+        save_manifest(manifest_path, settings, files)
+
+    records.sort(key=lambda record: record["file"])
+    return records, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert every .tex file under a folder.")
+    parser.add_argument("root", help="folder to convert (searched recursively)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="worker processes (default: CPU count; 1 converts in this process)")
+    parser.add_argument("--diff", action="store_true", help="also write <name>_diff.html next to each file")
+    parser.add_argument("--force", action="store_true", help=f"ignore {MANIFEST_NAME} and convert every file")
+    parser.add_argument("--summary", default=None, help="write the per-file records to this JSON file")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    records, skipped = convert_tree(args.root, args.workers, args.diff, args.force)
+    wall_seconds = time.perf_counter() - start
+
+    failed = [record for record in records if "error" in record]
+    for record in failed:
+        print(f"   failed  {record['file']}: {record['error']}")
+    print(f"{len(records) - len(failed)} converted, {len(skipped)} unchanged, {len(failed)} failed, "
+          f"{wall_seconds:.2f}s with {args.workers} workers")
+    if args.summary:
+        with open(args.summary, "w") as f:
+            f.write(pipeline.batch_summary(records, wall_seconds, args.workers))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
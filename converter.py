@@ -1,57 +1,640 @@
+import os
 import re
-from app.units import UNIT_MAP
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
-class LatexConverter:
-    def __init__(self):
-        # Compile regex for unit mapping
-        sorted_keys = sorted(UNIT_MAP.keys(), key=len, reverse=True)
-        patterns = []
-        for key in sorted_keys:
-            esc = re.escape(key)
-            # If key is like \word (letters only), add boundary check
-            # to prevent \m matching start of \meter or \text
-            if re.match(r"\\[a-zA-Z]+$", key):
-                patterns.append(esc + r"(?![a-zA-Z])")
+from app.cache import LRUCache
+from app.diffing import common_prefix_length
+from app.units import PREFIX_SYMBOLS, PREFIXABLE_UNIT_SYMBOLS, UNIT_MAP, get_prefixed_unit_map
+
+# Registry of everything convert() rewrites: scanner key -> (argument spec,
+# handler). Anything not in here is passthrough text, so the scanner only
+# ever stops at these names. Argument specs follow xparse:
+#   m  mandatory {...} directly after the previous argument
+#   o  optional [...], whitespace allowed before it
+#   g  optional {...}
+# Handlers get one positional argument per spec letter (None for a missing
+# optional one) and return the replacement text, or None to leave the
+# command untouched.
+COMMANDS = {}
+# Keys whose handler changes self.profile (preamble options). These run on
+# every occurrence instead of being answered from the memo.
+STATEFUL_COMMANDS = set()
+# Keys whose replacement is math; found in text mode it is wrapped in $...$
+MATH_COMMANDS = set()
+
+
+def _compile_spec(spec):
+    kinds = tuple(spec.split())
+    for kind in kinds:
+        if kind not in ('m', 'o', 'g'):
+            raise ValueError(f"Unknown argument type {kind!r} in spec {spec!r}")
+    return kinds
+
+
+def command(*names, spec='', stateful=False, math=True):
+    """
+    Registers the decorated method as the handler for \\<name>.
+    stateful=True marks a handler that updates self.profile; math=False one
+    whose replacement is text-mode LaTeX.
+    """
+    kinds = _compile_spec(spec)
+    def register(handler):
+        for name in names:
+            COMMANDS[name] = (kinds, handler)
+            if stateful:
+                STATEFUL_COMMANDS.add(name)
+            if math:
+                MATH_COMMANDS.add(name)
+        return handler
+    return register
+
+
+def environment(*names, spec=''):
+    """Registers the decorated method for \\begin{<name>} and its arguments."""
+    return command(*(f"begin{{{name}}}" for name in names), spec=spec, math=False)
+
+
+# One replaced source range: text[start:end] became replacement.
+Edit = namedtuple('Edit', 'start end replacement command')
+
+_MISSING = object()
+# Returned by TokenStream.read when a stream buffer ends mid-command
+INCOMPLETE = object()
+_WHITESPACE_PATTERN = re.compile(r'\s*')
+_UNIT_TEXT_PATTERN = re.compile(r'[^\W\d_]+')
+# A command name (or \begin{env key, or \text followed by spaces) touching
+# the end of a stream buffer may still grow into a handled one or a mode
+# switch
+_TRAILING_COMMAND_PATTERN = re.compile(r'\\[^\W\d_]*\s*(?:\{[^\W\d_]*\*?)?\Z')
+# Delimiters and paragraph breaks (blank-line runs) for split_blocks().
+# \\, \[ and \] are skipped as TokenStream does: they are not brackets.
+_BLOCK_TOKEN_PATTERN = re.compile(r'\\[\\\[\]]|[{}\[\]]|\n(?:[ \t\r]*\n)+')
+
+# \begin{...} and \end{...}, for keeping parallel chunks out of environments
+_ENVIRONMENT_PATTERN = re.compile(r'\\(begin|end)\s*\{([^{}]*)\}')
+# convert_parallel(): shorter documents are converted serially, as pickling
+# and process hops would cost more than they save; chunks are at least
+# PARALLEL_CHUNK_CHARS long for the same reason
+PARALLEL_MIN_CHARS = 1 << 18
+PARALLEL_CHUNK_CHARS = 1 << 16
+
+# Blank-line runs, where TokenStream can resume lexing with an empty mode stack
+_PARAGRAPH_PATTERN = re.compile(r'\n(?:[ \t\r]*\n)+')
+_match_start = re.Match.start
+_match_end = re.Match.end
+# The patterns of one set of handled commands (see build_token_pattern)
+TokenPattern = namedtuple('TokenPattern', 'lexer modes commands')
+# Modes of the mode stack
+MODE_TEXT, MODE_INLINE, MODE_DISPLAY = range(3)
+# Environments typeset in math mode
+_MATH_ENVIRONMENTS = ('equation', 'align', 'alignat', 'flalign', 'gather', 'multline',
+                      'eqnarray', 'displaymath', 'math')
+# Commands whose braced argument switches mode: text inside math, or math
+_TEXT_GROUPS = ('text', 'textrm', 'textit', 'textbf', 'textsf', 'texttt', 'textnormal',
+                'textup', 'textsc', 'mbox', 'hbox', 'intertext', 'shortintertext')
+_MATH_GROUPS = ('ensuremath',)
+# A command name ending right before a paragraph break: its optional
+# argument could still follow after the blank lines
+_COMMAND_BEFORE_BREAK_PATTERN = re.compile(r'\\(?:begin\{[^{}]*\}|[^\W\d_]+)\s*\Z')
+
+# mhchem options that change \ce output, as set by \usepackage[...]{mhchem}
+# or \mhchemoptions{...}. version=3/4 is accepted; both parse the same here.
+CHEM_OPTIONS = ('arrows', 'textfontname')
+_CHEM_FONTS = {'rmfamily': '\\mathrm', 'sffamily': '\\mathsf', 'ttfamily': '\\mathtt'}
+# \ce arrow -> (extensible amsmath/mathtools arrow or None, fixed symbol).
+# arrows=font selects the fixed symbols; any pgf style the extensible ones,
+# but only for a labelled arrow, so plain arrows need no extra package.
+_CHEM_ARROWS = {
+    '->': ('\\xrightarrow', '\\rightarrow'),
+    '<-': ('\\xleftarrow', '\\leftarrow'),
+    '<->': ('\\xleftrightarrow', '\\leftrightarrow'),
+    '<-->': (None, '\\rightleftarrows'),
+    '<=>': ('\\xrightleftharpoons', '\\rightleftharpoons'),
+    '<=>>': (None, '\\rightleftharpoons'),
+    '<<=>': (None, '\\rightleftharpoons'),
+}
+_CHEM_BONDS = {
+    '-': '{-}', '1': '{-}', '=': '{=}', '2': '{=}', '#': '{\\equiv}', '3': '{\\equiv}',
+    '~': '{\\sim}', '~-': '{\\simeq}', '~=': '{\\cong}', '~--': '{\\cong}', '-~-': '{\\cong}',
+    '...': '{\\cdots}', '....': '{\\cdots}', '->': '{\\rightarrow}', '<-': '{\\leftarrow}',
+}
+# One token of a \ce argument, tried in this order
+_CHEM_TOKEN_PATTERN = re.compile(
+    r'(?P<math>\$[^$]*\$)'
+    r'|(?P<arrow><-->|<=>>|<<=>|<=>|<->|->|<-)'
+    r'|\\bond\{(?P<bond>[^{}]*)\}'
+    r'|(?P<state>\((?:v|\^)\))'
+    r'|(?P<cmd>\\(?:[^\W\d_]+|.))'
+    r'|(?P<brace>\{)'
+    r'|(?P<sup>\^)'
+    r'|(?P<sub>_)'
+    r'|(?P<space>\s+)'
+    r'|(?P<letters>[^\W\d_]+)'
+    r'|(?P<digits>\d+)'
+    r'|(?P<other>.)', re.S)
+# Superscript without braces: a charge (2+, -) unless a letter follows
+# (\eta^2-C2H4), a number, letters or a radical dot
+_CHEM_CHARGE_PATTERN = re.compile(r'\d*[+-](?![^\W\d_])\.?|\d+|[^\W\d_]+|\.')
+_CHEM_WORD_PATTERN = re.compile(r'\\[^\W\d_]+|[^\W\d_]+')
+# \pu{...}: a leading number, then units with optional powers (m-3, m^2)
+_PU_NUMBER_PATTERN = re.compile(r'\s*([-+]?(?:\d+(?:[.,]\d*)?|[.,]\d+)(?:\(\d+\))?(?:[eE][-+]?\d+)?)\s*')
+_PU_UNIT_PATTERN = re.compile(r'(?P<unit>°[^\W\d_]*|[^\W\d_]+)\^?(?P<power>-?\d+)?|\s*(?P<sep>[.*/])\s*|(?P<space>\s+)')
+_PU_SEPARATORS = {'.': '\\cdot ', '*': '\\cdot ', '/': '/'}
+
+
+def _alternation(names):
+    return '|'.join(map(re.escape, sorted(names, key=len, reverse=True)))
+
+
+# Derived tables, built on first use and then shared by every converter in
+# the process (see _get_unit_tables, _get_token_pattern). Importing this
+# module or constructing a LatexConverter compiles nothing.
+_unit_tables = None
+_token_pattern = None
+_stateful_pattern = None
+
+
+def _get_unit_tables():
+    """
+    (symbols, token pattern) for _map_unit. symbols holds every unit
+    command it knows: the hand-written UNIT_MAP plus the generated prefix x
+    unit pairs. The pattern matches one token of a unit argument: a
+    prefix x unit pair, another command name, a braced argument, skipped
+    whitespace or a run of text.
+    """
+    global _unit_tables
+    if _unit_tables is None:
+        symbols = {**UNIT_MAP, **get_prefixed_unit_map()}
+        pattern = re.compile(
+            r'(?P<prefixed>(?P<prefix>' + _alternation(PREFIX_SYMBOLS) + r')\s*'
+            r'(?P<unit>' + _alternation(PREFIXABLE_UNIT_SYMBOLS) + r')(?![^\W\d_]))'
+            r'|(?P<cmd>\\[^\W\d_]*)'
+            r'|(?P<brace>\{)'
+            r'|(?P<space>\s+)'
+            r'|(?P<text>[^\\{\s]+)'
+        )
+        _unit_tables = (symbols, pattern)
+    return _unit_tables
+
+
+def build_token_pattern(names):
+    """
+    The TokenStream patterns for the given COMMANDS keys. lexer matches
+    every token: delimiters, escapes (\\\\, \\$, \\%), handled command names
+    (longest first so \\numlist wins over \\num, and never a prefix of a
+    longer name), math shifts, math environments, mode-switching groups
+    (\\text{, \\ensuremath{), paragraph breaks and comment starts, each
+    kind one named group. modes is the same lexer without delimiters, for
+    stretches where they cannot change the mode stack. commands only stops
+    at backslashes and finds the same handled commands (and escapes, so
+    \\\\num is not one) in a fraction of the time.
+    """
+    environments = [name for name in names if name.endswith('}')]
+    commands = [name for name in names if not name.endswith('}')]
+    handled = []
+    if environments:
+        handled.append(_alternation(environments))
+    if commands:
+        handled.append('(?:' + _alternation(commands) + r')(?![^\W\d_])')
+    command = r'|(?P<command>' + '|'.join(handled) + ')' if handled else ''
+    tokens = (
+        r'\\(?:(?P<escape>[\\$%])'
+        + command +
+        r'|(?P<env>(?:begin|end)\{(?:' + _alternation(_MATH_ENVIRONMENTS) + r')\*?\})'
+        r'|(?P<group>(?:' + _alternation(_TEXT_GROUPS + _MATH_GROUPS) + r')(?![^\W\d_])\s*\{)'
+        r'|(?P<shift>[()\[\]]))'
+        r'|(?P<dollar>\$\$?)'
+        r'|(?P<paragraph>\n(?:[ \t\r]*\n)+)'
+        r'|(?P<comment>%)'
+    )
+    # Every token starts with one of these; checking that first lets the
+    # engine skip plain text quickly
+    lexer = re.compile(r'(?=[{}\[\]\\$%\n])(?:(?P<open>\{)|(?P<close>\})|(?P<open_bracket>\[)'
+                       r'|(?P<close_bracket>\])|' + tokens + ')')
+    modes = re.compile(r'(?=[\\$%\n])(?:' + tokens + ')')
+    # No other token holds a backslash past its first character, so the
+    # escapes are all it takes to stay in step with the lexer
+    return TokenPattern(lexer, modes, re.compile(r'\\(?:[\\$%]' + command + ')'))
+
+
+def _get_token_pattern():
+    global _token_pattern
+    if _token_pattern is None:
+        _token_pattern = build_token_pattern(COMMANDS)
+    return _token_pattern
+
+
+def _get_stateful_pattern():
+    # Any STATEFUL_COMMANDS name, even in a comment or argument; a chunk it
+    # matches in is converted where the profile is known (convert_parallel)
+    global _stateful_pattern
+    if _stateful_pattern is None:
+        _stateful_pattern = re.compile(r'\\(?:' + _alternation(STATEFUL_COMMANDS) + r')(?![^\W\d_])')
+    return _stateful_pattern
+
+
+def split_blocks(text):
+    """
+    Splits text into paragraph blocks that convert independently: the
+    pieces joined together are text, and converting each one gives the
+    same result as converting text. A block ends after a blank-line run
+    at brace and bracket depth 0 that does not directly follow a command
+    name.
+    """
+    return _slice_blocks(text, list(_block_ends(text)))
+
+
+def _block_ends(text, start=0):
+    """Yields the end of every block after start, which must be a block boundary."""
+    brace_depth = bracket_depth = 0
+    for match in _BLOCK_TOKEN_PATTERN.finditer(text, start):
+        token = match.group()
+        if token == '{':
+            brace_depth += 1
+        elif token == '}':
+            if brace_depth:
+                brace_depth -= 1
+        elif token == '[':
+            bracket_depth += 1
+        elif token == ']':
+            if bracket_depth:
+                bracket_depth -= 1
+        elif token[0] == '\\':
+            continue
+        elif not brace_depth and not bracket_depth:
+            end = match.end()
+            tail = text.rfind('\\', start, match.start())
+            if tail == -1 or not _COMMAND_BEFORE_BREAK_PATTERN.match(text, tail, end):
+                yield end
+                start = end
+
+
+def split_chunks(text, min_chars=PARALLEL_CHUNK_CHARS):
+    """
+    Splits text into chunks of at least min_chars (the last may be
+    shorter) for convert_parallel(). Chunks only end where split_blocks()
+    ends a block and no environment other than document is open, so a
+    chunk never starts inside braces, brackets, math or an environment.
+    """
+    environments = _ENVIRONMENT_PATTERN.finditer(text)
+    environment = next(environments, None)
+    depth = 0
+    ends = []
+    start = 0
+    for end in _block_ends(text):
+        while environment is not None and environment.end() <= end:
+            if environment.group(2).strip() != 'document':
+                # A stray \end must not hide the next environment's \begin
+                depth = depth + 1 if environment.group(1) == 'begin' else max(depth - 1, 0)
+            environment = next(environments, None)
+        if not depth and end - start >= min_chars:
+            ends.append(end)
+            start = end
+    return _slice_blocks(text, ends)
+
+
+def _slice_blocks(text, ends):
+    blocks = []
+    start = 0
+    for end in ends:
+        blocks.append(text[start:end])
+        start = end
+    if start < len(text) or not blocks:
+        blocks.append(text[start:])
+    return blocks
+
+
+class TokenStream:
+    """
+    One document as conversion sees it, lexed only where it has to be.
+    The handled commands are found up front (build_token_pattern's
+    commands pattern, one C-level scan); starts and ends hold their
+    offsets into text, so no substrings are copied and a document without
+    any costs nothing more.
+
+    The mode stack follows the lexer tokens: $...$ and \\(...\\) are
+    inline math, $$...$$, \\[...\\] and the math environments display math,
+    \\text{...} and friends text again and \\ensuremath{...} math. A
+    paragraph break empties the stack, as TeX ends any open math there; %
+    comments do not change it. mode_at() and modes_at() therefore lex from
+    the last paragraph break before the position asked about, not from the
+    start of text; positions must be asked about in increasing order to
+    avoid starting over.
+
+    braced() and optional() match an argument's delimiter by lexing forward
+    from it. Pairs found on the way are kept, and an opening that is never
+    closed marks the rest of the text as done, so a stray '{' costs one
+    scan instead of one per command after it.
+    final=False marks text as a stream buffer that more input may follow;
+    read() then reports arguments that could continue past its end.
+    modes_in is the stack at the start of text, as returned by
+    modes_at() for the previous buffer.
+    """
+    def __init__(self, text, final=True, modes_in=(), pattern=None):
+        pattern = pattern or _get_token_pattern()
+        self.text = text
+        self.final = final
+        self.lexer = pattern.lexer
+        self.mode_lexer = pattern.modes
+        matches = [match for match in pattern.commands.finditer(text) if match.lastgroup]
+        self.starts = array('q', map(_match_start, matches))
+        self.ends = array('q', map(_match_end, matches))
+        # Per opening kind: {open position: close position}, and the offset
+        # from which every opening of that kind has been scanned
+        self._pairs = {'open': {}, 'open_bracket': {}}
+        self._scanned = {'open': len(text), 'open_bracket': len(text)}
+        self._modes_in = tuple(modes_in)
+        self._restart(0, modes_in)
+
+    def _restart(self, pos, stack, breaks=None):
+        # Lexing resumes at pos, which must be a token boundary, with stack.
+        # Stack entries are (closer, mode, open braces inside the entry);
+        # closer is the token that ends it: '$', '$$', '\\)', '\\]',
+        # 'end{align}', '}' for a group or '%' for a comment.
+        text = self.text
+        self._pos = pos
+        self._stack = list(stack)
+        self._comment_end = len(text) + 1  # no comment open
+        if stack and stack[-1][0] == '%':
+            self._comment_end = text.find('\n', pos)
+            if self._comment_end == -1:
+                self._comment_end = len(text)
+        self._lex_from(pos)
+        if breaks is None:
+            breaks = _PARAGRAPH_PATTERN.finditer(text, pos)
+            self._break = next(breaks, None)
+        self._breaks = breaks
+
+    def _advance(self, pos):
+        # Applies every token that ends by pos, skipping to the last
+        # paragraph break before it where that is safe
+        if pos < self._pos:
+            self._restart(0, self._modes_in)
+        text = self.text
+        passed = []
+        found = self._break
+        while found is not None and found.end() <= pos:
+            if found.start() >= self._pos:
+                passed.append(found)
+            found = next(self._breaks, None)
+        self._break = found
+        resume = None
+        for k in range(len(passed) - 1, -1, -1):
+            # Unless it is the whitespace of a \text {...} group, which
+            # cannot reach back past the previous break
+            start, end = passed[k].span()
+            tail = text.rfind('\\', passed[k-1].end() if k else self._pos, start)
+            if tail == -1 or not _COMMAND_BEFORE_BREAK_PATTERN.match(text, tail, end):
+                resume = end
+                break
+        if resume is not None:
+            self._restart(resume, (), self._breaks)
+
+        match = self._next
+        while match is not None and match.end() <= pos:
+            braces = self._braces
+            self._apply(match)
+            self._pos = match.end()
+            if braces != self._needs_braces():
+                self._lex_from(self._pos)
+                match = self._next
             else:
-                patterns.append(esc)
-        
-        self.unit_pattern = re.compile('|'.join(patterns))
+                match = next(self._tokens, None)
+        self._next = match
+
+    def _lex_from(self, pos):
+        self._braces = self._needs_braces()
+        self._tokens = (self.lexer if self._braces else self.mode_lexer).finditer(self.text, pos)
+        self._next = next(self._tokens, None)
+
+    def _needs_braces(self):
+        # Braces only change the stack while a \text{...} group is on top
+        # (they count towards its closing '}'), or a comment that may end
+        # back inside one; elsewhere tokens are read without them
+        return bool(self._stack) and self._stack[-1][0] in ('}', '%')
+
+    def _apply(self, match):
+        # One token's effect on the mode stack
+        text = self.text
+        stack = self._stack
+        group = match.lastgroup
+        start = match.start()
+        if start >= self._comment_end:
+            stack.pop()
+            self._comment_end = len(text) + 1
+        if group == 'open':
+            if stack:
+                closer, entry_mode, depth = stack[-1]
+                stack[-1] = (closer, entry_mode, depth + 1)
+        elif group == 'close':
+            if stack:
+                closer, entry_mode, depth = stack[-1]
+                if depth:
+                    stack[-1] = (closer, entry_mode, depth - 1)
+                elif closer == '}':
+                    stack.pop()
+        elif group == 'group':
+            if self._comment_end <= len(text):
+                closer, entry_mode, depth = stack[-1]
+                stack[-1] = (closer, entry_mode, depth + 1)
+            else:
+                stack.append(('}', MODE_INLINE if text[start+1] == 'e' else MODE_TEXT, 0))
+        elif group == 'paragraph':
+            stack.clear()
+        elif group in ('open_bracket', 'close_bracket', 'command', 'escape') or self._comment_end <= len(text):
+            # Math shifts and comment starts inside a comment are text
+            pass
+        elif group == 'dollar':
+            top = stack[-1][0] if stack else None
+            if match.end() - start == 1:
+                if top == '$' or top == '$$':
+                    stack.pop()
+                else:
+                    stack.append(('$', MODE_INLINE, 0))
+            elif top == '$$':
+                stack.pop()
+            elif top != '$':
+                # In inline math $$ closes it and opens another
+                stack.append(('$$', MODE_DISPLAY, 0))
+        elif group == 'shift':
+            token = text[start+1]
+            if token == '(':
+                stack.append(('\\)', MODE_INLINE, 0))
+            elif token == '[':
+                stack.append(('\\]', MODE_DISPLAY, 0))
+            elif stack and stack[-1][0] == text[start:start+2]:
+                stack.pop()
+        elif group == 'env':
+            end = match.end()
+            if text[start+1] == 'b':
+                closer = 'end' + text[start+6:end]
+                stack.append((closer, MODE_INLINE if closer == 'end{math}' else MODE_DISPLAY, 0))
+            elif stack and stack[-1][0] == text[start+1:end]:
+                stack.pop()
+        else:
+            end = text.find('\n', start)
+            self._comment_end = len(text) if end == -1 else end
+            stack.append(('%', stack[-1][1] if stack else MODE_TEXT, 0))
+
+    def modes_at(self, pos):
+        """The mode stack in effect at pos, after every token that ends by then."""
+        self._advance(pos)
+        stack = self._stack
+        # A comment ends at its newline even when no token follows
+        if self._comment_end < len(self.text) and self._comment_end <= pos:
+            return tuple(stack[:-1])
+        return tuple(stack)
+
+    def mode_at(self, pos):
+        """The mode (MODE_TEXT, MODE_INLINE or MODE_DISPLAY) in effect at pos."""
+        stack = self.modes_at(pos)
+        return stack[-1][1] if stack else MODE_TEXT
+
+    def token_start(self, pos):
+        """pos, or the start of the token that pos falls inside of."""
+        self._advance(pos)
+        if self._next is not None and self._next.start() < pos:
+            return self._next.start()
+        return pos
+
+    def _partner(self, start, opener, closer):
+        # Position of the delimiter closing the one at start, or None
+        pairs = self._pairs[opener]
+        end = pairs.get(start)
+        if end is not None or start >= self._scanned[opener]:
+            return end
+        stack = []
+        for match in self.lexer.finditer(self.text, start):
+            group = match.lastgroup
+            if group == opener or (group == 'group' and opener == 'open'):
+                # A group token ends with its '{'
+                stack.append(match.end() - 1)
+            elif group == closer and stack:
+                pairs[stack.pop()] = match.start()
+                if not stack:
+                    return match.start()
+        self._scanned[opener] = start
+        return None
+
+    def braced(self, start_index):
+        """
+        Same contract as LatexConverter._extract_braced_content:
+        (content, index of closing brace) or (None, -1).
+        """
+        text = self.text
+        if start_index >= len(text) or text[start_index] != '{':
+            return None, -1
+        end = self._partner(start_index, 'open', 'close')
+        if end is None:
+            return None, -1
+        return text[start_index+1:end], end
+
+    def optional(self, start_index):
+        """
+        Same contract as LatexConverter._extract_optional_arg:
+        (content, index of closing bracket) or (None, start_index).
+        """
+        text = self.text
+        i = _WHITESPACE_PATTERN.match(text, start_index).end()
+        if i >= len(text) or text[i] != '[':
+            return None, start_index
+        end = self._partner(i, 'open_bracket', 'close_bracket')
+        if end is None:
+            return None, start_index
+        return text[i+1:end], end
+
+    def read(self, spec, pos):
+        """
+        Reads the arguments described by a compiled spec starting at pos.
+        Returns (args, next_pos), (None, pos) if a mandatory one is missing,
+        or (INCOMPLETE, pos) if the text is not final and the arguments
+        may continue past its end.
+        """
+        text = self.text
+        n = len(text)
+        args = []
+        start = pos
+        for kind in spec:
+            if kind == 'o':
+                arg, end = self.optional(pos)
+                if arg is None and not self.final:
+                    i = _WHITESPACE_PATTERN.match(text, pos).end()
+                    if i == n or text[i] == '[':
+                        return INCOMPLETE, start
+            else:
+                arg, end = self.braced(pos)
+                if arg is None:
+                    if not self.final and (pos >= n or text[pos] == '{'):
+                        return INCOMPLETE, start
+                    if kind == 'm':
+                        return None, start
+            args.append(arg)
+            if arg is not None:
+                pos = end + 1
+        return args, pos
+
+
+class LatexConverter:
+    def __init__(self, cache_size=1024, block_cache_size=4096):
+        self.token_pattern = None  # see _get_token_pattern, set on first use
+
+        # Converted outputs keyed on (command, raw arguments, profile).
+        # Papers repeat the same few constructs (\si{\kilo\electronvolt},
+        # \pdv{f}{x}) hundreds of times, so most lookups skip the handler.
+        self.memo = LRUCache(cache_size)
+        # _map_unit results: the same unit shows up with many different
+        # numbers (\qty{1}{\kilo\meter}, \qty{2}{\kilo\meter}), which the
+        # command memo above cannot share
+        self.unit_memo = LRUCache(cache_size)
+        # Hashable snapshot of the options that change handler output, as
+        # sorted (option, value) pairs (see CHEM_OPTIONS); part of every memo
+        # key so a profile change never reuses stale text. Every document
+        # starts from the defaults.
+        self.profile = ()
+        # Mode stack (see TokenStream) where the last _convert_buffer() call
+        # stopped; a stream's next buffer starts from it
+        self.mode_stack = ()
+        # convert_incremental() results per paragraph block, keyed on
+        # (block text, profile at the block start)
+        self.blocks = LRUCache(block_cache_size)
+        # (text, block ends) of the last convert_incremental() call
+        self._last_split = ("", [])
+        # Per command key: [found, converted, handler calls, handler seconds],
+        # accumulated by every conversion until take_counters()
+        self.counters = {}
 
     def _tokenize_unit(self, unit_str):
         """
-        Tokenizes unit string into commands and text.
-        Returns list of (type, value) tuples.
-        types: 'CMD', 'TEXT', 'ARG'
+        Tokenizes unit string into commands and text in one pass of the
+        token pattern from _get_unit_tables(). Returns list of (type, value)
+        tuples. types: 'CMD', 'TEXT', 'ARG'
+        A prefix followed by a prefixable unit (\\kilo\\meter) is one CMD
+        token, looked up in the generated prefix x unit table.
         """
         tokens = []
-        i = 0
+        pos = 0
         n = len(unit_str)
-        while i < n:
-            char = unit_str[i]
-            if char == '\\':
-                j = i + 1
-                while j < n and unit_str[j].isalpha():
-                    j += 1
-                cmd = unit_str[i:j]
-                tokens.append(('CMD', cmd))
-                i = j
-                # Check for argument immediately for specific commands?
-                # Actually, better to parse args as separate tokens or attached.
-                # Let's do simple tokenization first.
-            elif char == '{':
+        match = _get_unit_tables()[1].match
+        while pos < n:
+            token = match(unit_str, pos)
+            kind = token.lastgroup
+            pos = token.end()
+            if kind == 'prefixed':
+                tokens.append(('CMD', token['prefix'] + token['unit']))
+            elif kind == 'cmd' or kind == 'text':
+                tokens.append(('CMD' if kind == 'cmd' else 'TEXT', token.group()))
+            elif kind == 'brace':
                 # Extract braced content as ARG
-                arg, end = self._extract_braced_content(unit_str, i)
+                arg, end = self._extract_braced_content(unit_str, pos - 1)
                 if arg is not None:
                     tokens.append(('ARG', arg))
-                    i = end + 1
+                    pos = end + 1
                 else:
-                    tokens.append(('TEXT', char))
-                    i += 1
-            elif char.isspace():
-                i += 1
-            else:
-                tokens.append(('TEXT', char))
-                i += 1
+                    tokens.append(('TEXT', '{'))
         return tokens
 
     def _map_unit(self, unit_str):
@@ -60,10 +643,18 @@ class LatexConverter:
         Handles modifiers: \\per, \\square, \\cubic, \\tothe, \\raiseto.
         """
         # Direct lookup if simple
-        if unit_str in UNIT_MAP:
-            return UNIT_MAP[unit_str]
+        mapped = _get_unit_tables()[0].get(unit_str)
+        if mapped is not None:
+            return mapped
+        mapped = self.unit_memo.get(unit_str)
+        if mapped is None:
+            mapped = self._map_unit_tokens(self._tokenize_unit(unit_str))
+            self.unit_memo.put(unit_str, mapped)
+        return mapped
 
-        tokens = self._tokenize_unit(unit_str)
+    def _map_unit_tokens(self, tokens):
+        """_map_unit for a token list from _tokenize_unit."""
+        symbols = _get_unit_tables()[0]
         output = []
         
         # State
@@ -91,9 +682,9 @@ class LatexConverter:
                         next_power = tokens[i+1][1]
                         i += 1 # Skip arg
                     consumed = True
-                elif val in UNIT_MAP:
+                elif val in symbols:
                     # It's a unit
-                    mapped = UNIT_MAP[val]
+                    mapped = symbols[val]
                     
                     # Determine base power from prefixes
                     p = 1
@@ -169,7 +760,8 @@ class LatexConverter:
                 output.append(val)
                 
             elif typ == 'TEXT':
-                output.append(val)
+                # Literal units (n/cm^3, MS) are upright like the mapped ones
+                output.append(_UNIT_TEXT_PATTERN.sub(r'\\mathrm{\g<0>}', val))
             elif typ == 'ARG':
                 # Unexpected arg
                 pass
@@ -309,240 +901,705 @@ class LatexConverter:
             res += f"\\,{self._map_unit(unit)}"
         return res
 
-    def convert(self, text):
+    # SIUNITX
+
+    @command('num', spec='m')
+    def _cmd_num(self, number):
+        return self._parse_number(number)
+
+    @command('complexnum', spec='m')
+    def _cmd_complexnum(self, number):
+        return self._parse_complex(number)
+
+    @command('unit', 'si', spec='o m')
+    def _cmd_unit(self, options, unit):
+        # options such as [per-mode=symbol] are accepted but not applied
+        return self._map_unit(unit)
+
+    @command('qty', 'SI', spec='o m m')
+    def _cmd_qty(self, options, number, unit):
+        return f"{self._parse_number(number)}\\,{self._map_unit(unit)}"
+
+    @command('numlist', spec='o m')
+    def _cmd_numlist(self, options, numbers):
+        return self._parse_list(numbers)
+
+    @command('numproduct', spec='o m')
+    def _cmd_numproduct(self, options, numbers):
+        return self._parse_product(numbers)
+
+    @command('qtylist', spec='o m m')
+    def _cmd_qtylist(self, options, numbers, unit):
+        return self._parse_list(numbers, unit=unit)
+
+    @command('qtyproduct', spec='o m m')
+    def _cmd_qtyproduct(self, options, numbers, unit):
+        return self._parse_product(numbers, unit=unit)
+
+    @command('numrange', spec='o m m')
+    def _cmd_numrange(self, options, num1, num2):
+        return self._parse_range(num1, num2)
+
+    @command('SIrange', 'qtyrange', spec='o m m m')
+    def _cmd_qtyrange(self, options, num1, num2, unit):
+        return self._parse_range(num1, num2, unit=unit)
+
+    @command('ang', spec='m')
+    def _cmd_ang(self, angle):
+        if ';' not in angle:
+            return f"{angle}^{{\\circ}}"
+        parts = angle.split(';')
+        # parts[0] is degrees, parts[1] is minutes, parts[2] is seconds
+        res = ""
+        if parts[0].strip():
+            res += f"{parts[0]}^{{\\circ}}"
+        if len(parts) > 1 and parts[1].strip():
+            res += f"{parts[1]}'"
+        if len(parts) > 2 and parts[2].strip():
+            res += f"{parts[2]}''"
+        return res
+
+    # Tabular Column Types (S -> c)
+    # This is a naive replacement for \begin{tabular}{...S...}
+    @environment('tabular', spec='m')
+    def _env_tabular(self, columns):
+        # Replace S with c (centering is a safe default for numbers)
+        return f"\\begin{{tabular}}{{{columns.replace('S', 'c')}}}"
+
+    # MHCHEM
+
+    def _set_chem_options(self, options):
+        # Folds key=value pairs from the preamble into self.profile
+        values = dict(self.profile)
+        for item in options.split(','):
+            key, sep, value = item.partition('=')
+            if sep and key.strip() in CHEM_OPTIONS:
+                values[key.strip()] = value.strip()
+        self.profile = tuple(sorted(values.items()))
+
+    def _parse_ce(self, content):
+        """
+        Handles \\ce{...}: formulas (H2O -> \\mathrm{H}_{2}\\mathrm{O}),
+        charges (SO4^2-, OH-), coefficients, reaction arrows with [above]
+        and [below] labels, \\bond, precipitate/gas marks (v, ^), adducts
+        (* or .) and $...$ math, in which nested \\ce are converted too.
+        """
+        options = dict(self.profile)
+        font = _CHEM_FONTS.get(options.get('textfontname'), '\\mathrm')
+        extensible = options.get('arrows') != 'font'
         output = []
-        i = 0
-        n = len(text)
-        
-        while i < n:
-            if text[i] == '\\':
-                # Identify command
-                j = i + 1
-                while j < n and text[j].isalpha():
-                    j += 1
-                cmd = text[i:j]
-                
-                # Logic for SIUNITX
-                if cmd == '\\num':
-                    arg, end = self._extract_braced_content(text, j)
-                    if arg is not None:
-                        output.append(self._parse_number(arg))
-                        i = end + 1
-                        continue
-                
-                elif cmd == '\\complexnum':
-                    arg, end = self._extract_braced_content(text, j)
-                    if arg is not None:
-                        output.append(self._parse_complex(arg))
-                        i = end + 1
-                        continue
-                        
-                elif cmd in ['\\unit', '\\si']:
-                    # Handle optional arg [per-mode=symbol]
-                    _, opt_end = self._extract_optional_arg(text, j)
-                    
-                    arg, end = self._extract_braced_content(text, opt_end + 1 if opt_end != j else j)
+        prev = 'start'  # kind of the last token: start, space, species, coef, cmd, op
+        last_cmd = ''
+        pos = 0
+        n = len(content)
+        match = _CHEM_TOKEN_PATTERN.match
+        while pos < n:
+            token = match(content, pos)
+            kind = token.lastgroup
+            value = token.group()
+            pos = token.end()
+            following = content[pos:pos+1]
+            if kind == 'space':
+                output.append(' ')
+                if prev != 'start':
+                    prev = 'space'
+                continue
+            if kind == 'letters':
+                if value == 'v' and prev in ('start', 'space') and (not following or following.isspace()):
+                    output.append('\\downarrow')
+                    prev = 'op'
+                else:
+                    output.append(f"{font}{{{value}}}")
+                    prev = 'species'
+            elif kind == 'digits':
+                if prev == 'species':
+                    output.append(f"_{{{value}}}")
+                else:
+                    # Stoichiometric coefficient: 2H2O, 12 H2O
+                    output.append(value)
+                    after = content[_WHITESPACE_PATTERN.match(content, pos).end():][:1]
+                    if after.isalpha() or after in ('(', '[', '\\'):
+                        output.append('\\,')
+                    prev = 'coef'
+            elif kind == 'sup':
+                if prev in ('start', 'space') and (not following or following.isspace()):
+                    output.append('\\uparrow')
+                    prev = 'op'
+                    continue
+                if following == '{':
+                    arg, end = self._extract_braced_content(content, pos)
                     if arg is not None:
-                        output.append(self._map_unit(arg))
-                        i = end + 1
-                        continue
+                        pos = end + 1
+                else:
+                    charge = _CHEM_CHARGE_PATTERN.match(content, pos)
+                    arg = charge and charge.group()
+                    if arg:
+                        pos = charge.end()
+                if prev in ('start', 'space', 'coef', 'op'):
+                    output.append('{}')  # leading isotope mass: ^{12}C
+                output.append(f"^{{{self._chem_superscript(arg, font)}}}" if arg is not None else '^')
+                prev = 'species'
+            elif kind == 'sub':
+                arg, end = self._extract_braced_content(content, pos) if following == '{' else (None, -1)
+                if arg is not None:
+                    output.append(f"_{{{self._parse_ce(arg)}}}")
+                    pos = end + 1
+                elif following and not following.isspace():
+                    output.append(f"_{{{following}}}")
+                    pos += 1
+                else:
+                    output.append('_')
+                prev = 'species'
+            elif kind == 'arrow':
+                labels = []
+                while len(labels) < 2 and content.startswith('[', pos):
+                    label, end = self._extract_optional_arg(content, pos)
+                    if label is None:
+                        break
+                    labels.append(self._parse_ce(label))
+                    pos = end + 1
+                output.append(self._chem_arrow(value, *labels, extensible=extensible))
+                prev = 'op'
+            elif kind == 'bond':
+                output.append(_CHEM_BONDS.get(token.group('bond'), '{-}'))
+                prev = 'op'
+            elif kind == 'state':
+                output.append('\\downarrow' if value == '(v)' else '\\uparrow')
+                prev = 'op'
+            elif kind == 'math':
+                output.append(self._chem_math(value[1:-1]))
+                prev = 'species'
+            elif kind == 'cmd':
+                output.append(value)
+                last_cmd = value
+                prev = 'start' if value == '\\\\' else 'cmd'
+            elif kind == 'brace':
+                arg, end = self._extract_braced_content(content, pos - 1)
+                if arg is None:
+                    output.append(value)
+                    prev = 'op'
+                    continue
+                pos = end + 1
+                # Text arguments (\text{...}, \mathrm{...}) are not formulas
+                if prev == 'cmd' and last_cmd.startswith(('\\text', '\\math', '\\operatorname')):
+                    output.append(f"{{{arg}}}")
+                else:
+                    output.append(f"{{{self._parse_ce(arg)}}}")
+                prev = 'species'
+            elif value in '+-':
+                if prev in ('species', 'cmd') and not (following.isalnum() or following in ('(', '[', '\\')):
+                    output.append(f"^{{{value}}}")  # charge: H+, OH-, [...]^2-
+                    prev = 'species'
+                elif value == '-' and prev in ('species', 'cmd'):
+                    output.append('{-}')  # bond: \mu-Cl
+                    prev = 'op'
+                else:
+                    output.append(value)
+                    prev = 'op'
+            elif value == '.' and prev == 'coef' and following.isdigit():
+                output.append(value)  # decimal coefficient 0.5H2O
+                prev = 'op'
+            elif value in '*.':
+                output.append('\\cdot ')
+                prev = 'op'
+            elif value in '=#' and prev == 'species':
+                output.append(_CHEM_BONDS[value])
+                prev = 'op'
+            else:
+                output.append(value)
+                prev = 'species' if value in ')]' else 'op'
+        return "".join(output).strip()
 
-                elif cmd in ['\\qty', '\\SI']:
-                    # \qty[opts]{num}{unit}
-                    _, opt_end = self._extract_optional_arg(text, j)
-                    
-                    num_arg, end1 = self._extract_braced_content(text, opt_end + 1 if opt_end != j else j)
-                    if num_arg is not None:
-                        # Check for second arg
-                        unit_arg, end2 = self._extract_braced_content(text, end1 + 1)
-                        if unit_arg is not None:
-                            output.append(f"{self._parse_number(num_arg)}\\,{self._map_unit(unit_arg)}")
-                            i = end2 + 1
-                            continue
-
-                elif cmd in ['\\numlist', '\\numproduct']:
-                    _, opt_end = self._extract_optional_arg(text, j)
-                    arg, end = self._extract_braced_content(text, opt_end + 1 if opt_end != j else j)
-                    if arg is not None:
-                        if cmd == '\\numlist':
-                            output.append(self._parse_list(arg))
-                        else:
-                            output.append(self._parse_product(arg))
-                        i = end + 1
-                        continue
-
-                elif cmd in ['\\qtylist', '\\qtyproduct']:
-                    _, opt_end = self._extract_optional_arg(text, j)
-                    arg1, end1 = self._extract_braced_content(text, opt_end + 1 if opt_end != j else j)
-                    if arg1 is not None:
-                        arg2, end2 = self._extract_braced_content(text, end1 + 1)
-                        if arg2 is not None:
-                            if cmd == '\\qtylist':
-                                output.append(self._parse_list(arg1, unit=arg2))
-                            else:
-                                output.append(self._parse_product(arg1, unit=arg2))
-                            i = end2 + 1
-                            continue
-
-                elif cmd in ['\\numrange', '\\SIrange', '\\qtyrange']:
-                    _, opt_end = self._extract_optional_arg(text, j)
-                    arg1, end1 = self._extract_braced_content(text, opt_end + 1 if opt_end != j else j)
-                    if arg1 is not None:
-                        arg2, end2 = self._extract_braced_content(text, end1 + 1)
-                        if arg2 is not None:
-                            if cmd == '\\numrange':
-                                output.append(self._parse_range(arg1, arg2))
-                                i = end2 + 1
-                                continue
-                            else: # qtyrange, SIrange requires 3rd arg for unit?
-                                # \qtyrange{1}{10}{\meter}
-                                arg3, end3 = self._extract_braced_content(text, end2 + 1)
-                                if arg3 is not None:
-                                    output.append(self._parse_range(arg1, arg2, unit=arg3))
-                                    i = end3 + 1
-                                    continue
-                        # Fallback if args missing? 
-                        
-                elif cmd == '\\ang':
-                    arg, end = self._extract_braced_content(text, j)
-                    if arg is not None:
-                        if ';' in arg:
-                            parts = arg.split(';')
-                            # parts[0] is degrees, parts[1] is minutes, parts[2] is seconds
-                            res = ""
-                            if parts[0].strip():
-                                res += f"{parts[0]}^{{\\circ}}"
-                            if len(parts) > 1 and parts[1].strip():
-                                res += f"{parts[1]}'"
-                            if len(parts) > 2 and parts[2].strip():
-                                res += f"{parts[2]}''"
-                            output.append(res)
-                        else:
-                            output.append(f"{arg}^{{\\circ}}")
-                        i = end + 1
-                        continue
-
-                # Tabular Column Types (S -> c)
-                # This is a naive replacement for \begin{tabular}{...S...}
-                # We need to detect \begin{tabular} and then modify its argument.
-                elif cmd == '\\begin':
-                    arg, end = self._extract_braced_content(text, j)
-                    if arg == 'tabular':
-                        output.append('\\begin{tabular}')
-                        # The next braced group is the column spec
-                        spec, end_spec = self._extract_braced_content(text, end + 1)
-                        if spec is not None:
-                            # Replace S with c (centering is a safe default for numbers)
-                            new_spec = spec.replace('S', 'c')
-                            output.append(f"{{{new_spec}}}")
-                            i = end_spec + 1
-                            continue
-                        else:
-                            i = end + 1
-                            continue
-                    else:
-                        output.append(f"\\begin{{{arg}}}")
-                        i = end + 1
-                        continue
-
-                # Logic for PHYSICS
-                # Derivatives: \dv{x}, \dv{f}{x}, \dv[n]{f}{x}
-                elif cmd == '\\dv':
-                    opt_arg, opt_end = self._extract_optional_arg(text, j)
-                    arg1, end1 = self._extract_braced_content(text, opt_end + 1 if opt_end != j else j)
-                    
-                    if arg1 is not None:
-                        # Check for second arg
-                        arg2, end2 = self._extract_braced_content(text, end1 + 1)
-                        if arg2 is not None:
-                            # \dv{f}{x} -> \frac{d f}{d x}
-                            order = f"^{opt_arg}" if opt_arg else ""
-                            output.append(f"\\frac{{\\mathrm{{d}}{order} {arg1}}}{{\\mathrm{{d}}{arg2}{order}}}")
-                            i = end2 + 1
-                        else:
-                            # \dv{x} -> \mathrm{d}x (differentials?) usually \dd is differential, \dv is derivative
-                            # But \dv{x} sometimes means d/dx operator if single arg? 
-                            # Physics package doc: \dv{x} -> d/dx. \dv{f}{x} -> df/dx.
-                            order = f"^{opt_arg}" if opt_arg else ""
-                            output.append(f"\\frac{{\\mathrm{{d}}{order}}}{{\\mathrm{{d}}{arg1}{order}}}")
-                            i = end1 + 1
-                        continue
-
-                elif cmd == '\\pdv':
-                    opt_arg, opt_end = self._extract_optional_arg(text, j)
-                    arg1, end1 = self._extract_braced_content(text, opt_end + 1 if opt_end != j else j)
-                    
-                    if arg1 is not None:
-                        arg2, end2 = self._extract_braced_content(text, end1 + 1)
-                        if arg2 is not None:
-                             # \pdv{f}{x}
-                            order = f"^{opt_arg}" if opt_arg else ""
-                            output.append(f"\\frac{{\\partial{order} {arg1}}}{{\\partial {arg2}{order}}}")
-                            i = end2 + 1
-                        else:
-                            # \pdv{x} -> partial/partial x
-                            order = f"^{opt_arg}" if opt_arg else ""
-                            output.append(f"\\frac{{\\partial{order}}}{{\\partial {arg1}{order}}}")
-                            i = end1 + 1
-                        continue
-
-                # Bracy things: \abs, \norm
-                elif cmd == '\\abs':
-                    arg, end = self._extract_braced_content(text, j)
-                    if arg is not None:
-                        output.append(f"\\left| {arg} \\right|")
-                        i = end + 1
-                        continue
-                elif cmd == '\\norm':
-                    arg, end = self._extract_braced_content(text, j)
-                    if arg is not None:
-                        output.append(f"\\left\\| {arg} \\right\\|")
-                        i = end + 1
-                        continue
-                
-                # Vectors
-                elif cmd == '\\vb':
-                    arg, end = self._extract_braced_content(text, j)
-                    if arg is not None:
-                        output.append(f"\\mathbf{{{arg}}}")
-                        i = end + 1
-                        continue
-                
-                # Bras and Kets
-                elif cmd == '\\bra':
-                    arg, end = self._extract_braced_content(text, j)
-                    if arg is not None:
-                        output.append(f"\\langle {arg} |")
-                        i = end + 1
-                        continue
-                elif cmd == '\\ket':
-                    arg, end = self._extract_braced_content(text, j)
-                    if arg is not None:
-                        output.append(f"| {arg} \\rangle")
-                        i = end + 1
-                        continue
-                elif cmd == '\\braket':
-                    arg1, end1 = self._extract_braced_content(text, j)
-                    if arg1 is not None:
-                        arg2, end2 = self._extract_braced_content(text, end1 + 1)
-                        if arg2 is not None:
-                            output.append(f"\\langle {arg1} | {arg2} \\rangle")
-                            i = end2 + 1
-                        else:
-                             # \braket{x} -> <x|x> usually? Or just <x|
-                             # Physics package: \braket{a} -> <a|a> NO, \braket{a} -> <a| 
-                             # Wait, \braket{a}{b} is <a|b>. \braket{a} is usually just inner product placeholder?
-                             # Let's assume 2 args for standard usage, if 1 arg, maybe it is <a|a> check docs.
-                             # Docs say: \braket{a} -> <a|a>.
-                             output.append(f"\\langle {arg1} | {arg1} \\rangle")
-                             i = end1 + 1
-                        continue
-
-                # If no match, just append the command extraction
-                output.append(cmd)
-                i = j
+    def _chem_superscript(self, text, font):
+        # Charges and oxidation states: letters upright, '.' is a radical dot
+        text = _CHEM_WORD_PATTERN.sub(
+            lambda word: word.group() if word.group()[0] == '\\' else f"{font}{{{word.group()}}}", text)
+        return text.replace('.', '\\bullet ').rstrip()
+
+    def _chem_arrow(self, arrow, above=None, below=None, extensible=True):
+        command, symbol = _CHEM_ARROWS[arrow]
+        if command and extensible and (above or below):
+            below = f"[{below}]" if below else ""
+            return f"{command}{below}{{{above or ''}}}"
+        if above:
+            symbol = f"\\overset{{{above}}}{{{symbol}}}"
+        if below:
+            symbol = f"\\underset{{{below}}}{{{symbol}}}"
+        return symbol
+
+    def _chem_math(self, math):
+        # $...$ inside \ce is already math; only nested \ce{...} is converted
+        output = []
+        copied = 0
+        start = math.find('\\ce{')
+        while start != -1:
+            arg, end = self._extract_braced_content(math, start + 3)
+            if arg is None:
+                break
+            output.append(math[copied:start])
+            output.append(f"{{{self._parse_ce(arg)}}}")
+            copied = end + 1
+            start = math.find('\\ce{', copied)
+        output.append(math[copied:])
+        return "".join(output)
+
+    def _parse_pu(self, content):
+        """
+        Handles \\pu{...}: \\pu{123 kJ/mol} -> 123\\,\\mathrm{kJ}/\\mathrm{mol},
+        \\pu{1.2e3 kg m-3} -> 1.2 \\times 10^{3}\\,\\mathrm{kg}\\,\\mathrm{m}^{-3}
+        """
+        number = ""
+        rest = content
+        match = _PU_NUMBER_PATTERN.match(content)
+        if match:
+            number = self._parse_number(match.group(1))
+            rest = content[match.end():]
+        units = []
+        pos = 0
+        while pos < len(rest):
+            token = _PU_UNIT_PATTERN.match(rest, pos)
+            if token is None:
+                units.append(rest[pos])
+                pos += 1
+                continue
+            pos = token.end()
+            unit = token.group('unit')
+            if unit is None:
+                units.append(_PU_SEPARATORS[token.group('sep')] if token.group('sep') else '\\,')
+                continue
+            if unit[0] == '°':
+                mapped = '{}^{\\circ}' + (f"\\mathrm{{{unit[1:]}}}" if unit[1:] else "")
             else:
-                output.append(text[i])
-                i += 1
-        
+                mapped = f"\\mathrm{{{unit}}}"
+            if token.group('power'):
+                mapped += f"^{{{token.group('power')}}}"
+            units.append(mapped)
+        unit = "".join(units).strip()
+        if number and unit:
+            return f"{number}\\,{unit}"
+        return number or unit
+
+    @command('ce', spec='m')
+    def _cmd_ce(self, formula):
+        return self._parse_ce(formula)
+
+    @command('pu', spec='m')
+    def _cmd_pu(self, quantity):
+        return self._parse_pu(quantity)
+
+    @command('usepackage', spec='o m', stateful=True)
+    def _cmd_usepackage(self, options, packages):
+        if options and 'mhchem' in (name.strip() for name in packages.split(',')):
+            self._set_chem_options(options)
+        # The preamble itself is left as written
+
+    @command('mhchemoptions', spec='m', stateful=True)
+    def _cmd_mhchemoptions(self, options):
+        self._set_chem_options(options)
+
+    # PHYSICS
+
+    # Derivatives: \dv{x}, \dv{f}{x}, \dv[n]{f}{x}
+    # Physics package doc: \dv{x} -> d/dx. \dv{f}{x} -> df/dx.
+    @command('dv', spec='o m g')
+    def _cmd_dv(self, order, arg1, arg2):
+        order = f"^{order}" if order else ""
+        if arg2 is None:
+            return f"\\frac{{\\mathrm{{d}}{order}}}{{\\mathrm{{d}}{arg1}{order}}}"
+        return f"\\frac{{\\mathrm{{d}}{order} {arg1}}}{{\\mathrm{{d}}{arg2}{order}}}"
+
+    @command('pdv', spec='o m g')
+    def _cmd_pdv(self, order, arg1, arg2):
+        order = f"^{order}" if order else ""
+        if arg2 is None:
+            return f"\\frac{{\\partial{order}}}{{\\partial {arg1}{order}}}"
+        return f"\\frac{{\\partial{order} {arg1}}}{{\\partial {arg2}{order}}}"
+
+    # Bracy things: \abs, \norm
+    @command('abs', spec='m')
+    def _cmd_abs(self, arg):
+        return f"\\left| {arg} \\right|"
+
+    @command('norm', spec='m')
+    def _cmd_norm(self, arg):
+        return f"\\left\\| {arg} \\right\\|"
+
+    # Vectors
+    @command('vb', spec='m')
+    def _cmd_vb(self, arg):
+        return f"\\mathbf{{{arg}}}"
+
+    # Bras and Kets
+    @command('bra', spec='m')
+    def _cmd_bra(self, arg):
+        return f"\\langle {arg} |"
+
+    @command('ket', spec='m')
+    def _cmd_ket(self, arg):
+        return f"| {arg} \\rangle"
+
+    # Physics package docs: \braket{a} -> <a|a>.
+    @command('braket', spec='m g')
+    def _cmd_braket(self, arg1, arg2):
+        if arg2 is None:
+            arg2 = arg1
+        return f"\\langle {arg1} | {arg2} \\rangle"
+
+    def convert(self, text, return_edits=False, profile=()):
+        """
+        Converts siunitx/physics/mhchem commands in text to standard LaTeX.
+        Only the names registered in COMMANDS are located (one compiled
+        regex); everything between them is copied as whole slices.
+        With return_edits=True returns (converted, edits) where edits is the
+        list of Edit(start, end, replacement, command) in source order.
+        profile is the preamble state text starts with, for a file that is
+        included from another (see profile_after).
+        """
+        edits = [] if return_edits else None
+        self.profile = profile
+        self.mode_stack = ()
+        output, _ = self._convert_buffer(text, True, edits, self.counters)
+        if edits is not None:
+            return "".join(output), edits
+        return "".join(output)
+
+    def profile_after(self, text, profile=()):
+        """
+        The profile in effect at the end of text when it starts with
+        profile. Only text holding a STATEFUL_COMMANDS name is converted.
+        """
+        if not _get_stateful_pattern().search(text):
+            return profile
+        return self._convert_chunk(text, profile, False)[2]
+
+    def convert_incremental(self, text, return_edits=False):
+        """
+        convert() for text that is resubmitted with small changes, such as
+        the /convert form. Text is cut into paragraph blocks (split_blocks)
+        and each block's output and edits are remembered, so only blocks
+        that changed since an earlier call are converted again. Output and
+        edits are identical to convert().
+        """
+        output = []
+        edits = [] if return_edits else None
+        offset = 0
+        self.profile = ()
+        blocks_get, blocks_put = self.blocks.get, self.blocks.put
+        for block in self._split_resubmitted(text):
+            # Blocks follow paragraph breaks, which end any open math
+            self.mode_stack = ()
+            key = (block, self.profile)
+            cached = blocks_get(key)
+            if cached is None:
+                block_edits = []
+                block_counters = {}
+                parts, _ = self._convert_buffer(block, True, block_edits, block_counters)
+                cached = ("".join(parts), tuple(block_edits), self.profile, block_counters)
+                blocks_put(key, cached)
+                self._add_counters(block_counters, True)
+            else:
+                self._add_counters(cached[3], False)
+            converted, block_edits, self.profile, _ = cached
+            output.append(converted)
+            if edits is not None:
+                edits.extend(edit._replace(start=edit.start + offset, end=edit.end + offset)
+                             for edit in block_edits)
+            offset += len(block)
+        if edits is not None:
+            return "".join(output), edits
+        return "".join(output)
+
+    def _split_resubmitted(self, text):
+        """
+        split_blocks(text), reusing the block ends found for the previous
+        call: ends inside the unchanged head are kept, and scanning of the
+        changed region stops at the first end that the unchanged tail
+        already had (same text after it, depth 0 on both sides).
+        """
+        old_text, old_ends = self._last_split
+        head = common_prefix_length(old_text, text)
+        limit = min(len(old_text), len(text)) - head
+        tail = common_prefix_length(old_text[::-1][:limit], text[::-1][:limit])
+
+        # An end at head could still move: its blank-line run may continue
+        # into the changed text
+        ends = old_ends[:bisect_left(old_ends, head)]
+        shift = len(text) - len(old_text)
+        first_tail = bisect_left(old_ends, len(old_text) - tail)
+        resume = {end + shift: i for i, end in enumerate(old_ends[first_tail:], first_tail)}
+        for end in _block_ends(text, ends[-1] if ends else 0):
+            ends.append(end)
+            i = resume.get(end)
+            if i is not None:
+                ends.extend(old_end + shift for old_end in old_ends[i+1:])
+                break
+
+        self._last_split = (text, ends)
+        return _slice_blocks(text, ends)
+
+    def convert_parallel(self, text, executor=None, workers=None, return_edits=False,
+                         min_chars=PARALLEL_MIN_CHARS):
+        """
+        convert() spread over worker processes: text is cut with
+        split_chunks() and the chunks are converted on executor (a
+        ProcessPoolExecutor; one is started for this call if None) with up
+        to workers (default: CPU count) running at once. A chunk that may
+        change the profile (see STATEFUL_COMMANDS, normally the preamble)
+        is converted here, in order, so every later chunk is sent with the
+        profile it starts from. Output and edits are identical to
+        convert(); text shorter than min_chars is simply passed to it.
+        """
+        workers = workers or os.cpu_count() or 1
+        if workers <= 1 or len(text) < min_chars:
+            return self.convert(text, return_edits)
+        chunks = split_chunks(text, max(PARALLEL_CHUNK_CHARS, len(text) // (workers * 4)))
+        if len(chunks) == 1:
+            return self.convert(text, return_edits)
+
+        if self.token_pattern is None:
+            self.token_pattern = _get_token_pattern()
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers=min(workers, len(chunks)))
+        try:
+            stateful = _get_stateful_pattern().search
+            self.profile = ()
+            results = []
+            for chunk in chunks:
+                if stateful(chunk):
+                    results.append(self._convert_chunk(chunk, self.profile, return_edits))
+                    self.profile = results[-1][2]
+                    self._add_counters(results[-1][3], True)
+                else:
+                    results.append(executor.submit(_convert_chunk, chunk, self.profile,
+                                                   return_edits, self.token_pattern))
+
+            output = []
+            edits = [] if return_edits else None
+            offset = 0
+            for chunk, result in zip(chunks, results):
+                if not isinstance(result, tuple):
+                    result = result.result()
+                    self._add_counters(result[3], True)
+                converted, chunk_edits, _, _ = result
+                output.append(converted)
+                if edits is not None:
+                    edits.extend(edit._replace(start=edit.start + offset, end=edit.end + offset)
+                                 for edit in chunk_edits)
+                offset += len(chunk)
+        finally:
+            if own_executor:
+                executor.shutdown(cancel_futures=True)
+        self.mode_stack = ()
+        if edits is not None:
+            return "".join(output), edits
         return "".join(output)
+
+    def _convert_chunk(self, text, profile, return_edits):
+        # One convert_parallel() chunk, starting with profile and an empty
+        # mode stack (chunks follow paragraph breaks). Returns (converted,
+        # edits or None, profile at the end, counters).
+        self.profile = profile
+        self.mode_stack = ()
+        edits = [] if return_edits else None
+        counters = {}
+        parts, _ = self._convert_buffer(text, True, edits, counters)
+        return "".join(parts), edits, self.profile, counters
+
+    def convert_stream(self, chunks, max_pending=1 << 20, with_source=False):
+        """
+        Converts an iterable of text chunks (see iter_chunks), yielding
+        converted text as soon as it is safe to. Only a command whose name
+        or arguments may continue in the next chunk is held back, so memory
+        is bounded by the largest single command. An argument still open
+        after max_pending characters is treated like an unbalanced brace.
+        Output joined together equals convert() of the joined input.
+        with_source=True yields (source, converted) pairs instead, source
+        being the input text that converted replaces.
+        """
+        buffer = ""
+        self.profile = ()
+        self.mode_stack = ()
+        for chunk in chunks:
+            if not chunk:
+                continue
+            buffer += chunk
+            output, consumed = self._convert_buffer(buffer, False, None, self.counters, len(buffer) > max_pending)
+            if output:
+                yield (buffer[:consumed], "".join(output)) if with_source else "".join(output)
+            buffer = buffer[consumed:]
+        output, _ = self._convert_buffer(buffer, True, None, self.counters)
+        if output:
+            yield (buffer, "".join(output)) if with_source else "".join(output)
+
+    def take_counters(self):
+        """
+        Returns the per-command counters collected since the last call as
+        {key: {"found", "converted", "handler_calls", "handler_seconds"}}
+        (keys as in COMMANDS, e.g. 'qty', 'begin{tabular}') and resets them.
+        Handlers only run on memo misses, so calls can be below found.
+        """
+        counters, self.counters = self.counters, {}
+        return {name: {"found": found, "converted": converted,
+                       "handler_calls": calls, "handler_seconds": seconds}
+                for name, (found, converted, calls, seconds) in sorted(counters.items())}
+
+    def _add_counters(self, counters, with_handlers):
+        # Folds one block's counters into self.counters; a reused block ran
+        # no handlers, so only its found/converted counts are added
+        total = self.counters
+        for name, (found, converted, calls, seconds) in counters.items():
+            entry = total.get(name)
+            if entry is None:
+                entry = total[name] = [0, 0, 0, 0.0]
+            entry[0] += found
+            entry[1] += converted
+            if with_handlers:
+                entry[2] += calls
+                entry[3] += seconds
+
+    def _convert_buffer(self, text, final, edits, counters, force_first=False):
+        """
+        The conversion loop behind convert() and convert_stream().
+        Returns (output parts, consumed) where text[:consumed] has been
+        converted. Unless final, it stops before a command that could
+        continue past the end of text; force_first resolves the first such
+        command as if text were final so a stream always makes progress.
+        Commands found and converted and the time spent in handlers are
+        added to counters (see self.counters).
+        """
+        output = []
+        n = len(text)
+        copied = 0  # text[:copied] is already in output
+        pos = 0     # commands before pos sit inside an already replaced argument
+        if self.token_pattern is None:
+            self.token_pattern = _get_token_pattern()
+        tokens = TokenStream(text, final, self.mode_stack, self.token_pattern)
+        memo_get, memo_put = self.memo.get, self.memo.put
+        # Names are tallied once at the end; the loop only appends
+        found = []  # every complete command
+        kept = []   # the ones whose handler left them untouched
+        found_append = found.append
+        try:
+            for start, j in zip(tokens.starts, tokens.ends):
+                if start < pos:
+                    continue
+                if j == n and not final:
+                    return self._flush(tokens, output, copied, start)
+                name = text[start+1:j]
+                spec, handler = COMMANDS[name]
+                args, end = tokens.read(spec, j)
+                if args is INCOMPLETE:
+                    if not force_first:
+                        return self._flush(tokens, output, copied, start)
+                    force_first = False
+                    args = None
+                if args is None:
+                    continue
+                found_append(name)
+                key = (name, *args, self.profile)
+                stateful = name in STATEFUL_COMMANDS
+                replacement = _MISSING if stateful else memo_get(key, _MISSING)
+                if replacement is _MISSING:
+                    started = time.perf_counter()
+                    replacement = handler(self, *args)
+                    elapsed = time.perf_counter() - started
+                    if not stateful:
+                        counts = counters.get(name) or counters.setdefault(name, [0, 0, 0, 0.0])
+                        counts[2] += 1
+                        counts[3] += elapsed
+                        memo_put(key, replacement)
+                if replacement is None:
+                    kept.append(name)
+                    continue
+                if name in MATH_COMMANDS and tokens.mode_at(start) == MODE_TEXT:
+                    replacement = f"${replacement}$"
+
+                if start > copied:
+                    output.append(text[copied:start])
+                output.append(replacement)
+                if edits is not None:
+                    edits.append(Edit(start, end, replacement, name))
+                copied = pos = end
+
+            return self._flush(tokens, output, copied, n if final else self._stream_stop(tokens, copied))
+        finally:
+            if found:
+                _tally(counters, found, kept)
+
+    def _stream_stop(self, tokens, copied):
+        """
+        How far a non-final buffer can be converted once every command in it
+        is done: not into a trailing command name, $ or whitespace with a
+        newline, which the next chunk could still turn into a handled
+        command, $$ or a paragraph break, and never inside a token.
+        """
+        text = tokens.text
+        stop = n = len(text)
+        tail = text.rfind('\\', copied)
+        if tail != -1 and _TRAILING_COMMAND_PATTERN.match(text, tail):
+            # Unless that backslash closes a \\ escape
+            run = tail
+            while run > copied and text[run-1] == '\\':
+                run -= 1
+            if (tail - run) % 2 == 0:
+                stop = tail
+        i = n
+        while i > copied and text[i-1] == '$':
+            i -= 1
+        if i == n:
+            while i > copied and text[i-1] in ' \t\r\n':
+                i -= 1
+            newline = text.find('\n', i)
+            i = n if newline == -1 else newline
+        stop = min(stop, i)
+        return tokens.token_start(stop)
+
+    def _flush(self, tokens, output, copied, stop):
+        # Ends a _convert_buffer call: copies text up to stop and keeps the
+        # mode stack there for the next buffer of a stream (a final buffer
+        # has none, so it is not lexed to the end for it)
+        stop = max(copied, stop)
+        if stop > copied:
+            output.append(tokens.text[copied:stop])
+        self.mode_stack = () if tokens.final else tokens.modes_at(stop)
+        return output, stop
+
+
+def _tally(counters, found, kept):
+    # Adds found/converted counts per command name to counters. Stateful
+    # commands (\usepackage and the like) only configure the conversion, so
+    # they are left out rather than counted as found and not converted
+    kept = Counter(kept)
+    for name, count in Counter(found).items():
+        if name in STATEFUL_COMMANDS:
+            continue
+        counts = counters.get(name) or counters.setdefault(name, [0, 0, 0, 0.0])
+        counts[0] += count
+        counts[1] += count - kept[name]
+
+
+def iter_chunks(stream, chunk_size=1 << 16):
+    """
+    Chunks for LatexConverter.convert_stream from a text file object, e.g.
+    open(path, encoding='utf-8') or socket.makefile('r', encoding='utf-8').
+    """
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+# The converter each convert_parallel() worker process keeps between chunks,
+# so its memos stay warm for the rest of the document
+_chunk_converter = None
+
+
+def _convert_chunk(text, profile, return_edits, token_pattern):
+    # Pool job for LatexConverter.convert_parallel()
+    global _chunk_converter
+    if _chunk_converter is None:
+        _chunk_converter = LatexConverter()
+    _chunk_converter.token_pattern = token_pattern
+    return _chunk_converter._convert_chunk(text, profile, return_edits)
@@ -0,0 +1,217 @@
+"""
+Long-lived conversion service for editor integrations and build scripts.
+One process keeps a warm LatexConverter (compiled patterns, unit tables,
+command memo, paragraph blocks) and answers JSON-RPC 2.0 requests, one
+JSON object per line, on stdin/stdout or on a local Unix socket. A file
+then costs its conversion time instead of interpreter start, imports and
+a cold converter.
+
+    python -m app.daemon                        # stdin/stdout
+    python -m app.daemon --socket /tmp/latex.sock
+
+Methods (params by name):
+    convert {text}              -> {text, commands}
+    diff    {text}              -> {text, diff_html}
+    report  {text, file}        -> conversion report (see pipeline.conversion_report)
+    stats   {}                  -> requests served and cache statistics
+    shutdown {}                 -> stops the daemon after replying
+
+Every handler runs under the one ConversionService lock, whichever
+transport or thread it arrives on: requests are read concurrently but
+served one at a time, so a long conversion delays every request queued
+behind it. The latency gained is the warm start, not parallelism; run
+several daemons to convert several files at once.
+"""
+import argparse
+import inspect
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import pipeline
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+
+class RpcError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class ConversionService:
+    """
+    The methods behind the RPC interface. Requests are read and answered
+    concurrently, but the converter keeps per-document state (profile,
+    mode stack, counters), so conversions take turns on one lock; the
+    caches they warm are shared by every client.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.stopping = threading.Event()
+        with self.lock:
+            pipeline.init_worker()
+
+    def call(self, method, params):
+        handler = getattr(self, f"rpc_{method}", None) if isinstance(method, str) else None
+        if handler is None:
+            raise RpcError(METHOD_NOT_FOUND, f"Method not found: {method}")
+        if not isinstance(params, dict):
+            raise RpcError(INVALID_PARAMS, "params must be an object")
+        try:
+            inspect.signature(handler).bind(**params)
+        except TypeError as e:
+            raise RpcError(INVALID_PARAMS, str(e))
+        with self.lock:
+            self.requests += 1
+            return handler(**params)
+
+    def rpc_convert(self, text):
+        converter = pipeline.get_converter()
+        converter.take_counters()
+        # Editors resend the whole file after each change; only the
+        # paragraphs that changed are converted again
+        converted = converter.convert_incremental(text)
+        return {"text": converted, "commands": converter.take_counters()}
+
+    def rpc_diff(self, text):
+        converted, diff_html = pipeline.convert_document(text)
+        pipeline.get_converter().take_counters()
+        return {"text": converted, "diff_html": diff_html}
+
+    def rpc_report(self, text, file=None):
+        converter = pipeline.get_converter()
+        converter.take_counters()
+        start = time.perf_counter()
+        converter.convert(text)
+        return pipeline.conversion_report(file, len(text), time.perf_counter() - start,
+                                          converter.take_counters())
+
+    def rpc_stats(self):
+        converter = pipeline.get_converter()
+        return {
+            "pid": os.getpid(),
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "requests": self.requests,
+            "memo": converter.memo.stats(),
+            "unit_memo": converter.unit_memo.stats(),
+            "blocks": converter.blocks.stats(),
+        }
+
+    def rpc_shutdown(self):
+        self.stopping.set()
+        return True
+
+    def handle_line(self, line):
+        """Answers one request line; returns the response object, or None for a notification."""
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return _error(None, PARSE_ERROR, f"Parse error: {e}")
+        if not isinstance(request, dict) or "method" not in request:
+            return _error(None, INVALID_REQUEST, "Invalid request")
+        request_id = request.get("id")
+        try:
+            result = self.call(request["method"], request.get("params", {}))
+        except RpcError as e:
+            response = _error(request_id, e.code, e.message)
+        except Exception as e:
+            response = _error(request_id, INTERNAL_ERROR, f"{type(e).__name__}: {e}")
+        else:
+            response = {"jsonrpc": "2.0", "id": request_id, "result": result}
+        return response if "id" in request else None
+
+
+def _error(request_id, code, message):
+    return {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": message}}
+
+
+def serve_stdio(service, workers=4, stdin=sys.stdin, stdout=sys.stdout):
+    """
+    Reads requests from stdin until EOF or shutdown. Each is handled on a
+    thread, so replies can arrive out of order; clients match them by id.
+    """
+    write_lock = threading.Lock()
+
+    def answer(line):
+        response = service.handle_line(line)
+        if response is not None:
+            with write_lock:
+                stdout.write(json.dumps(response) + "\n")
+                stdout.flush()
+
+    def read():
+        try:
+            for line in stdin:
+                if line.strip():
+                    executor.submit(answer, line)
+        except RuntimeError:
+            pass  # shut down while a line was being read
+        service.stopping.set()
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    # Read on a daemon thread so shutdown does not wait for another line
+    threading.Thread(target=read, daemon=True).start()
+    service.stopping.wait()
+    executor.shutdown(wait=True)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """One client connection: request lines in, response lines out, in order."""
+    def handle(self):
+        service = self.server.service
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = service.handle_line(line)
+            if response is not None:
+                self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+                self.wfile.flush()
+            if service.stopping.is_set():
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+                return
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_socket(service, path):
+    """Serves every client connecting to the Unix socket at path, each on its own thread."""
+    if os.path.exists(path):
+        os.unlink(path)  # left behind by a daemon that did not shut down cleanly
+    with UnixServer(path, _RequestHandler) as server:
+        server.service = service
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve LaTeX conversions as JSON-RPC over stdio or a Unix socket.")
+    parser.add_argument("--socket", default=None, help="listen on this Unix socket path instead of stdin/stdout")
+    parser.add_argument("--threads", type=int, default=4, help="stdin requests handled at once (default: 4)")
+    args = parser.parse_args(argv)
+
+    service = ConversionService()
+    if args.socket:
+        serve_socket(service, args.socket)
+    else:
+        serve_stdio(service, args.threads)
+
+
+if __name__ == "__main__":
+    main()
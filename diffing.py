@@ -0,0 +1,702 @@
+"""
+Diff engines for the HTML diff views.
+
+difflib.HtmlDiff pairs lines with SequenceMatcher and then runs a
+character-level diff on every changed pair, which is effectively quadratic
+on long LaTeX paragraph lines. FastHtmlDiff renders the same table markup
+but finds line matches with a hashed-line patience diff and highlights
+changed lines word by word, giving up on intraline detail past a cutoff.
+"""
+import difflib
+import re
+import shutil
+import tempfile
+from bisect import bisect_left
+from collections import Counter
+
+from app.cache import LRUCache
+
+# Regions with no unique common line fall back to SequenceMatcher on the
+# hashed lines when they are at most this many line pairs; larger ones are
+# reported as a single replace block.
+FALLBACK_MAX_PAIRS = 250_000
+
+# Intraline highlighting is skipped (whole line marked) when the two token
+# lists would need more than this many comparisons.
+INTRALINE_MAX_PAIRS = 40_000
+
+_WORD_PATTERN = re.compile(r'\w+|\s+|[^\w\s]')
+_WORD_CHAR = re.compile(r'\w')
+
+# (old line, new line) -> intraline() result, see intraline_cached()
+_intraline_memo = LRUCache(8192)
+
+
+def diff_opcodes(a, b):
+    """
+    SequenceMatcher-style opcodes (tag, i1, i2, j1, j2) turning line list
+    a into b, computed with a patience diff over hashed lines.
+    """
+    ids = {}
+    ha = [ids.setdefault(line, len(ids)) for line in a]
+    hb = [ids.setdefault(line, len(ids)) for line in b]
+
+    blocks = []
+    stack = [(0, len(ha), 0, len(hb))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+
+        # Common prefix and suffix
+        start = 0
+        while alo + start < ahi and blo + start < bhi and ha[alo + start] == hb[blo + start]:
+            start += 1
+        if start:
+            blocks.append((alo, blo, start))
+            alo += start
+            blo += start
+        end = 0
+        while alo < ahi - end and blo < bhi - end and ha[ahi - end - 1] == hb[bhi - end - 1]:
+            end += 1
+        if end:
+            blocks.append((ahi - end, bhi - end, end))
+            ahi -= end
+            bhi -= end
+        if alo == ahi or blo == bhi or (ahi - alo == 1 and bhi - blo == 1):
+            continue
+
+        anchors = _unique_anchors(ha, hb, alo, ahi, blo, bhi)
+        if anchors:
+            # Recurse into the gaps between anchors
+            prev_a, prev_b = alo, blo
+            for i, j in anchors:
+                blocks.append((i, j, 1))
+                stack.append((prev_a, i, prev_b, j))
+                prev_a, prev_b = i + 1, j + 1
+            stack.append((prev_a, ahi, prev_b, bhi))
+        elif (ahi - alo) * (bhi - blo) <= FALLBACK_MAX_PAIRS:
+            matcher = difflib.SequenceMatcher(None, ha[alo:ahi], hb[blo:bhi], autojunk=False)
+            for i, j, size in matcher.get_matching_blocks():
+                if size:
+                    blocks.append((alo + i, blo + j, size))
+
+    blocks.sort()
+    opcodes = []
+    i = j = 0
+    for bi, bj, size in blocks + [(len(ha), len(hb), 0)]:
+        if i < bi and j < bj:
+            opcodes.append(('replace', i, bi, j, bj))
+        elif i < bi:
+            opcodes.append(('delete', i, bi, j, bj))
+        elif j < bj:
+            opcodes.append(('insert', i, bi, j, bj))
+        if size:
+            if opcodes and opcodes[-1][0] == 'equal':
+                opcodes[-1] = ('equal', opcodes[-1][1], bi + size, opcodes[-1][3], bj + size)
+            else:
+                opcodes.append(('equal', bi, bi + size, bj, bj + size))
+        i, j = bi + size, bj + size
+    return opcodes
+
+
+def _unique_anchors(ha, hb, alo, ahi, blo, bhi):
+    """
+    Lines occurring exactly once in both ranges, reduced to the longest
+    run that is increasing in both files (patience sorting).
+    """
+    count_a = Counter(ha[alo:ahi])
+    count_b = Counter(hb[blo:bhi])
+    pos_b = {}
+    for j in range(blo, bhi):
+        h = hb[j]
+        if count_b[h] == 1 and count_a.get(h) == 1:
+            pos_b[h] = j
+    if not pos_b:
+        return []
+
+    # Longest increasing subsequence of b positions in a order
+    tails = []      # smallest b position ending an increasing run of each length
+    tail_items = []
+    back = {}
+    for i in range(alo, ahi):
+        j = pos_b.get(ha[i])
+        if j is None:
+            continue
+        k = bisect_left(tails, j)
+        back[i, j] = tail_items[k - 1] if k else None
+        if k == len(tails):
+            tails.append(j)
+            tail_items.append((i, j))
+        else:
+            tails[k] = j
+            tail_items[k] = (i, j)
+
+    anchors = []
+    item = tail_items[-1]
+    while item is not None:
+        anchors.append(item)
+        item = back[item]
+    anchors.reverse()
+    return anchors
+
+
+def group_opcodes(opcodes, n=3):
+    """Hunks of opcodes with up to n lines of context, like SequenceMatcher.get_grouped_opcodes."""
+    if not opcodes:
+        return []
+    codes = list(opcodes)
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    groups = []
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # End the current hunk and start a new one on a long equal run
+        if tag == 'equal' and i2 - i1 > n * 2:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        groups.append(group)
+    return groups
+
+
+def _split_lines(text):
+    lines = text.split('\n')
+    return [line[:-1] if line.endswith('\r') else line for line in lines]
+
+
+def edit_groups(text, edits, numlines=5):
+    """
+    Diff hunks built straight from a converter edit log (see
+    LatexConverter.convert(return_edits=True)) instead of diffing the two
+    documents. Returns (fromlines, tolines, groups) for
+    FastHtmlDiff.render_groups; the line containers are dicts holding only
+    the lines the hunks show. Work is proportional to the number of edits,
+    apart from C-level newline counting between them. Lines are split on
+    '\n' with a trailing '\r' dropped, matching splitlines() for \n and
+    \r\n files.
+    """
+    fromlines = {}
+    tolines = {}
+    opcodes = []
+    n = len(text)
+    line = 0            # source line number at offset pos
+    pos = 0
+    delta = 0           # converted line number minus source line number
+    after_line = 0      # first source line after the previous hunk
+    after_offset = 0    # its offset
+
+    def forward(i, offset, stop):
+        # Source lines i.. from offset, up to line stop or the end of text
+        while i < stop and offset < n:
+            end = text.find('\n', offset)
+            if end == -1:
+                end = n
+            fromlines[i] = _split_lines(text[offset:end])[0]
+            i += 1
+            offset = end + 1
+        return i
+
+    k = 0
+    while k < len(edits):
+        # Edits sharing a line form one changed segment of whole lines
+        seg_start = text.rfind('\n', 0, edits[k].start) + 1
+        last = k
+        while True:
+            seg_end = text.find('\n', edits[last].end)
+            if seg_end == -1:
+                seg_end = n
+            if last + 1 < len(edits) and edits[last + 1].start <= seg_end:
+                last += 1
+            else:
+                break
+
+        parts = []
+        cursor = seg_start
+        for edit in edits[k:last + 1]:
+            parts.append(text[cursor:edit.start])
+            parts.append(edit.replacement)
+            cursor = edit.end
+        parts.append(text[cursor:seg_end])
+        k = last + 1
+
+        segment = text[seg_start:seg_end]
+        converted = ''.join(parts)
+        if converted == segment:
+            continue
+
+        line += text.count('\n', pos, seg_start)
+        pos = seg_start
+
+        # Context: numlines after the previous hunk and before this one
+        forward(after_line, after_offset, min(line, after_line + numlines))
+        offset = seg_start
+        for i in range(line - 1, max(after_line, line - numlines) - 1, -1):
+            start = text.rfind('\n', 0, offset - 1) + 1
+            fromlines[i] = _split_lines(text[start:offset - 1])[0]
+            offset = start
+        opcodes.append(('equal', after_line, line, after_line + delta, line + delta))
+
+        old = _split_lines(segment)
+        new = _split_lines(converted)
+        for i, text_line in enumerate(old):
+            fromlines[line + i] = text_line
+        for j, text_line in enumerate(new):
+            tolines[line + delta + j] = text_line
+        # Multi-line edits can leave some lines of the segment unchanged
+        for tag, i1, i2, j1, j2 in diff_opcodes(old, new):
+            opcodes.append((tag, line + i1, line + i2, line + delta + j1, line + delta + j2))
+
+        delta += len(new) - len(old)
+        line += len(old)
+        pos = after_offset = seg_end + 1
+        after_line = line
+
+    if not opcodes:
+        return fromlines, tolines, []
+    end_line = forward(after_line, after_offset, after_line + numlines)
+    opcodes.append(('equal', after_line, end_line, after_line + delta, end_line + delta))
+    merged = []
+    for op in opcodes:
+        if op[0] == 'equal':
+            if op[1] == op[2]:
+                continue
+            if merged and merged[-1][0] == 'equal':
+                merged[-1] = ('equal', merged[-1][1], op[2], merged[-1][3], op[4])
+                continue
+        merged.append(op)
+    return fromlines, tolines, group_opcodes(merged, numlines)
+
+
+def _escape(text):
+    return text.replace("&", "&amp;").replace(">", "&gt;").replace("<", "&lt;").replace(' ', '&nbsp;')
+
+
+def _mark(text, css):
+    return f'<span class="{css}">{_escape(text)}</span>' if text else ''
+
+
+def common_prefix_length(a, b):
+    """Length of the common prefix of two strings (bisection on C-level slice compares)."""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def intraline_cached(old, new):
+    """
+    intraline() through a per-process memo. A resubmitted document shows
+    mostly the same changed line pairs, so their highlighted cells are
+    reused and only rows the edit touched are diffed again.
+    """
+    key = (old, new)
+    result = _intraline_memo.get(key)
+    if result is None:
+        result = intraline(old, new)
+        _intraline_memo.put(key, result)
+    return result
+
+
+def intraline(old, new):
+    """Returns (old_html, new_html) with changed words highlighted."""
+    # Converter edits are local, so split off the common head and tail
+    # (widened to word boundaries) and only diff the words in between.
+    head = common_prefix_length(old, new)
+    while head and _WORD_CHAR.match(old, head - 1):
+        head -= 1
+    limit = min(len(old), len(new)) - head
+    tail = common_prefix_length(old[::-1][:limit], new[::-1][:limit])
+    while tail and _WORD_CHAR.match(old, len(old) - tail):
+        tail -= 1
+    old_mid = _WORD_PATTERN.findall(old, head, len(old) - tail)
+    new_mid = _WORD_PATTERN.findall(new, head, len(new) - tail)
+    prefix = _escape(old[:head])
+    suffix = _escape(old[len(old) - tail:])
+
+    if len(old_mid) * len(new_mid) > INTRALINE_MAX_PAIRS:
+        return (prefix + _mark(''.join(old_mid), 'diff_chg') + suffix,
+                prefix + _mark(''.join(new_mid), 'diff_chg') + suffix)
+
+    old_html = [prefix]
+    new_html = [prefix]
+    matcher = difflib.SequenceMatcher(None, old_mid, new_mid, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        old_part = ''.join(old_mid[i1:i2])
+        new_part = ''.join(new_mid[j1:j2])
+        if tag == 'equal':
+            old_html.append(_escape(old_part))
+            new_html.append(_escape(new_part))
+        elif tag == 'delete':
+            old_html.append(_mark(old_part, 'diff_sub'))
+        elif tag == 'insert':
+            new_html.append(_mark(new_part, 'diff_add'))
+        else:
+            old_html.append(_mark(old_part, 'diff_chg'))
+            new_html.append(_mark(new_part, 'diff_chg'))
+    old_html.append(suffix)
+    new_html.append(suffix)
+    return ''.join(old_html), ''.join(new_html)
+
+
+class FastHtmlDiff(difflib.HtmlDiff):
+    """
+    Drop-in replacement for difflib.HtmlDiff: same table markup and CSS
+    classes (make_file is inherited), built from diff_opcodes() and
+    word-level intraline highlighting.
+    """
+
+    def make_table(self, fromlines, tolines, fromdesc='', todesc='', context=False, numlines=5):
+        opcodes = diff_opcodes(fromlines, tolines)
+        if context:
+            groups = group_opcodes(opcodes, numlines)
+        elif fromlines or tolines:
+            groups = [opcodes]
+        else:
+            groups = []
+        return self.render_groups(fromlines, tolines, groups, fromdesc, todesc, context)
+
+    def make_table_from_edits(self, text, edits, fromdesc='', todesc='', numlines=5):
+        """Context table for text and its converter edit log, without a full diff."""
+        fromlines, tolines, groups = edit_groups(text, edits, numlines)
+        return self.render_groups(fromlines, tolines, groups, fromdesc, todesc, context=True)
+
+    def make_file_from_edits(self, text, edits, fromdesc='', todesc='', numlines=5, charset='utf-8'):
+        """Like make_file(context=True), built with make_table_from_edits()."""
+        table = self.make_table_from_edits(text, edits, fromdesc, todesc, numlines)
+        return self._file(table, charset)
+
+    def make_file_from_groups(self, fromlines, tolines, groups, fromdesc='', todesc='', charset='utf-8'):
+        """Like make_file(context=True) for hunks computed elsewhere (see StreamingDiff)."""
+        table = self.render_groups(fromlines, tolines, groups, fromdesc, todesc, context=True)
+        return self._file(table, charset)
+
+    def _file(self, table, charset):
+        return (self._file_template % dict(
+            styles=self._styles,
+            legend=self._legend,
+            table=table,
+            charset=charset
+        )).encode(charset, 'xmlcharrefreplace').decode(charset)
+
+    def render_groups(self, fromlines, tolines, groups, fromdesc='', todesc='', context=True):
+        """
+        Renders hunks of opcodes into the HtmlDiff table. fromlines and
+        tolines only need to support indexing for the line numbers that the
+        groups refer to, so callers may pass dicts of just those lines.
+        """
+        self._make_prefix()
+        hunks = [self.hunk_rows(fromlines, tolines, group) for group in groups]
+        if not hunks:
+            data_rows = self.empty_row(context)
+        else:
+            data_rows = ''.join(self.hunk_html(rows, number, number + 1 == len(hunks))
+                                for number, rows in enumerate(hunks))
+        return self.table(data_rows, fromdesc, todesc)
+
+    def hunk_rows(self, fromlines, tolines, group):
+        """(from cells, to cells) for every row of one hunk."""
+        from_prefix, to_prefix = self._prefix
+        tabsize = self._tabsize
+
+        def cells(prefix, linenum, html):
+            if linenum is None:
+                return '<td class="diff_header"></td><td nowrap="nowrap"></td>'
+            return (f'<td class="diff_header" id="{prefix}{linenum}">{linenum}</td>'
+                    f'<td nowrap="nowrap">{html.rstrip()}</td>')
+
+        rows = []
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for i, j in zip(range(i1, i2), range(j1, j2)):
+                    line = _escape(fromlines[i].expandtabs(tabsize))
+                    rows.append((cells(from_prefix, i + 1, line), cells(to_prefix, j + 1, line)))
+                continue
+            for k in range(max(i2 - i1, j2 - j1)):
+                i, j = i1 + k, j1 + k
+                old = fromlines[i].expandtabs(tabsize) if i < i2 else None
+                new = tolines[j].expandtabs(tabsize) if j < j2 else None
+                if old is not None and new is not None:
+                    old_html, new_html = intraline_cached(old, new)
+                else:
+                    old_html = _mark(old, 'diff_sub') if old else ''
+                    new_html = _mark(new, 'diff_add') if new else ''
+                rows.append((cells(from_prefix, i + 1 if old is not None else None, old_html),
+                             cells(to_prefix, j + 1 if new is not None else None, new_html)))
+        return rows
+
+    _ROW = ('            <tr><td class="diff_next"%s>%s</td>%s'
+            '<td class="diff_next">%s</td>%s</tr>\n')
+
+    def hunk_html(self, rows, number, last, separator=True):
+        """
+        Table rows for hunk number (from 0); the last hunk links back to the
+        top. separator=False leaves out the </tbody><tbody> in front of
+        every hunk but the first, for callers that wrap each hunk themselves.
+        """
+        s = []
+        for row, (from_cells, to_cells) in enumerate(rows):
+            if row == 0:
+                s.append(self.first_row_html(from_cells, to_cells, number, last, separator))
+            else:
+                s.append(self._ROW % ('', '', from_cells, '', to_cells))
+        return ''.join(s)
+
+    def first_row_html(self, from_cells, to_cells, number, last, separator=True):
+        to_prefix = self._prefix[1]
+        if not last:
+            link = f'<a href="#difflib_chg_{to_prefix}_{number + 1}">n</a>'
+        else:
+            link = f'<a href="#difflib_chg_{to_prefix}_top">t</a>'
+        separator = '        </tbody>        \n        <tbody>\n' if number and separator else ''
+        return separator + self._ROW % (f' id="difflib_chg_{to_prefix}_{number}"', link, from_cells, link, to_cells)
+
+    def empty_row(self, context=True):
+        message = 'No Differences Found' if context else 'Empty File'
+        cell = f'<td></td><td>&nbsp;{message}&nbsp;</td>'
+        top = f'<a href="#difflib_chg_{self._prefix[1]}_top">t</a>'
+        return self._ROW % ('', top, cell, top, cell)
+
+    def table(self, data_rows, fromdesc='', todesc=''):
+        if fromdesc or todesc:
+            header_row = '<thead><tr>%s%s%s%s</tr></thead>' % (
+                '<th class="diff_next"><br /></th>',
+                '<th colspan="2" class="diff_header">%s</th>' % fromdesc,
+                '<th class="diff_next"><br /></th>',
+                '<th colspan="2" class="diff_header">%s</th>' % todesc)
+        else:
+            header_row = ''
+
+        return self._table_template % dict(
+            data_rows=data_rows,
+            header_row=header_row,
+            prefix=self._prefix[1])
+
+    def file_parts(self, fromdesc='', todesc='', charset='utf-8'):
+        """
+        make_file() output before and after the table rows, for writing a
+        diff page piece by piece (see StreamingDiff). Uses the current
+        prefix, so call _make_prefix() first.
+        """
+        head, tail = self._file(self.table('\0', fromdesc, todesc), charset).split('\0')
+        return head, tail
+
+
+class _LineBuffer:
+    # One side of a StreamingDiff: the complete lines not yet diffed, split
+    # as _split_lines() does, and the pieces of the unfinished line after them
+    def __init__(self):
+        self.lines = []
+        self.tail = []
+        self.tail_len = 0
+
+    def add(self, piece):
+        parts = piece.split('\n')
+        if len(parts) > 1:
+            self.tail.append(parts[0])
+            parts[0] = ''.join(self.tail)
+            last = parts.pop()
+            self.lines.extend(line[:-1] if line.endswith('\r') else line for line in parts)
+            self.tail = [last]
+            self.tail_len = len(last)
+        else:
+            self.tail.append(piece)
+            self.tail_len += len(piece)
+
+    def tail_equals(self, other):
+        return self.tail_len == other.tail_len and ''.join(self.tail) == ''.join(other.tail)
+
+    def take_lines(self):
+        lines = self.lines
+        self.lines = []
+        return lines
+
+    def take_all(self):
+        lines = self.take_lines()
+        tail = ''.join(self.tail)
+        if tail:
+            lines.append(tail[:-1] if tail.endswith('\r') else tail)
+        self.tail = []
+        self.tail_len = 0
+        return lines
+
+
+class StreamingDiff:
+    """
+    Context diff of a document that is only seen in pieces, such as the
+    (source, converted) pairs of LatexConverter.convert_stream(with_source=True),
+    written as table rows to the text file out as it goes. Pieces are
+    collected until both sides share their last line break, then that
+    segment is diffed on its own (diff_opcodes), rendered, and all lines
+    no later row can show are dropped. The rows of the open hunk wait in a
+    spooled temporary file, as the first row's link depends on whether
+    another hunk follows, so memory stays bounded by the current segment
+    however large the document or its hunks. The page around the rows is
+    html.file_parts().
+    """
+    def __init__(self, out, numlines=5, html=None, spool_bytes=1 << 20):
+        self.out = out
+        self.numlines = numlines
+        self.html = html or FastHtmlDiff()
+        self.html._make_prefix()
+        self.fromlines = {}
+        self.tolines = {}
+        self.opcodes = []       # the last opcode, which the next segment may extend
+        self.hunks = 0          # hunks opened so far
+        self._in_hunk = False
+        self._first_row = None  # (from cells, to cells) of the newest hunk
+        self._rows = tempfile.SpooledTemporaryFile(spool_bytes, "w+", encoding="utf-8")
+        self._old = _LineBuffer()
+        self._new = _LineBuffer()
+        self._old_count = 0     # lines of old diffed so far
+        self._new_count = 0
+        self._old_needed = 0    # context owed after the last change
+        self._new_needed = 0
+        self._old_tail = {}     # last numlines lines diffed, by line number
+        self._new_tail = {}
+
+    def feed(self, old, new):
+        self._old.add(old)
+        self._new.add(new)
+        # Cut at the last line break of old when the text after it is the
+        # same on both sides, as when it was copied through unconverted
+        if not (self._old.lines and self._new.lines and self._old.tail_equals(self._new)):
+            return
+        self._diff_segment(self._old.take_lines(), self._new.take_lines())
+        # Every opcode but the last is final
+        for op in self.opcodes[:-1]:
+            self._render(op, False)
+        del self.opcodes[:-1]
+        tag, i1, i2, j1, j2 = self.opcodes[-1]
+        self.fromlines = {i: line for i, line in self.fromlines.items() if i >= i1}
+        self.tolines = {j: line for j, line in self.tolines.items() if j >= j1}
+
+    def finish(self):
+        # Like splitlines(), a final line break does not start another line
+        self._diff_segment(self._old.take_all(), self._new.take_all())
+        for k, op in enumerate(self.opcodes):
+            self._render(op, k + 1 == len(self.opcodes))
+        self.opcodes = []
+        if self._first_row is not None:
+            self._write_hunk(last=True)
+        elif not self.hunks:
+            self.out.write(self.html.empty_row())
+        self._rows.close()
+
+    def _render(self, op, at_end):
+        # Cuts the opcodes into hunks exactly as group_opcodes() does
+        n = self.numlines
+        tag, i1, i2, j1, j2 = op
+        if tag != 'equal':
+            if not self._in_hunk:
+                self._open()
+            self._add_rows(op)
+        elif self._in_hunk:
+            if at_end or i2 - i1 > n * 2:
+                self._add_rows((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+                self._in_hunk = False
+                if not at_end:
+                    self._open()
+                    self._add_rows((tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2))
+            else:
+                self._add_rows(op)
+        elif not at_end:
+            # Unchanged start of the document
+            self._open()
+            self._add_rows((tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2))
+
+    def _open(self):
+        # A new hunk settles the previous one's link
+        if self._first_row is not None:
+            self._write_hunk(last=False)
+        self._in_hunk = True
+        self.hunks += 1
+
+    def _add_rows(self, op):
+        for from_cells, to_cells in self.html.hunk_rows(self.fromlines, self.tolines, [op]):
+            if self._first_row is None:
+                self._first_row = (from_cells, to_cells)
+            else:
+                self._rows.write(self.html._ROW % ('', '', from_cells, '', to_cells))
+
+    def _write_hunk(self, last):
+        self.out.write(self.html.first_row_html(*self._first_row, self.hunks - 1, last))
+        self._first_row = None
+        self._rows.seek(0)
+        shutil.copyfileobj(self._rows, self.out)
+        self._rows.seek(0)
+        self._rows.truncate()
+
+    def _diff_segment(self, old, new):
+        n = self.numlines
+        a0, b0 = self._old_count, self._new_count
+        a_end, b_end = a0 + len(old), b0 + len(new)
+        fromlines, tolines = self.fromlines, self.tolines
+        # Context lines a change in an earlier segment asked for
+        for i in range(a0, min(self._old_needed, a_end)):
+            fromlines[i] = old[i - a0]
+        for j in range(b0, min(self._new_needed, b_end)):
+            tolines[j] = new[j - b0]
+
+        opcodes = self.opcodes
+        for tag, i1, i2, j1, j2 in diff_opcodes(old, new):
+            i1, i2, j1, j2 = i1 + a0, i2 + a0, j1 + b0, j2 + b0
+            # Runs split by a segment boundary are joined back up
+            last = opcodes[-1] if opcodes else None
+            if last and (last[0] == 'equal') == (tag == 'equal'):
+                merged = tag if last[0] == tag else 'replace'
+                opcodes[-1] = (merged, last[1], i2, last[3], j2)
+            else:
+                opcodes.append((tag, i1, i2, j1, j2))
+            if tag == 'equal':
+                continue
+            # The change and numlines around it; lines before this segment
+            # were kept as its tail below
+            for i in range(max(a0, i1 - n), min(a_end, i2 + n)):
+                fromlines[i] = old[i - a0]
+            for j in range(max(b0, j1 - n), min(b_end, j2 + n)):
+                tolines[j] = new[j - b0]
+            for i in range(max(0, i1 - n), a0):
+                fromlines[i] = self._old_tail[i]
+            for j in range(max(0, j1 - n), b0):
+                tolines[j] = self._new_tail[j]
+            self._old_needed = max(self._old_needed, i2 + n)
+            self._new_needed = max(self._new_needed, j2 + n)
+
+        # The last numlines lines, as leading context for the next segment
+        self._old_tail = _tail(self._old_tail, old, a0, n)
+        self._new_tail = _tail(self._new_tail, new, b0, n)
+        self._old_count, self._new_count = a_end, b_end
+
+
+def _tail(previous, lines, first, n):
+    # {line number: line} for the last n lines up to first + len(lines)
+    tail = {i: line for i, line in previous.items() if i >= first + len(lines) - n}
+    for i in range(max(0, len(lines) - n), len(lines)):
+        tail[first + i] = lines[i]
+    return tail
+
+
+# Engines selectable by name (LATEX_DIFF_ENGINE in pipeline.py)
+DIFF_ENGINES = {
+    'difflib': difflib.HtmlDiff,
+    'fast': FastHtmlDiff,
+}
+
+
+def make_html_diff(engine='fast'):
+    """Returns an HtmlDiff-compatible object for the named engine."""
+    try:
+        return DIFF_ENGINES[engine]()
+    except KeyError:
+        raise ValueError(f"Unknown diff engine {engine!r}, expected one of {sorted(DIFF_ENGINES)}")
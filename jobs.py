@@ -0,0 +1,174 @@
+"""
+Background jobs for large uploads. POST returns a job id at once; a fixed
+number of worker tasks take jobs from a bounded queue, and finished
+results are kept until their TTL runs out. Free of FastAPI imports; the
+web layer supplies the coroutine that does the work.
+"""
+import asyncio
+import os
+import time
+import uuid
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    """
+    One queued upload, spooled to the file source_path, which the job
+    owns. status goes queued -> running -> done or failed; stage and
+    progress (a fraction from 0 to 1) are whatever the run coroutine
+    reports with advance(), which may be only a few coarse steps. The
+    file is removed once the job has run, so only the result stays until
+    the job expires.
+    """
+    def __init__(self, filename, source_path, key=None):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.source_path = source_path
+        self.key = key
+        self.status = "queued"
+        self.stage = "queued"
+        self.progress = 0.0
+        self.error = None
+        self.archive = None
+        self.report = None
+        self.created = time.time()
+        self.finished = None
+
+    def remove_source(self):
+        if self.source_path is not None:
+            try:
+                os.unlink(self.source_path)
+            except OSError:
+                pass
+            self.source_path = None
+
+    def advance(self, stage, progress):
+        self.stage = stage
+        self.progress = progress
+
+    def to_dict(self, ttl):
+        data = {
+            "id": self.id,
+            "file": self.filename,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": round(self.progress, 3),
+            "created": self.created,
+        }
+        if self.finished is not None:
+            data["finished"] = self.finished
+            data["expires"] = self.finished + ttl
+        if self.error:
+            data["error"] = self.error
+        if self.archive is not None:
+            data["archive_bytes"] = len(self.archive)
+        return data
+
+
+class JobQueue:
+    """
+    Runs `await run(job)` for submitted jobs on `workers` tasks. At most
+    max_queued jobs wait at a time; submit() raises QueueFull past that so
+    the caller can answer 429 instead of letting a burst pile up. Jobs
+    that finished more than ttl seconds ago are forgotten, result and all.
+    """
+    def __init__(self, run, max_queued=16, workers=1, ttl=3600):
+        self.run = run
+        self.max_queued = max_queued
+        self.workers = workers
+        self.ttl = ttl
+        self.jobs = {}
+        self.expired = 0
+        self._queue = None
+        self._tasks = []
+
+    def start(self):
+        """Starts the worker and expiry tasks; call from inside the running event loop."""
+        self._queue = asyncio.Queue(self.max_queued)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._expire_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Jobs that never ran still hold their spooled uploads
+        for job in self.jobs.values():
+            job.remove_source()
+
+    def submit(self, job):
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFull()
+        self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is not None and self._is_expired(job, time.time()):
+            self._forget(job)
+            return None
+        return job
+
+    def queued(self):
+        return self._queue.qsize() if self._queue else 0
+
+    def stats(self):
+        statuses = {}
+        for job in self.jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {
+            "queued": self.queued(),
+            "max_queued": self.max_queued,
+            "workers": self.workers,
+            "ttl_seconds": self.ttl,
+            "jobs": statuses,
+            "expired": self.expired,
+            "archive_bytes": sum(len(job.archive) for job in self.jobs.values() if job.archive),
+        }
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            try:
+                await self.run(job)
+                job.status = "done"
+                job.advance("done", 1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.status = "failed"
+                job.error = f"{type(e).__name__}: {e}"
+            finally:
+                job.remove_source()
+                job.finished = time.time()
+                self._queue.task_done()
+
+    def _is_expired(self, job, now):
+        return job.finished is not None and now - job.finished > self.ttl
+
+    def _forget(self, job):
+        if self.jobs.pop(job.id, None) is not None:
+            job.archive = None
+            self.expired += 1
+
+    def expire(self):
+        """Drops every job whose TTL has run out; returns how many."""
+        now = time.time()
+        stale = [job for job in self.jobs.values() if self._is_expired(job, now)]
+        for job in stale:
+            self._forget(job)
+        return len(stale)
+
+    async def _expire_loop(self):
+        # get() also checks, so a sweep only has to bound memory, not be exact
+        interval = min(max(self.ttl / 4, 1), 60)
+        while True:
+            await asyncio.sleep(interval)
+            self.expire()
@@ -1,11 +1,19 @@
 from fastapi import FastAPI, Form, Request, UploadFile, File
-from fastapi.responses import HTMLResponse, Response
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-import difflib
-import zipfile
-import io
+from starlette.concurrency import iterate_in_threadpool
+from concurrent.futures import ProcessPoolExecutor
+import aiofiles
+import asyncio
+import functools
+import hashlib
+import json
 import os
+import re
+import tempfile
+import time
+from typing import List
 
 import sys
 import os
@@ -17,7 +25,16 @@ if __name__ == "__main__":
     else:
         sys.path.append(os.path.abspath('..'))
 
-from app.converter import LatexConverter
+from app import pipeline
+from app.cache import LRUCache, ResultCache
+from app.jobs import Job, JobQueue, QueueFull
+
+# Conversion, diffing and zipping are CPU-bound and run in a process pool so
+# one large upload does not block every other request on this worker.
+# LATEX_POOL_WORKERS: number of worker processes (default: CPU count)
+# LATEX_POOL_MAX_QUEUE: requests allowed in flight before answering 503
+POOL_WORKERS = int(os.environ.get("LATEX_POOL_WORKERS", os.cpu_count() or 1))
+POOL_MAX_QUEUE = int(os.environ.get("LATEX_POOL_MAX_QUEUE", 32))
 
 app = FastAPI()
 
@@ -25,7 +42,122 @@ app = FastAPI()
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
 templates = Jinja2Templates(directory="app/templates")
-converter = LatexConverter()
+
+pool = None
+pending_jobs = 0
+
+# Finished /convert and /upload results, keyed by pipeline.result_key().
+# LATEX_RESULT_CACHE_MAX_BYTES: memory tier budget (default 256 MB)
+# LATEX_RESULT_CACHE_DIR: folder for the disk tier (default: memory only)
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("LATEX_RESULT_CACHE_MAX_BYTES", 256 << 20))
+RESULT_CACHE_DIR = os.environ.get("LATEX_RESULT_CACHE_DIR") or None
+
+# /upload reads the file in pipeline.UPLOAD_CHUNK_BYTES pieces.
+# LATEX_UPLOAD_MAX_BYTES: larger uploads are refused with 413 (default 64 MB)
+# LATEX_UPLOAD_CACHE_MAX_BYTES: larger archives skip the result cache
+UPLOAD_MAX_BYTES = int(os.environ.get("LATEX_UPLOAD_MAX_BYTES", 64 << 20))
+UPLOAD_CACHE_MAX_BYTES = int(os.environ.get("LATEX_UPLOAD_CACHE_MAX_BYTES", 16 << 20))
+results = ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_DIR, pipeline.CACHE_VERSION)
+
+# /convert renders the first DIFF_PAGE_HUNKS hunks of the diff with the
+# page; the rest are fetched from /convert/diff/{id} while scrolling.
+# LATEX_DIFF_PAGE_HUNKS: hunks per page (default 20)
+# LATEX_DIFF_PAGE_MAX_HUNKS: most hunks one request may ask for
+# LATEX_DIFF_MEMO_SIZE: parsed diffs kept for paging (default 64)
+DIFF_PAGE_HUNKS = int(os.environ.get("LATEX_DIFF_PAGE_HUNKS", 20))
+DIFF_PAGE_MAX_HUNKS = int(os.environ.get("LATEX_DIFF_PAGE_MAX_HUNKS", 100))
+diff_memo = LRUCache(int(os.environ.get("LATEX_DIFF_MEMO_SIZE", 64)))
+DIFF_ID_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+# Converter counters summed over every conversion this server ran (cache
+# hits are not counted again); served by /metrics
+_COUNTER_FIELDS = ("found", "converted", "handler_calls", "handler_seconds")
+metrics = {"documents": {}, "characters": 0, "commands": {}}
+
+
+# Background jobs for large uploads (POST /jobs): a bounded queue worked
+# by a few tasks that hand the CPU-bound part to the pool.
+# LATEX_JOB_QUEUE_MAX: jobs allowed to wait before answering 429
+# LATEX_JOB_WORKERS: jobs converted at once (default: pool size)
+# LATEX_JOB_TTL_SECONDS: how long a finished result can be fetched
+JOB_QUEUE_MAX = int(os.environ.get("LATEX_JOB_QUEUE_MAX", 16))
+JOB_WORKERS = int(os.environ.get("LATEX_JOB_WORKERS", POOL_WORKERS))
+JOB_TTL_SECONDS = float(os.environ.get("LATEX_JOB_TTL_SECONDS", 3600))
+
+
+class PoolBusy(Exception):
+    pass
+
+
+@app.on_event("startup")
+def start_pool():
+    global pool
+    pool = ProcessPoolExecutor(max_workers=POOL_WORKERS, initializer=pipeline.init_worker)
+    # The executor only spawns a worker when work arrives, so without this the
+    # first requests would wait for process start, imports and init_worker.
+    # One no-op per worker spawns them all now; the futures are not awaited,
+    # so startup is not delayed.
+    for _ in range(POOL_WORKERS):
+        pool.submit(pipeline.worker_ready)
+
+
+@app.on_event("startup")
+async def start_jobs():
+    jobs.start()
+
+
+@app.on_event("shutdown")
+async def stop_jobs():
+    await jobs.stop()
+
+
+@app.on_event("shutdown")
+def stop_pool():
+    pool.shutdown(cancel_futures=True)
+
+
+async def run_in_pool(func, *args):
+    """Runs func(*args) in the process pool, refusing work past POOL_MAX_QUEUE."""
+    global pending_jobs
+    if pending_jobs >= POOL_MAX_QUEUE:
+        raise PoolBusy()
+    pending_jobs += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pool, functools.partial(func, *args))
+    finally:
+        pending_jobs -= 1
+
+
+async def run_batch_in_pool(func, jobs):
+    """
+    Runs func(*args) for every args tuple in jobs across the pool and returns
+    the results in order. A batch takes one POOL_MAX_QUEUE slot, however
+    many files it holds.
+    """
+    global pending_jobs
+    if pending_jobs >= POOL_MAX_QUEUE:
+        raise PoolBusy()
+    pending_jobs += 1
+    try:
+        loop = asyncio.get_running_loop()
+        futures = [loop.run_in_executor(pool, functools.partial(func, *args)) for args in jobs]
+        return await asyncio.gather(*futures)
+    finally:
+        pending_jobs -= 1
+
+
+def too_large_response():
+    return Response(f"Error: File is larger than {UPLOAD_MAX_BYTES} bytes.", status_code=413)
+
+
+def queue_full_response():
+    return Response("Too many queued jobs, please retry shortly.", status_code=429, headers={"Retry-After": "10"})
+
+
+def busy_response():
+    return Response("Server busy, please retry shortly.", status_code=503, headers={"Retry-After": "5"})
+
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
@@ -33,87 +165,358 @@ async def read_root(request: Request):
 
 @app.post("/convert", response_class=HTMLResponse)
 async def convert_code(request: Request, code: str = Form(...)):
-    converted_code = converter.convert(code)
-    
-    # Generate HTML diff
-    diff_generator = difflib.HtmlDiff()
-    # splitlines(keepends=True) needed? HtmlDiff expects lists of strings
-    original_lines = code.splitlines()
-    converted_lines = converted_code.splitlines()
-    
-    diff_html = diff_generator.make_table(
-        original_lines, 
-        converted_lines, 
-        context=True, 
-        numlines=5
-    )
-    
+    cache_key = pipeline.result_key("convert-hunks", code.encode("utf-8"))
+    cached = results.get(cache_key)
+    if cached is not None:
+        converted_code, diff = json.loads(cached)
+        diff = pipeline.load_diff_hunks(diff)
+    else:
+        try:
+            converted_code, diff, commands = await run_in_pool(pipeline.convert_code, code)
+        except PoolBusy:
+            return busy_response()
+        record_metrics("/convert", len(code), commands)
+        results.put(cache_key, json.dumps([converted_code, diff]).encode("utf-8"))
+    diff_memo.put(cache_key, diff)
+
+    first_page = pipeline.diff_page(diff, 0, DIFF_PAGE_HUNKS)
     return templates.TemplateResponse("index.html", {
         "request": request, 
         "original_code": code,
         "converted_code": converted_code,
-        "diff_html": diff_html
+        "diff_id": cache_key,
+        "diff_hunks": first_page["hunks"],
+        "diff_total": first_page["total"],
+        "diff_page_hunks": DIFF_PAGE_HUNKS,
+        "diff_prefix": pipeline.DIFF_PAGE_PREFIX[1],
     })
 
+@app.get("/convert/diff/{diff_id}")
+async def convert_diff_page(diff_id: str, start: int = 0, count: int = DIFF_PAGE_HUNKS):
+    """
+    Hunks start .. start + count of a /convert diff as JSON: {total, start,
+    hunks}, each hunk the <tr> rows of one <tbody>.
+    """
+    expired = Response("Diff expired, please convert again.", status_code=404)
+    # The id is a result cache key, which also names a file on disk
+    if not DIFF_ID_PATTERN.fullmatch(diff_id):
+        return expired
+    diff = diff_memo.get(diff_id)
+    if diff is None:
+        # Dropped from the memo (or another worker served /convert); the
+        # result cache may still hold it
+        cached = results.get(diff_id)
+        if cached is None:
+            return expired
+        try:
+            diff = pipeline.load_diff_hunks(json.loads(cached)[1])
+        except (ValueError, LookupError, TypeError, AttributeError):
+            return expired  # the key of some other kind of result
+        diff_memo.put(diff_id, diff)
+    start = max(start, 0)
+    count = min(max(count, 1), DIFF_PAGE_MAX_HUNKS)
+    return pipeline.diff_page(diff, start, count)
+
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
-    # Read file content
-    content_bytes = await file.read()
+    # Larger than allowed: refuse before reading anything
+    if (getattr(file, "size", None) or 0) > UPLOAD_MAX_BYTES:
+        return too_large_response()
+
+    # Spool the upload to a temporary file chunk by chunk, hashing as it
+    # goes; the pool worker then decodes and converts it chunk by chunk too
+    source_fd, source_path = tempfile.mkstemp(suffix=".tex")
+    os.close(source_fd)
+    archive_path = source_path + ".zip"
+    converted = False
     try:
-        content_str = content_bytes.decode('utf-8')
-    except UnicodeDecodeError:
-        return Response("Error: File must be UTF-8 encoded.", status_code=400)
-    
-    # Convert
+        digest = await spool_upload(file, source_path)
+        if digest is None:
+            return too_large_response()
+
+        # Also save to local Downloads folder as requested
+        name_root = pipeline.package_name_root(file.filename)
+        downloads_path = os.path.join(os.path.expanduser("~"), "Downloads")
+        save_path = os.path.join(downloads_path, f"{name_root}_converted_package.zip")
+        headers = {"Content-Disposition": f"attachment; filename=converted_files.zip"}
+
+        # Same bytes, same name and same code as before: serve the finished ZIP
+        cache_key = pipeline.result_key("upload", digest, file.filename or "")
+        cached = results.get(cache_key)
+        if cached is not None:
+            if not os.path.exists(save_path):
+                await save_copy(save_path, cached)
+            return Response(cached, media_type="application/zip", headers=headers)
+
+        # Convert, diff and zip in the pool, straight from and to disk
+        try:
+            report = await run_in_pool(pipeline.convert_upload, source_path, file.filename, archive_path)
+            converted = True
+        except PoolBusy:
+            return busy_response()
+        except pipeline.InvalidUtf8 as e:
+            return Response(f"Error: File must be UTF-8 encoded (invalid byte at offset {e.offset}).", status_code=400)
+        except Exception as e:
+            import traceback
+            with open("debug_error.log", "w") as f:
+                f.write(traceback.format_exc())
+            return Response(f"Internal Error: {str(e)}", status_code=500)
+    finally:
+        os.unlink(source_path)
+        if not converted and os.path.exists(archive_path):
+            os.unlink(archive_path)
+    record_metrics("/upload", report["characters"], {
+        row["command"][1:]: row for row in report["commands"]
+    })
+
+    # Small archives go into the result cache as they stream; large ones
+    # would cost their whole size in memory
+    if os.path.getsize(archive_path) > UPLOAD_CACHE_MAX_BYTES:
+        cache_key = None
+    return StreamingResponse(
+        stream_archive(pipeline.iter_file(archive_path), save_path, cache_key, remove_path=archive_path),
+        media_type="application/zip",
+        headers=headers
+    )
+
+
+@app.post("/batch")
+async def batch_upload(files: List[UploadFile] = File(...)):
+    # Accepts several .tex files and/or ZIPs of a project; every .tex file
+    # is converted in its own pool job and all results go into one archive.
+    started = time.perf_counter()
+    if any((getattr(file, "size", None) or 0) > UPLOAD_MAX_BYTES for file in files):
+        return too_large_response()
+
+    # Spooled like /upload; ZIPs are expanded from disk under the same limit
+    uploads = []
     try:
-        converted_str = converter.convert(content_str)
+        for file in files:
+            source_fd, source_path = tempfile.mkstemp(suffix=".upload")
+            os.close(source_fd)
+            uploads.append((file.filename, source_path, UPLOAD_MAX_BYTES))
+            if await spool_upload(file, source_path) is None:
+                return too_large_response()
+        expanded = await run_batch_in_pool(pipeline.expand_sources, uploads)
+        sources = [source for group in expanded for source in group]
+        if not sources:
+            return Response("Error: No .tex files found in upload.", status_code=400)
+        results = await run_batch_in_pool(pipeline.convert_batch_file, sources)
+    except PoolBusy:
+        return busy_response()
+    except pipeline.TooLarge as e:
+        return Response(f"Error: {e}.", status_code=413)
     except Exception as e:
         import traceback
         with open("debug_error.log", "w") as f:
             f.write(traceback.format_exc())
         return Response(f"Internal Error: {str(e)}", status_code=500)
-    
-    # Generate Diff
-    diff_generator = difflib.HtmlDiff()
-    diff_html = diff_generator.make_file(
-        content_str.splitlines(),
-        converted_str.splitlines(),
-        fromdesc='Original',
-        todesc='Converted',
-        context=True,
-        numlines=5
+    finally:
+        for _, source_path, _ in uploads:
+            os.unlink(source_path)
+
+    wall_seconds = time.perf_counter() - started
+    entries = [entry for file_entries, _ in results for entry in file_entries]
+    records = [record for _, record in results]
+    for record in records:
+        record_metrics("/batch", record["bytes"], record.get("commands", {}))
+    summary = pipeline.batch_summary(records, wall_seconds, POOL_WORKERS)
+    entries.append(("summary.json", summary, pipeline.ZIP_LEVEL_TEX))
+
+    return StreamingResponse(
+        stream_archive(pipeline.iter_zip(entries)),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": "attachment; filename=converted_batch.zip",
+            "X-Batch-Files": str(len(records)),
+            "X-Batch-Wall-Seconds": f"{wall_seconds:.3f}",
+        }
     )
-    
-    # Create ZIP in memory
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-        # Add converted tex
-        # Sanitize filename?
-        original_name = file.filename or "document.tex"
-        name_root, ext = os.path.splitext(original_name)
-        new_name = f"{name_root}_converted{ext}"
-        zip_file.writestr(new_name, converted_str)
-        
-        # Add diff html
-        zip_file.writestr("diff.html", diff_html)
-
-
-
-    # Also save to local Downloads folder as requested
+
+
+async def run_job(job):
+    """JobQueue worker step: the /upload pipeline for one job's spooled file, result kept as ZIP bytes."""
+    cached = results.get(job.key)
+    if cached is not None:
+        job.archive = cached
+        return
+
+    # Decoded, converted, diffed and zipped in one pool call, straight from
+    # and to disk; invalid UTF-8 fails the job with pipeline.InvalidUtf8.
+    # The worker process cannot report back, so progress is coarse: it
+    # stays at "converting" for the whole pool call
+    job.advance("converting", 0.05)
+    archive_path = job.source_path + ".zip"
     try:
-        downloads_path = os.path.join(os.path.expanduser("~"), "Downloads")
-        save_path = os.path.join(downloads_path, f"{name_root}_converted_package.zip")
-        with open(save_path, "wb") as f:
-            f.write(zip_buffer.getvalue())
+        # Job workers are bounded by JOB_WORKERS, so they use the pool directly
+        # rather than taking POOL_MAX_QUEUE slots from interactive requests
+        loop = asyncio.get_running_loop()
+        report = await loop.run_in_executor(
+            pool, functools.partial(pipeline.convert_upload, job.source_path, job.filename, archive_path))
+        job.advance("reading", 0.95)
+        async with aiofiles.open(archive_path, "rb") as f:
+            job.archive = await f.read()
+    finally:
+        if os.path.exists(archive_path):
+            os.unlink(archive_path)
+    record_metrics("/jobs", report["characters"], {row["command"][1:]: row for row in report["commands"]})
+    job.report = report
+    results.put(job.key, job.archive)
+
+
+jobs = JobQueue(run_job, JOB_QUEUE_MAX, JOB_WORKERS, JOB_TTL_SECONDS)
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(file: UploadFile = File(...)):
+    # Answers at once with a job id; poll GET /jobs/{id}, then fetch the
+    # archive from GET /jobs/{id}/result
+    if (getattr(file, "size", None) or 0) > UPLOAD_MAX_BYTES:
+        return too_large_response()
+    # A full queue is refused before the upload is read; submit() below
+    # still catches the race with another request taking the last place
+    if jobs.queued() >= jobs.max_queued:
+        return queue_full_response()
+
+    # Spooled to disk like /upload; the job owns the file once queued
+    source_fd, source_path = tempfile.mkstemp(suffix=".tex")
+    os.close(source_fd)
+    submitted = False
+    try:
+        digest = await spool_upload(file, source_path)
+        if digest is None:
+            return too_large_response()
+        key = pipeline.result_key("upload", digest, file.filename or "")
+        try:
+            job = jobs.submit(Job(file.filename, source_path, key))
+        except QueueFull:
+            return queue_full_response()
+        submitted = True
+    finally:
+        if not submitted:
+            os.unlink(source_path)
+    return {
+        **job.to_dict(jobs.ttl),
+        "status_url": f"/jobs/{job.id}",
+        "result_url": f"/jobs/{job.id}/result",
+    }
+
+
+@app.get("/jobs/stats")
+async def job_stats():
+    return jobs.stats()
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return Response("Unknown or expired job.", status_code=404)
+    return job.to_dict(jobs.ttl)
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return Response("Unknown or expired job.", status_code=404)
+    if job.status == "failed":
+        return Response(f"Conversion failed: {job.error}", status_code=500)
+    if job.status != "done":
+        return Response(f"Job is {job.status}.", status_code=409, headers={"Retry-After": "2"})
+    name_root = pipeline.package_name_root(job.filename)
+    return Response(job.archive, media_type="application/zip", headers={
+        "Content-Disposition": f"attachment; filename={name_root}_converted_package.zip",
+    })
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return metrics
+
+
+def record_metrics(endpoint, characters, commands):
+    """Adds one conversion's counters (LatexConverter.take_counters format) to metrics."""
+    metrics["documents"][endpoint] = metrics["documents"].get(endpoint, 0) + 1
+    metrics["characters"] += characters
+    totals = metrics["commands"]
+    for name, counts in commands.items():
+        total = totals.setdefault(f"\\{name}", dict.fromkeys(_COUNTER_FIELDS, 0))
+        for field in _COUNTER_FIELDS:
+            total[field] += counts[field]
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return results.stats()
+
+
+async def spool_upload(file, path):
+    """
+    Writes the upload to path UPLOAD_CHUNK_BYTES at a time and returns the
+    SHA-256 digest of its bytes, or None as soon as it passes
+    UPLOAD_MAX_BYTES.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    async with aiofiles.open(path, "wb") as f:
+        while chunk := await file.read(pipeline.UPLOAD_CHUNK_BYTES):
+            size += len(chunk)
+            if size > UPLOAD_MAX_BYTES:
+                return None
+            digest.update(chunk)
+            await f.write(chunk)
+    return digest.digest()
+
+
+async def save_copy(save_path, data):
+    try:
+        async with aiofiles.open(save_path, "wb") as f:
+            await f.write(data)
         print(f"Saved converted file to: {save_path}")
     except Exception as e:
         print(f"Could not save to Downloads folder: {e}")
 
-    return Response(
-        content=zip_buffer.getvalue(),
-        media_type="application/zip",
-        headers={"Content-Disposition": f"attachment; filename=converted_files.zip"}
-    )
+
+async def stream_archive(chunks, save_path=None, cache_key=None, remove_path=None):
+    """
+    Yields the ZIP pieces from the iterator chunks (run in a worker thread,
+    e.g. pipeline.iter_zip compressing entry by entry), copying every
+    piece to save_path with aiofiles on the way. With cache_key the
+    finished archive is stored in the result cache; remove_path is
+    deleted once the archive has been sent.
+    """
+    save_file = None
+    if save_path:
+        try:
+            save_file = await aiofiles.open(save_path, "wb")
+        except Exception as e:
+            print(f"Could not save to Downloads folder: {e}")
+
+    parts = []
+    completed = False
+    try:
+        async for chunk in iterate_in_threadpool(chunks):
+            if cache_key:
+                parts.append(chunk)
+            if save_file is not None:
+                try:
+                    await save_file.write(chunk)
+                except Exception as e:
+                    print(f"Could not save to Downloads folder: {e}")
+                    await save_file.close()
+                    save_file = None
+            yield chunk
+        completed = True
+        if cache_key:
+            results.put(cache_key, b"".join(parts))
+    finally:
+        if save_file is not None:
+            await save_file.close()
+            if completed:
+                print(f"Saved converted file to: {save_path}")
+        if remove_path:
+            os.unlink(remove_path)
 
 if __name__ == "__main__":
     import uvicorn
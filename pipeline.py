@@ -0,0 +1,481 @@
+"""
+CPU-bound parts of the web handlers (conversion, HTML diff, ZIP build).
+Kept free of FastAPI imports so the functions can run in worker processes.
+"""
+import codecs
+import difflib
+import hashlib
+import html
+import json
+import os
+import tempfile
+import time
+import zipfile
+
+from app import converter, diffing, units
+from app.cache import source_version
+from app.converter import LatexConverter
+from app.diffing import FastHtmlDiff, StreamingDiff, edit_groups, make_html_diff
+
+# LATEX_DIFF_ENGINE: 'fast' (patience diff, word-level highlights) or
+# 'difflib' (the standard library HtmlDiff)
+DIFF_ENGINE = os.environ.get("LATEX_DIFF_ENGINE", "fast")
+
+# Deflate level (0-9) per ZIP entry. diff.html is large and only viewed
+# once, so it gets a cheaper setting than the converted .tex.
+ZIP_LEVEL_TEX = int(os.environ.get("LATEX_ZIP_LEVEL_TEX", 6))
+ZIP_LEVEL_DIFF = int(os.environ.get("LATEX_ZIP_LEVEL_DIFF", 1))
+
+# Anchor prefixes of the paged diff table (see diff_page); the same on
+# every page so the "next change" links reach hunks loaded later
+DIFF_PAGE_PREFIX = ("from0_", "to0_")
+
+# Bytes read, decoded and converted at a time for a spooled upload
+UPLOAD_CHUNK_BYTES = int(os.environ.get("LATEX_UPLOAD_CHUNK_BYTES", 256 << 10))
+
+# Changes whenever converter.py, units.py, diffing.py, this file or main.py
+# (which builds the cached /convert results) is edited, which retires every
+# cached result built by the old code. main.py imports this module, so it
+# is hashed by path.
+CACHE_VERSION = source_version(converter, units, diffing, __file__,
+                               os.path.join(os.path.dirname(__file__), "main.py"))
+
+# One converter per process. Worker processes build it in init_worker();
+# anything else (tests, scripts) gets it on first use.
+_converter = None
+
+# Touches every handler once so patterns, unit tables and the memo are hot
+# before the first real request reaches a fresh worker.
+_WARMUP_TEXT = (
+    r"\num{1.5e3} \complexnum{1+2i} \si{\kilo\meter\per\second} "
+    r"\SI{100}{\volt} \qtylist{1;2}{\meter} \SIrange{0}{5}{\volt} "
+    r"\ang{1;2;3} \begin{tabular}{lS} \dv{f}{x} \pdv{f}{x} \braket{a}{b} "
+    r"\ce{SO4^2- + Ba^2+ -> BaSO4 v} \pu{123 kJ/mol}"
+)
+
+
+def get_converter():
+    global _converter
+    if _converter is None:
+        _converter = LatexConverter()
+    return _converter
+
+
+def init_worker():
+    """Process pool initializer: builds and warms this worker's converter."""
+    get_converter().convert(_WARMUP_TEXT)
+    get_converter().take_counters()
+
+
+def worker_ready():
+    """No-op submitted at startup so the pool spawns (and warms) its workers early."""
+    return os.getpid()
+
+
+def convert_code(code):
+    """
+    /convert pipeline. Returns (converted_code, diff, commands) where diff
+    holds the context hunks for the paged diff view (see diff_hunks) and
+    commands the converter counters for this call (see
+    LatexConverter.take_counters).
+    """
+    get_converter().take_counters()
+    diff_generator = make_html_diff(DIFF_ENGINE)
+    if hasattr(diff_generator, 'make_table_from_edits'):
+        # Build the hunks from the converter's own edit log, no re-diffing.
+        # The form is resubmitted after small fixes, so only changed
+        # paragraphs are converted again.
+        converted_code, edits = get_converter().convert_incremental(code, return_edits=True)
+        fromlines, tolines, groups = edit_groups(code, edits, numlines=5)
+        return converted_code, diff_hunks(fromlines, tolines, groups), get_converter().take_counters()
+
+    converted_code = get_converter().convert_incremental(code)
+    fromlines, tolines = code.splitlines(), converted_code.splitlines()
+    groups = list(difflib.SequenceMatcher(None, fromlines, tolines).get_grouped_opcodes(5))
+    return converted_code, diff_hunks(fromlines, tolines, groups), get_converter().take_counters()
+
+
+def diff_hunks(fromlines, tolines, groups):
+    """
+    The diff view's data: groups of opcodes (one per hunk) and only the
+    lines they show, as {line number: text}; fromlines and tolines may be
+    lists or edit_groups() dicts. Rows are rendered a page at a
+    time by diff_page(), so a book-sized diff costs nothing up front.
+    """
+    shown_from = {}
+    shown_to = {}
+    for group in groups:
+        for tag, i1, i2, j1, j2 in group:
+            for i in range(i1, i2):
+                shown_from[i] = fromlines[i]
+            if tag != 'equal':  # unchanged rows show the source line on both sides
+                for j in range(j1, j2):
+                    shown_to[j] = tolines[j]
+    return {"groups": [list(map(tuple, group)) for group in groups],
+            "fromlines": shown_from, "tolines": shown_to}
+
+
+def load_diff_hunks(data):
+    """diff_hunks() output back from JSON, which turned line numbers into strings."""
+    return {
+        "groups": [[tuple(op) for op in group] for group in data["groups"]],
+        "fromlines": {int(i): line for i, line in data["fromlines"].items()},
+        "tolines": {int(j): line for j, line in data["tolines"].items()},
+    }
+
+
+def diff_page(diff, start, count):
+    """
+    Hunks start .. start + count of a diff_hunks() result as table rows
+    (one HTML string per hunk, each meant for its own <tbody>), with the
+    total so the view knows when to stop asking.
+    """
+    renderer = FastHtmlDiff()
+    # Every page belongs to the same table, so the anchors ("n" links to the
+    # next hunk, "t" back to the top) must not change from call to call
+    renderer._prefix = list(DIFF_PAGE_PREFIX)
+    groups = diff["groups"]
+    hunks = []
+    for number in range(start, min(start + count, len(groups))):
+        rows = renderer.hunk_rows(diff["fromlines"], diff["tolines"], groups[number])
+        hunks.append(renderer.hunk_html(rows, number, number + 1 == len(groups), separator=False))
+    return {"total": len(groups), "start": start, "hunks": hunks}
+
+
+def result_key(kind, content_bytes, *extra):
+    """
+    SHA-256 key for a cached result: the input bytes plus everything else
+    that shapes the output (code version, diff engine, ZIP levels, names).
+    """
+    digest = hashlib.sha256()
+    settings = [kind, CACHE_VERSION, DIFF_ENGINE, str(ZIP_LEVEL_TEX), str(ZIP_LEVEL_DIFF), *extra]
+    digest.update("\0".join(settings).encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(content_bytes)
+    return digest.hexdigest()
+
+
+def package_name_root(filename):
+    return os.path.splitext(filename or "document.tex")[0]
+
+
+def convert_document(content_str, workers=1):
+    """
+    Converts content_str and returns (converted_str, diff_html) for a full
+    diff page. workers > 1 spreads a large document over that many
+    processes (see LatexConverter.convert_parallel).
+    """
+    diff_generator = make_html_diff(DIFF_ENGINE)
+    if hasattr(diff_generator, 'make_file_from_edits'):
+        converted_str, edits = get_converter().convert_parallel(content_str, workers=workers, return_edits=True)
+        diff_html = diff_generator.make_file_from_edits(
+            content_str, edits, fromdesc='Original', todesc='Converted', numlines=5)
+        return converted_str, diff_html
+
+    converted_str = get_converter().convert_parallel(content_str, workers=workers)
+    diff_html = diff_generator.make_file(
+        content_str.splitlines(),
+        converted_str.splitlines(),
+        fromdesc='Original',
+        todesc='Converted',
+        context=True,
+        numlines=5
+    )
+    return converted_str, diff_html
+
+
+def convert_package(content_str, filename):
+    """
+    Upload pipeline for text already in memory (/jobs; /upload streams
+    through convert_upload). Converts content_str and returns (entries,
+    name_root, report) where entries are (name, data, compresslevel)
+    tuples for iter_zip(): the converted .tex, diff.html and the
+    conversion report as report.json and report.html.
+    """
+    get_converter().take_counters()
+    start = time.perf_counter()
+    converted_str, diff_html = convert_document(content_str)
+    report = conversion_report(filename, len(content_str), time.perf_counter() - start,
+                               get_converter().take_counters())
+
+    name_root, ext = os.path.splitext(filename or "document.tex")
+    entries = [
+        (f"{name_root}_converted{ext}", converted_str, ZIP_LEVEL_TEX),
+        ("diff.html", diff_html, ZIP_LEVEL_DIFF),
+        ("report.json", json.dumps(report, indent=2), ZIP_LEVEL_TEX),
+        ("report.html", render_report_html(report), ZIP_LEVEL_TEX),
+    ]
+    return entries, name_root, report
+
+
+class InvalidUtf8(ValueError):
+    """Input is not UTF-8; offset is the position of the first bad byte."""
+    def __init__(self, offset):
+        super().__init__(offset)
+        self.offset = offset
+
+    def __str__(self):
+        return f"not UTF-8 encoded (byte {self.offset})"
+
+
+def decode_utf8(chunks):
+    """
+    Decodes an iterable of byte chunks as UTF-8, yielding text as it
+    arrives. A character split across chunks is held back until its last
+    byte; invalid input raises InvalidUtf8 with the byte offset in the
+    whole stream.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    offset = 0  # bytes passed to the decoder so far
+    for chunk in chunks:
+        pending = len(decoder.getstate()[0])
+        try:
+            text = decoder.decode(chunk)
+        except UnicodeDecodeError as e:
+            # e.start counts from the bytes held back from earlier chunks
+            raise InvalidUtf8(offset - pending + e.start)
+        offset += len(chunk)
+        if text:
+            yield text
+    pending = len(decoder.getstate()[0])
+    try:
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError as e:
+        raise InvalidUtf8(offset - pending + e.start)
+
+
+class TooLarge(ValueError):
+    """A batch ZIP would expand past max_bytes, in one member or in total."""
+    def __init__(self, name, size, max_bytes):
+        super().__init__(name, size, max_bytes)
+        self.name = name
+        self.size = size
+        self.max_bytes = max_bytes
+
+    def __str__(self):
+        return f"{self.name} expands to {self.size} bytes, over the limit of {self.max_bytes}"
+
+
+def iter_file(path, chunk_size=UPLOAD_CHUNK_BYTES):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def convert_upload(source_path, filename, archive_path):
+    """
+    /upload pipeline for an upload spooled to source_path. The file is
+    read, decoded and converted UPLOAD_CHUNK_BYTES at a time, and each
+    converted piece goes straight into the ZIP entry at archive_path, so
+    neither the text nor its conversion is ever held whole. diff.html is
+    built from the same pieces (StreamingDiff). Writes the same entries
+    as convert_package() and returns the report; raises InvalidUtf8.
+    """
+    converter = get_converter()
+    converter.take_counters()
+    start = time.perf_counter()
+    name_root, ext = os.path.splitext(filename or "document.tex")
+    if DIFF_ENGINE != "fast":
+        # Other engines diff whole line lists; read the file in one go
+        content_str = "".join(decode_utf8(iter_file(source_path)))
+        entries, _, report = convert_package(content_str, filename)
+        with open(archive_path, "wb") as f:
+            for chunk in iter_zip(entries):
+                f.write(chunk)
+        return report
+
+    characters = 0
+    # A ZIP takes one entry at a time, so the diff rows wait in a temporary
+    # file while the converted text is written
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as diff_file, \
+            zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED, False, compresslevel=ZIP_LEVEL_TEX) as zip_file:
+        diff = StreamingDiff(diff_file, numlines=5)
+        head, tail = diff.html.file_parts('Original', 'Converted')
+        diff_file.write(head)
+        with zip_file.open(f"{name_root}_converted{ext}", "w") as entry:
+            chunks = decode_utf8(iter_file(source_path))
+            for source, converted in converter.convert_stream(chunks, with_source=True):
+                entry.write(converted.encode("utf-8"))
+                diff.feed(source, converted)
+                characters += len(source)
+        diff.finish()
+        diff_file.write(tail)
+        report = conversion_report(filename, characters, time.perf_counter() - start,
+                                   converter.take_counters())
+
+        diff_file.seek(0)
+        zip_file.compresslevel = ZIP_LEVEL_DIFF  # for entries opened by name
+        with zip_file.open("diff.html", "w") as entry:
+            while True:
+                piece = diff_file.read(UPLOAD_CHUNK_BYTES)
+                if not piece:
+                    break
+                entry.write(piece.encode("utf-8"))
+        zip_file.writestr("report.json", json.dumps(report, indent=2), compresslevel=ZIP_LEVEL_TEX)
+        zip_file.writestr("report.html", render_report_html(report), compresslevel=ZIP_LEVEL_TEX)
+    return report
+
+
+def conversion_report(filename, characters, seconds, commands):
+    """
+    Report for one converted document from the converter counters: one
+    row per command (found, converted, handler calls and time), most
+    frequent first.
+    """
+    rows = [{"command": f"\\{name}", **counts} for name, counts in commands.items()]
+    rows.sort(key=lambda row: (-row["found"], row["command"]))
+    for row in rows:
+        row["handler_seconds"] = round(row["handler_seconds"], 6)
+    return {
+        "file": filename,
+        "characters": characters,
+        "seconds": round(seconds, 4),
+        "found": sum(row["found"] for row in rows),
+        "converted": sum(row["converted"] for row in rows),
+        "commands": rows,
+    }
+
+
+def render_report_html(report):
+    """report.html: the conversion report as a standalone table."""
+    rows = "".join(
+        f"<tr><td><code>{html.escape(row['command'])}</code></td><td>{row['found']}</td>"
+        f"<td>{row['converted']}</td><td>{row['handler_calls']}</td>"
+        f"<td>{row['handler_seconds'] * 1000:.3f}</td></tr>\n"
+        for row in report["commands"]
+    )
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Conversion report - {html.escape(report['file'] or 'document')}</title>
+<style>
+    body {{ font-family: sans-serif; margin: 2em; }}
+    table {{ border-collapse: collapse; }}
+    th, td {{ border: 1px solid #ccc; padding: 4px 10px; text-align: right; }}
+    th:first-child, td:first-child {{ text-align: left; }}
+</style>
+</head>
+<body>
+<h2>{html.escape(report['file'] or 'document')}</h2>
+<p>{report['characters']} characters converted in {report['seconds']:.3f} s:
+{report['found']} commands found, {report['converted']} converted.</p>
+<table>
+<tr><th>Command</th><th>Found</th><th>Converted</th><th>Handler calls</th><th>Handler time (ms)</th></tr>
+{rows}</table>
+</body>
+</html>
+"""
+
+
+def expand_sources(filename, path, max_bytes):
+    """
+    Returns [(name, bytes)] for one batch upload spooled to path: the file
+    itself, or every .tex member (with its folder path) when it is a ZIP
+    of a project. Raises TooLarge before reading anything when a member,
+    or all members together, would expand past max_bytes; ZipFile never
+    decompresses a member past the size its header declares.
+    """
+    if not zipfile.is_zipfile(path):
+        with open(path, "rb") as f:
+            return [(os.path.basename(filename or "document.tex"), f.read())]
+
+    with zipfile.ZipFile(path) as zip_file:
+        members = []
+        for info in zip_file.infolist():
+            name = info.filename.replace("\\", "/").lstrip("/")
+            if info.is_dir() or not name.lower().endswith(".tex"):
+                continue
+            if name.startswith("__MACOSX/") or ".." in name.split("/"):
+                continue
+            if info.file_size > max_bytes:
+                raise TooLarge(name, info.file_size, max_bytes)
+            members.append((name, info))
+        total = sum(info.file_size for _, info in members)
+        if total > max_bytes:
+            raise TooLarge(filename or "upload", total, max_bytes)
+        return [(name, zip_file.read(info)) for name, info in members]
+
+
+def convert_batch_file(name, content_bytes):
+    """
+    /batch worker job for a single file. Returns (entries, record): the
+    converted file and its diff under the file's own path, plus a summary
+    record with the size, time taken and any error.
+    """
+    start = time.perf_counter()
+    record = {"file": name, "bytes": len(content_bytes)}
+    try:
+        content_str = content_bytes.decode('utf-8')
+    except UnicodeDecodeError as e:
+        record["error"] = f"not UTF-8 encoded (byte {e.start})"
+        record["seconds"] = round(time.perf_counter() - start, 4)
+        return [], record
+
+    get_converter().take_counters()
+    converted_str, diff_html = convert_document(content_str)
+    record["commands"] = get_converter().take_counters()
+    name_root, ext = os.path.splitext(name)
+    entries = [
+        (f"{name_root}_converted{ext}", converted_str, ZIP_LEVEL_TEX),
+        (f"{name_root}_diff.html", diff_html, ZIP_LEVEL_DIFF),
+    ]
+    record["changed"] = converted_str != content_str
+    record["seconds"] = round(time.perf_counter() - start, 4)
+    return entries, record
+
+
+def batch_summary(records, wall_seconds, workers):
+    """Builds the summary.json text for a batch from its per-file records."""
+    summary = {
+        "files": len(records),
+        "failed": sum(1 for record in records if "error" in record),
+        "wall_seconds": round(wall_seconds, 4),
+        "cpu_seconds": round(sum(record["seconds"] for record in records), 4),
+        "workers": workers,
+        "results": records,
+    }
+    return json.dumps(summary, indent=2)
+
+
+class _ZipSink:
+    """
+    Write-only file object for ZipFile. It has tell() but no seek(), so
+    ZipFile writes entries sequentially with data descriptors and the
+    bytes can be handed out as soon as each entry is complete.
+    """
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(entries):
+    """
+    Yields a ZIP archive of (name, data, compresslevel) entries piece by
+    piece: one chunk per entry, then the central directory.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED, False) as zip_file:
+        for name, data, level in entries:
+            zip_file.writestr(name, data, compresslevel=level)
+            yield sink.take()
+    yield sink.take()
@@ -0,0 +1,202 @@
+"""
+Project mode: converts a root .tex file together with every file it pulls
+in through \\input, \\include or \\subfile. Each file is converted once and
+the result is cached under the SHA-256 of its bytes (and of the preamble
+options it is included under), so a re-run after an edit only reconverts
+the chapters that changed.
+
+    python -m app.project book.tex -o converted/
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+
+from app import converter as converter_module, units
+from app.cache import ResultCache, source_version
+from app.converter import LatexConverter
+
+# \input{file}, \include{file}, \subfile{file} (the .tex extension is optional)
+_INCLUDE_PATTERN = re.compile(r'\\(?:input|include|subfile)\s*\{([^{}]+)\}')
+# A % that is not escaped starts a comment running to the end of the line
+_COMMENT_PATTERN = re.compile(r'(?<!\\)%[^\n]*')
+
+CACHE_DIR_NAME = ".latex_cache"
+MEMORY_CACHE_BYTES = 64 << 20
+
+
+def find_includes(text):
+    """Returns the file names referenced by \\input/\\include/\\subfile in text, in order."""
+    return [match.group(1).strip() for match in _iter_includes(text)]
+
+
+def _iter_includes(text):
+    # Include matches with their offsets in text; comments are blanked
+    # rather than removed so the offsets stay put
+    text = _COMMENT_PATTERN.sub(lambda match: ' ' * len(match.group()), text)
+    return _INCLUDE_PATTERN.finditer(text)
+
+
+def is_under(path, folder):
+    """Whether path, with symlinks resolved, is inside folder."""
+    path, folder = os.path.realpath(path), os.path.realpath(folder)
+    return os.path.commonpath([path, folder]) == folder
+
+
+def resolve_include(name, base_dir):
+    """
+    Maps an include argument to a file path under base_dir, adding .tex when
+    the name has no extension. Returns None when no such file exists, or
+    when the name points outside base_dir (../x, an absolute path or a
+    symlink out of the folder).
+    """
+    candidates = [name] if os.path.splitext(name)[1] else [name + ".tex", name]
+    for candidate in candidates:
+        path = os.path.normpath(os.path.join(base_dir, candidate))
+        if os.path.isfile(path) and is_under(path, base_dir):
+            return path
+    return None
+
+
+def sha256_file(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(digest, profile):
+    """Cache key of a file's conversion: its hash and the profile it starts with."""
+    if not profile:
+        return digest
+    return hashlib.sha256(f"{digest}:{profile!r}".encode("utf-8")).hexdigest()
+
+
+class ProjectConverter:
+    """
+    Converts the include graph of a root .tex file with a per-file cache.
+    Include paths are resolved against the root file's folder, as LaTeX
+    does. Each included file is converted with the profile (mhchem options
+    and the like) in effect where it is first included. Converted text is
+    stored in a ResultCache under cache_dir, which drops it when
+    converter.py or units.py changes; set cache_dir=None to keep the cache
+    in memory only.
+    """
+    def __init__(self, root_path, cache_dir="", converter=None):
+        self.root_path = os.path.abspath(root_path)
+        self.base_dir = os.path.dirname(self.root_path)
+        if cache_dir == "":
+            cache_dir = os.path.join(self.base_dir, CACHE_DIR_NAME)
+        self.cache = ResultCache(MEMORY_CACHE_BYTES, cache_dir, source_version(converter_module, units))
+        self.converter = converter or LatexConverter()
+        self.missing = []
+        self.profiles = {}
+
+    def resolve(self):
+        """
+        Walks the include graph from the root and returns every reachable
+        file once, in first-seen (depth-first) order. Includes that do not
+        exist under the project folder are collected in self.missing, and
+        the profile each file starts with in self.profiles.
+        """
+        self.missing = []
+        self.profiles = {self.root_path: ()}
+        order = []
+        seen = set()
+        stack = [self.root_path]
+        while stack:
+            path = stack.pop()
+            if path in seen:
+                continue
+            seen.add(path)
+            order.append(path)
+            with open(path, encoding="utf-8", errors="replace") as f:
+                text = f.read()
+            children = []
+            profile = self.profiles[path]
+            pos = 0
+            for match in _iter_includes(text):
+                # The profile where the include is, from the commands since the last one
+                profile = self.converter.profile_after(text[pos:match.start()], profile)
+                pos = match.start()
+                name = match.group(1).strip()
+                child = resolve_include(name, self.base_dir)
+                if child is None:
+                    self.missing.append((os.path.relpath(path, self.base_dir), name))
+                elif child not in seen:
+                    children.append(child)
+                    self.profiles[child] = profile
+            # Reversed so the first include is converted first
+            stack.extend(reversed(children))
+        return order
+
+    def convert(self, output_dir=None):
+        """
+        Converts every file in the project and returns one record per file
+        (relative path, sha256, whether it came from the cache, seconds).
+        With output_dir the converted files are written there under the
+        same relative paths, so the includes still resolve.
+        """
+        records = []
+        for path in self.resolve():
+            start = time.perf_counter()
+            with open(path, "rb") as f:
+                data = f.read()
+            digest = sha256_file(data)
+            profile = self.profiles[path]
+            key = cache_key(digest, profile)
+            cached_bytes = self.cache.get(key)
+            cached = cached_bytes is not None
+            if cached:
+                converted = cached_bytes.decode("utf-8")
+            else:
+                converted = self.converter.convert(data.decode("utf-8"), profile=profile)
+                self.cache.put(key, converted.encode("utf-8"))
+
+            relative = os.path.relpath(path, self.base_dir)
+            if output_dir:
+                out_path = os.path.normpath(os.path.join(output_dir, relative))
+                # resolve() only returns files under the project folder;
+                # never write over anything outside output_dir regardless
+                if not is_under(out_path, output_dir):
+                    raise ValueError(f"Refusing to write {out_path} outside {output_dir}")
+                os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+                with open(out_path, "w", encoding="utf-8", newline="") as f:
+                    f.write(converted)
+
+            records.append({
+                "file": relative,
+                "sha256": digest,
+                "cached": cached,
+                "seconds": round(time.perf_counter() - start, 4),
+            })
+        return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a LaTeX project following \\input/\\include.")
+    parser.add_argument("root", help="root .tex file")
+    parser.add_argument("-o", "--output", default=None, help="folder for the converted files")
+    parser.add_argument("--cache-dir", default="", help=f"result cache folder (default: <project>/{CACHE_DIR_NAME})")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the on-disk cache")
+    args = parser.parse_args(argv)
+
+    cache_dir = None if args.no_cache else args.cache_dir
+    project = ProjectConverter(args.root, cache_dir=cache_dir)
+    start = time.perf_counter()
+    records = project.convert(args.output)
+    total = time.perf_counter() - start
+
+    for record in records:
+        state = "cached" if record["cached"] else "converted"
+        print(f"{record['seconds']:8.3f}s  {state:9}  {record['file']}")
+    for source, name in project.missing:
+        print(f"   missing  {name} (from {source})")
+    reconverted = sum(1 for record in records if not record["cached"])
+    print(f"{len(records)} files, {reconverted} converted, {total:.2f}s total")
+    if args.output:
+        with open(os.path.join(args.output, "project.json"), "w") as f:
+            json.dump({"files": records, "missing": project.missing}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+"""
+Test setup: the repository folder is the `app` package (see run.py), so it
+is registered under that name whatever the checkout is called.
+"""
+import importlib.util
+import os
+import sys
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "app" not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+        "app", os.path.join(PACKAGE_DIR, "__init__.py"), submodule_search_locations=[PACKAGE_DIR])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["app"] = module
+    spec.loader.exec_module(module)
@@ -0,0 +1,17 @@
+"""ResultCache keeps finished results only."""
+from app import cache
+from app.cache import ResultCache, source_version
+
+
+def test_empty_value_is_not_stored(tmp_path):
+    results = ResultCache(1 << 20, str(tmp_path), "0123456789abcdef")
+    results.put("a" * 64, b"")
+    assert results.get("a" * 64) is None
+    assert len(results) == 0
+    assert not any(path.is_file() for path in tmp_path.rglob("*"))
+    results.put("b" * 64, b"zip")
+    assert results.get("b" * 64) == b"zip"
+
+
+def test_source_version_takes_paths():
+    assert source_version(cache) == source_version(cache.__file__)
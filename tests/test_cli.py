@@ -0,0 +1,30 @@
+"""Batch CLI: failed files are reported apart from converted ones."""
+from app import cli
+
+
+def test_failed_files_are_not_counted_as_converted(tmp_path, capsys):
+    (tmp_path / "good.tex").write_text("Speed \\qty{3}{\\meter}.\n")
+    (tmp_path / "bad.tex").write_bytes(b"ok \xff\n")
+    assert cli.main([str(tmp_path), "-j", "1"]) == 1
+    out = capsys.readouterr().out
+    assert "failed  bad.tex" in out
+    assert "1 converted, 0 unchanged, 1 failed" in out
+    assert (tmp_path / "good_converted.tex").exists()
+
+
+def test_clean_run_exits_zero(tmp_path, capsys):
+    (tmp_path / "good.tex").write_text("Speed \\qty{3}{\\meter}.\n")
+    assert cli.main([str(tmp_path), "-j", "1"]) == 0
+    assert "1 converted, 0 unchanged, 0 failed" in capsys.readouterr().out
+
+
+def test_unreadable_file_does_not_stop_the_run(tmp_path, capsys):
+    (tmp_path / "good.tex").write_text("Speed \\qty{3}{\\meter}.\n")
+    (tmp_path / "gone.tex").symlink_to(tmp_path / "deleted.tex")
+    summary = tmp_path / "summary.json"
+    assert cli.main([str(tmp_path), "-j", "1", "--summary", str(summary)]) == 1
+    out = capsys.readouterr().out
+    assert "failed  gone.tex" in out
+    assert "1 converted, 0 unchanged, 1 failed" in out
+    assert (tmp_path / "good_converted.tex").exists()
+    assert '"failed": 1' in summary.read_text()
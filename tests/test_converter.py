@@ -0,0 +1,145 @@
+"""
+Converter behaviour: mhchem arrows, and the promise that streaming,
+incremental and parallel conversion give exactly convert()'s output.
+"""
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from app.benchmarks.corpus import load_samples
+from app import converter as converter_module
+from app.converter import LatexConverter, iter_chunks, split_chunks
+
+# Inputs whose commands, groups or environments straddle the chunk,
+# paragraph and block boundaries the other entry points cut at
+EDGE_CASES = {
+    "unbalanced open brace": "Text \\num{1.5 and \\qty{3}{\\meter} later.\n\n\\SI{2}{\\volt} {\n",
+    "unbalanced close brace": "a } \\num{2} }} \\qty{1}{\\second}\n\n]\\SI{3}{\\volt}\n",
+    "environment across paragraphs": ("\\begin{align}\n  x &= \\qty{1}{\\meter}\n\n"
+                                      "  y &= \\num{2}\n\\end{align}\nText \\num{3}.\n"),
+    "verb and comments": ("\\verb|\\num{1}| % \\qty{2}{\\meter}\n\\num{3}% tail \\SI{1}{\\volt}\n\n"
+                          "%\n\\num{4}\\%\\num{5}\n"),
+    "math modes": ("$$\\num{1}$$ \\[\\qty{2}{\\meter}\\] \\(\\num{3}\\) \\ensuremath{\\num{4}}\n\n"
+                   "$a \\text{b \\num{5} $\\num{6}$} c$ \\num{7}\n"),
+    "preamble options": ("\\usepackage[arrows=font]{mhchem}\n\n\\ce{A ->[x] B}\n\n"
+                         "\\mhchemoptions{textfontname=sffamily}\n\\ce{H2O}\n"),
+}
+DOCUMENTS = {**load_samples(), **EDGE_CASES}
+
+
+@pytest.mark.parametrize("source, expected", [
+    ("\\ce{A <=> B}", "\\rightleftharpoons"),
+    ("\\ce{A -> B}", "\\rightarrow"),
+    ("\\ce{A <- B}", "\\leftarrow"),
+    ("\\ce{A <-> B}", "\\leftrightarrow"),
+])
+def test_unlabelled_arrow_is_fixed_symbol(source, expected):
+    converted = LatexConverter().convert(source)
+    assert expected in converted
+    assert "\\x" not in converted
+
+
+def test_labelled_arrow_is_extensible():
+    assert "\\xrightarrow[\\mathrm{below}]{\\mathrm{above}}" in LatexConverter().convert("\\ce{A ->[above][below] B}")
+
+
+def test_font_arrows_option():
+    converted = LatexConverter().convert("\\usepackage[arrows=font]{mhchem}\n\\ce{A ->[above] B}")
+    assert "\\overset{\\mathrm{above}}{\\rightarrow}" in converted
+
+
+@pytest.mark.parametrize("name, size", [
+    *((name, size) for name in sorted(DOCUMENTS) for size in (5, 64, 4096)),
+    # One character at a time is slow on the samples; the edge cases cover it
+    *((name, 1) for name in sorted(EDGE_CASES)),
+])
+def test_convert_stream_matches_convert(name, size):
+    text = DOCUMENTS[name]
+    expected = LatexConverter().convert(text)
+    assert "".join(LatexConverter().convert_stream(iter_chunks(io.StringIO(text), size))) == expected
+    pairs = list(LatexConverter().convert_stream(iter_chunks(io.StringIO(text), size), with_source=True))
+    assert "".join(source for source, _ in pairs) == text
+    assert "".join(converted for _, converted in pairs) == expected
+
+
+@pytest.mark.parametrize("name", sorted(DOCUMENTS))
+def test_convert_incremental_matches_convert(name):
+    text = DOCUMENTS[name]
+    assert LatexConverter().convert_incremental(text, return_edits=True) == LatexConverter().convert(text, True)
+
+
+def resubmissions(text):
+    # The /convert form's edits: typing in the middle, adding and removing
+    # a paragraph, breaking a brace, changing the preamble
+    middle = len(text) // 2
+    yield text
+    yield text[:middle] + " \\num{42} " + text[middle:]
+    yield text[:middle] + "\n\n\\qty{1}{\\meter}\n\n" + text[middle:]
+    yield text[:middle] + "{" + text[middle:]
+    yield text[:middle] + text[middle + 40:]
+    yield "\\usepackage[arrows=font]{mhchem}\n\\ce{A ->[x] B}\n\n" + text
+    yield text
+
+
+@pytest.mark.parametrize("name", sorted(DOCUMENTS))
+def test_convert_incremental_resubmission_matches_convert(name):
+    converter = LatexConverter()
+    for text in resubmissions(DOCUMENTS[name]):
+        assert converter.convert_incremental(text, return_edits=True) == LatexConverter().convert(text, True)
+        assert converter.convert_incremental(text) == LatexConverter().convert(text)
+
+
+@pytest.fixture(scope="module")
+def pool():
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        yield pool
+
+
+# The edge cases back to back, so chunks start and end among them
+MIXED = "\n\n".join(sorted(EDGE_CASES.values()) * 3)
+
+
+@pytest.mark.parametrize("name", [*sorted(DOCUMENTS), "mixed"])
+def test_convert_parallel_matches_convert(name, pool, monkeypatch):
+    text = MIXED if name == "mixed" else DOCUMENTS[name]
+    monkeypatch.setattr(converter_module, "PARALLEL_CHUNK_CHARS", 256)
+    expected = LatexConverter().convert(text, True)
+    got = LatexConverter().convert_parallel(text, pool, workers=2, return_edits=True, min_chars=0)
+    assert got == expected
+    assert LatexConverter().convert_parallel(text, pool, workers=2, min_chars=0) == expected[0]
+
+
+def test_convert_parallel_splits_the_samples():
+    # Otherwise the test above would only exercise the convert() fallback
+    for name in (*load_samples(), "mixed"):
+        text = MIXED if name == "mixed" else DOCUMENTS[name]
+        assert len(split_chunks(text, 256)) > 2, name
+
+
+@pytest.mark.parametrize("source, expected", [
+    # Text mode: the math replacement is wrapped in $...$
+    ("Speed \\qty{3}{\\meter\\per\\second}.", "Speed $3\\,\\mathrm{m}\\mathrm{s}^{-1}$."),
+    ("\\qty{3}{\\meter} $x$ \\num{4}", "$3\\,\\mathrm{m}$ $x$ $4$"),
+    # Already math: never wrapped a second time
+    ("$\\qty{3}{\\meter}$", "$3\\,\\mathrm{m}$"),
+    ("\\(\\num{2}\\)", "\\(2\\)"),
+    ("$$\\num{2}$$", "$$2$$"),
+    ("\\[\\num{2}\\]", "\\[2\\]"),
+    ("\\begin{equation}\\num{2}\\end{equation}", "\\begin{equation}2\\end{equation}"),
+    ("\\begin{align*}x &= \\num{2}\\end{align*}", "\\begin{align*}x &= 2\\end{align*}"),
+    ("\\ensuremath{\\num{3}}", "\\ensuremath{3}"),
+    # \text{...} switches back to text mode, also inside math
+    ("\\text{\\num{3}}", "\\text{$3$}"),
+    ("$a \\text{is \\num{5}}$", "$a \\text{is $5$}$"),
+    ("$\\text{$\\num{6}$}$", "$\\text{$6$}$"),
+    ("\\[x \\text{ for \\qty{1}{\\second}} \\num{7}\\]", "\\[x \\text{ for $1\\,\\mathrm{s}$} 7\\]"),
+    # Math closed by a paragraph break: text mode again
+    ("$\\num{1}\n\n\\num{2}", "$1\n\n$2$"),
+    # Literal unit text is set upright
+    ("\\qty{3}{km/h}", "$3\\,\\mathrm{km}/\\mathrm{h}$"),
+    ("\\SI{5}{Hz}", "$5\\,\\mathrm{Hz}$"),
+    ("$\\si{mV}$", "$\\mathrm{mV}$"),
+])
+def test_math_mode_wrapping(source, expected):
+    assert LatexConverter().convert(source) == expected
@@ -0,0 +1,65 @@
+"""JSON-RPC daemon: a stdio session answers every method and the protocol errors."""
+import io
+import json
+
+import pytest
+
+from app import daemon
+from app.converter import LatexConverter
+
+SOURCE = "Speed \\qty{3}{\\meter} and \\num{1.5e3}.\n"
+
+
+@pytest.fixture(scope="module")
+def service():
+    return daemon.ConversionService()
+
+
+def session(service, lines):
+    # One stdio session; replies may come back in any order, so they are keyed by id
+    stdout = io.StringIO()
+    daemon.serve_stdio(service, 2, io.StringIO("".join(line + "\n" for line in lines)), stdout)
+    return [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+
+def request(request_id, method, **params):
+    return json.dumps({"jsonrpc": "2.0", "id": request_id, "method": method, "params": params})
+
+
+def test_stdio_round_trip(service):
+    replies = session(service, [
+        request(1, "convert", text=SOURCE),
+        request(2, "diff", text=SOURCE),
+        request(3, "report", text=SOURCE, file="a.tex"),
+        request(4, "stats"),
+        json.dumps({"jsonrpc": "2.0", "method": "stats", "params": {}}),  # notification: no reply
+        request(5, "shutdown"),
+    ])
+    results = {reply["id"]: reply["result"] for reply in replies}
+    assert sorted(results) == [1, 2, 3, 4, 5]
+    assert results[1]["text"] == LatexConverter().convert(SOURCE)
+    assert results[1]["commands"]["qty"]["converted"] == 1
+    assert results[2]["text"] == results[1]["text"]
+    assert "<table" in results[2]["diff_html"]
+    assert (results[3]["file"], results[3]["found"], results[3]["converted"]) == ("a.tex", 2, 2)
+    assert results[4]["requests"] >= 3
+    assert results[5] is True
+
+
+def test_stdio_errors(service):
+    replies = session(service, [
+        "{not json",
+        request(1, "convert", txt=SOURCE),
+        request(2, "convert"),
+        json.dumps({"jsonrpc": "2.0", "id": 3, "method": "convert", "params": ["x"]}),
+        request(4, "nope"),
+        request(5, "shutdown"),
+    ])
+    errors = {reply["id"]: reply["error"]["code"] for reply in replies if "error" in reply}
+    assert errors == {
+        None: daemon.PARSE_ERROR,
+        1: daemon.INVALID_PARAMS,
+        2: daemon.INVALID_PARAMS,
+        3: daemon.INVALID_PARAMS,
+        4: daemon.METHOD_NOT_FOUND,
+    }
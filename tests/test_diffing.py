@@ -0,0 +1,52 @@
+"""StreamingDiff must render the same page as a diff of the whole documents."""
+import io
+import re
+
+import pytest
+
+from app.diffing import FastHtmlDiff, StreamingDiff
+
+OLD = "".join(f"line {k} with $x_{k}$\n" if k % 7 == 3 else f"line {k}\n" for k in range(40))
+NEW = OLD.replace("$x_", "$y_")
+
+
+def normalized(page):
+    # Every page numbers its anchors from a class-wide counter
+    return re.sub(r"(difflib_chg_to|from|to)\d+_", r"\1N_", page)
+
+
+def streamed(old, new, size):
+    out = io.StringIO()
+    diff = StreamingDiff(out, numlines=5)
+    head, tail = diff.html.file_parts("Original", "Converted")
+    out.write(head)
+    for k in range(0, max(len(old), len(new)), size):
+        diff.feed(old[k:k + size], new[k:k + size])
+    diff.finish()
+    out.write(tail)
+    return normalized(out.getvalue())
+
+
+def whole(old, new):
+    return normalized(FastHtmlDiff().make_file(old.splitlines(), new.splitlines(), "Original", "Converted",
+                                               context=True, numlines=5))
+
+
+@pytest.mark.parametrize("size", [1, 5, 64, 1 << 16])
+@pytest.mark.parametrize("ending", ["\n", "\r\n", ""])
+def test_streaming_diff_matches_whole_diff(size, ending):
+    old = OLD.replace("\n", "\r\n") if ending == "\r\n" else OLD
+    new = NEW.replace("\n", "\r\n") if ending == "\r\n" else NEW
+    if not ending:
+        old, new = old[:-1], new[:-1]
+    assert streamed(old, new, size) == whole(old, new)
+
+
+def test_streaming_diff_change_on_last_line():
+    old = OLD + "end $z$\n"
+    new = NEW + "end $w$\n"
+    assert streamed(old, new, 3) == whole(old, new)
+
+
+def test_streaming_diff_identical():
+    assert streamed(OLD, OLD, 7) == whole(OLD, OLD)
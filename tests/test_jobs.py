@@ -0,0 +1,53 @@
+"""JobQueue: finished jobs are forgotten, result and spooled input, once their TTL runs out."""
+import asyncio
+import time
+
+from app.jobs import Job, JobQueue
+
+
+def test_finished_job_expires(tmp_path):
+    source = tmp_path / "upload.tex"
+    source.write_bytes(b"x")
+
+    async def run(job):
+        job.archive = b"zip"
+
+    async def scenario():
+        queue = JobQueue(run, max_queued=2, workers=1, ttl=0.05)
+        queue.start()
+        try:
+            job = queue.submit(Job("a.tex", str(source)))
+            while job.finished is None:
+                await asyncio.sleep(0.01)
+            assert job.status == "done"
+            assert not source.exists()
+            assert queue.get(job.id) is job
+            job.finished = time.time() - 1
+            assert queue.get(job.id) is None
+            assert job.archive is None
+            assert queue.stats()["expired"] == 1
+        finally:
+            await queue.stop()
+
+    asyncio.run(scenario())
+
+
+def test_expire_sweeps_only_stale_jobs():
+    async def run(job):
+        pass
+
+    async def scenario():
+        queue = JobQueue(run, max_queued=4, workers=1, ttl=60)
+        queue.start()
+        try:
+            old, new = queue.submit(Job("old.tex", None)), queue.submit(Job("new.tex", None))
+            while new.finished is None:
+                await asyncio.sleep(0.01)
+            old.finished -= 120
+            assert queue.expire() == 1
+            assert queue.get(old.id) is None
+            assert queue.get(new.id) is new
+        finally:
+            await queue.stop()
+
+    asyncio.run(scenario())
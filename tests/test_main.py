@@ -0,0 +1,154 @@
+"""Endpoint tests: the archives /upload, /batch and /jobs return must open and hold the conversion."""
+import io
+import os
+import time
+import zipfile
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+from fastapi.testclient import TestClient
+
+from conftest import PACKAGE_DIR
+
+SOURCE = "Speed \\qty{3}{\\meter\\per\\second} and \\num{1.5e3}.\n\n\\pdv{f}{x}\n"
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    # main.py resolves app/templates and app/static from the working
+    # directory and saves a copy of every upload to ~/Downloads
+    root = tmp_path_factory.mktemp("server")
+    os.makedirs(root / "app" / "static")
+    os.symlink(os.path.join(PACKAGE_DIR, "templates"), root / "app" / "templates")
+    os.makedirs(root / "home" / "Downloads")
+    patch = pytest.MonkeyPatch()
+    patch.chdir(root)
+    patch.setenv("HOME", str(root / "home"))
+    from app import main
+    with TestClient(main.app) as client:
+        yield client
+    patch.undo()
+
+
+def open_zip(response):
+    assert response.status_code == 200, response.text
+    assert response.content, "empty archive"
+    return zipfile.ZipFile(io.BytesIO(response.content))
+
+
+def converted_text():
+    from app import pipeline
+    return pipeline.get_converter().convert(SOURCE)
+
+
+def test_upload_returns_archive(client):
+    # The second request is answered from the result cache
+    for _ in range(2):
+        archive = open_zip(client.post("/upload", files={"file": ("paper.tex", SOURCE.encode("utf-8"))}))
+        assert archive.testzip() is None
+        assert archive.read("paper_converted.tex").decode("utf-8") == converted_text()
+        assert b"<table" in archive.read("diff.html")
+
+
+def test_upload_saves_download_copy(client):
+    open_zip(client.post("/upload", files={"file": ("copy.tex", SOURCE.encode("utf-8"))}))
+    saved = os.path.join(os.environ["HOME"], "Downloads", "copy_converted_package.zip")
+    with zipfile.ZipFile(saved) as archive:
+        assert archive.read("copy_converted.tex").decode("utf-8") == converted_text()
+
+
+def test_upload_rejects_invalid_utf8(client):
+    response = client.post("/upload", files={"file": ("bad.tex", b"ok \xff")})
+    assert response.status_code == 400
+
+
+def test_batch_returns_archive(client):
+    files = [("files", ("a.tex", SOURCE.encode("utf-8"))), ("files", ("b.tex", b"plain text\n"))]
+    archive = open_zip(client.post("/batch", files=files))
+    names = archive.namelist()
+    assert "summary.json" in names
+    assert any(name.endswith("a_converted.tex") for name in names)
+    assert any(name.endswith("b_converted.tex") for name in names)
+
+
+def zip_bytes(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for name, data in members:
+            zip_file.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_batch_expands_zip(client):
+    upload = zip_bytes([("book/ch1.tex", SOURCE), ("book/ch2.tex", "plain\n"), ("book/fig.png", "x")])
+    names = open_zip(client.post("/batch", files=[("files", ("book.zip", upload))])).namelist()
+    assert "book/ch1_converted.tex" in names
+    assert "book/ch2_converted.tex" in names
+
+
+def test_batch_rejects_too_large_upload(client, monkeypatch):
+    from app import main
+    monkeypatch.setattr(main, "UPLOAD_MAX_BYTES", 8)
+    response = client.post("/batch", files=[("files", ("a.tex", SOURCE.encode("utf-8")))])
+    assert response.status_code == 413
+
+
+@pytest.mark.parametrize("members", [
+    [("bomb.tex", "%" * (1 << 20))],
+    [(f"part{k}.tex", "%" * (1 << 12)) for k in range(64)],
+])
+def test_batch_rejects_zip_expanding_past_limit(client, monkeypatch, members):
+    # Compresses to a few KB, under the limit; expands past it
+    from app import main
+    upload = zip_bytes(members)
+    monkeypatch.setattr(main, "UPLOAD_MAX_BYTES", 128 << 10)
+    assert len(upload) < main.UPLOAD_MAX_BYTES
+    response = client.post("/batch", files=[("files", ("bomb.zip", upload))])
+    assert response.status_code == 413
+
+
+def wait_for_job(client, job_id):
+    deadline = time.time() + 30
+    while (status := client.get(f"/jobs/{job_id}").json())["status"] not in ("done", "failed"):
+        assert time.time() < deadline
+        time.sleep(0.05)
+    return status
+
+
+def test_job_result_is_archive(client):
+    response = client.post("/jobs", files={"file": ("job.tex", SOURCE.encode("utf-8"))})
+    assert response.status_code == 202
+    job_id = response.json()["id"]
+    assert wait_for_job(client, job_id)["status"] == "done"
+    archive = open_zip(client.get(f"/jobs/{job_id}/result"))
+    assert archive.read("job_converted.tex").decode("utf-8") == converted_text()
+
+
+def test_job_rejects_invalid_utf8(client):
+    response = client.post("/jobs", files={"file": ("bad.tex", b"ok \xff")})
+    assert response.status_code == 202
+    status = wait_for_job(client, response.json()["id"])
+    assert status["status"] == "failed"
+    assert "UTF-8" in status["error"]
+
+
+def test_job_rejects_too_large(client, monkeypatch):
+    from app import main
+    monkeypatch.setattr(main, "UPLOAD_MAX_BYTES", 8)
+    response = client.post("/jobs", files={"file": ("big.tex", SOURCE.encode("utf-8"))})
+    assert response.status_code == 413
+
+
+def test_job_refused_when_queue_full(client, monkeypatch):
+    from app import main
+
+    async def spool_upload(file, path):
+        raise AssertionError("a full queue must answer before reading the upload")
+
+    monkeypatch.setattr(main.jobs, "max_queued", 0)
+    monkeypatch.setattr(main, "spool_upload", spool_upload)
+    response = client.post("/jobs", files={"file": ("job.tex", SOURCE.encode("utf-8"))})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "10"
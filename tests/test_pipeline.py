@@ -0,0 +1,25 @@
+"""Conversion reports count the commands that were converted, not the preamble."""
+import json
+
+from app import pipeline
+
+PREAMBLE_HEAVY = (
+    "\\documentclass{article}\n"
+    "\\usepackage{amsmath}\n\\usepackage{siunitx}\n\\usepackage{physics}\n"
+    "\\usepackage[version=4,arrows=font]{mhchem}\n\\usepackage{graphicx}\n"
+    "\\mhchemoptions{textfontname=sffamily}\n"
+    "\\begin{document}\n"
+    "Speed \\qty{3}{\\meter\\per\\second}, count \\num{1.5e3} and \\ce{H2O}.\n"
+    "\\end{document}\n"
+)
+
+
+def test_report_leaves_out_preamble_commands():
+    pipeline.get_converter().take_counters()
+    entries, _, report = pipeline.convert_package(PREAMBLE_HEAVY, "paper.tex")
+    counts = {row["command"]: (row["found"], row["converted"]) for row in report["commands"]}
+    assert counts == {"\\qty": (1, 1), "\\num": (1, 1), "\\ce": (1, 1)}
+    assert (report["found"], report["converted"]) == (3, 3)
+    written = dict((name, data) for name, data, _ in entries)
+    assert json.loads(written["report.json"]) == report
+    assert "usepackage" not in written["report.html"]
@@ -0,0 +1,43 @@
+"""Project mode: included files are converted with the root's preamble options."""
+from app.converter import LatexConverter
+from app.project import ProjectConverter
+
+ROOT = "\\documentclass{book}\n\\usepackage[arrows=font]{mhchem}\n\\begin{document}\n\\include{ch1}\n\\end{document}\n"
+CHAPTER = "Reaction \\ce{A <=> B} and \\ce{C ->[heat] D}.\n"
+
+
+def convert_project(tmp_path, root):
+    (tmp_path / "main.tex").write_text(root)
+    (tmp_path / "ch1.tex").write_text(CHAPTER)
+    records = ProjectConverter(str(tmp_path / "main.tex")).convert(str(tmp_path / "out"))
+    return (tmp_path / "out" / "ch1.tex").read_text(), {record["file"]: record["cached"] for record in records}
+
+
+def test_included_file_gets_root_profile(tmp_path):
+    converted, _ = convert_project(tmp_path, ROOT)
+    inlined = LatexConverter().convert(ROOT.replace("\\include{ch1}\n", CHAPTER))
+    assert converted in inlined
+    assert "\\overset{" in converted
+
+
+def test_profile_is_part_of_cache_key(tmp_path):
+    with_option, _ = convert_project(tmp_path, ROOT)
+    _, cached = convert_project(tmp_path, ROOT)
+    assert cached["ch1.tex"]
+    without_option, cached = convert_project(tmp_path, ROOT.replace("[arrows=font]", ""))
+    assert not cached["ch1.tex"]
+    assert without_option == LatexConverter().convert(CHAPTER)
+    assert without_option != with_option
+
+
+def test_include_outside_project_is_missing(tmp_path):
+    project = tmp_path / "project"
+    project.mkdir()
+    (tmp_path / "outside.tex").write_text(CHAPTER)
+    (project / "main.tex").write_text("\\input{../outside}\n\\include{" + str(tmp_path / "outside") + "}\n")
+    converter = ProjectConverter(str(project / "main.tex"), cache_dir=None)
+    records = converter.convert(str(project / "out"))
+    assert [record["file"] for record in records] == ["main.tex"]
+    assert [name for _, name in converter.missing] == ["../outside", str(tmp_path / "outside")]
+    assert (tmp_path / "outside.tex").read_text() == CHAPTER
+    assert sorted(path.name for path in (project / "out").iterdir()) == ["main.tex"]
@@ -216,3 +216,69 @@ UNIT_MAP = {
     r'\to': r'\text{to}',
     r'\percent': r'\%',
 }
+
+# SI prefixes and the units they combine with. PREFIXED_UNIT_MAP below is
+# generated from these two tables, so every prefix x unit pair (\kilo\meter,
+# \micro\farad, \giga\electronvolt ...) maps to one symbol like the
+# hand-written abbreviations above instead of two separate pieces.
+PREFIX_SYMBOLS = {
+    r'\quecto': 'q', r'\ronto': 'r', r'\yocto': 'y', r'\zepto': 'z',
+    r'\atto': 'a', r'\femto': 'f', r'\pico': 'p', r'\nano': 'n',
+    r'\micro': r'\mu', r'\milli': 'm', r'\centi': 'c', r'\deci': 'd',
+    r'\deca': 'da', r'\deka': 'da', r'\hecto': 'h', r'\kilo': 'k',
+    r'\mega': 'M', r'\giga': 'G', r'\tera': 'T', r'\peta': 'P',
+    r'\exa': 'E', r'\zetta': 'Z', r'\yotta': 'Y', r'\ronna': 'R',
+    r'\quetta': 'Q',
+}
+
+PREFIXABLE_UNIT_SYMBOLS = {
+    r'\meter': 'm', r'\metre': 'm', r'\gram': 'g', r'\second': 's',
+    r'\ampere': 'A', r'\kelvin': 'K', r'\mole': 'mol', r'\candela': 'cd',
+    r'\becquerel': 'Bq', r'\coulomb': 'C', r'\farad': 'F', r'\gray': 'Gy',
+    r'\hertz': 'Hz', r'\henry': 'H', r'\joule': 'J', r'\lumen': 'lm',
+    r'\katal': 'kat', r'\lux': 'lx', r'\newton': 'N', r'\ohm': r'\Omega',
+    r'\pascal': 'Pa', r'\siemens': 'S', r'\sievert': 'Sv', r'\tesla': 'T',
+    r'\volt': 'V', r'\watt': 'W', r'\weber': 'Wb', r'\electronvolt': 'eV',
+    r'\litre': 'L', r'\liter': 'L', r'\dalton': 'Da', r'\tonne': 't',
+    r'\bel': 'B',
+}
+
+
+def _prefixed_symbol(prefix, unit):
+    # \mu and \Omega are math symbols and stay outside \mathrm, as in \um, \kohm
+    head, tail = '', ''
+    if prefix.startswith('\\'):
+        head, prefix = prefix, ''
+    if unit.startswith('\\'):
+        tail, unit = unit, ''
+    if prefix or unit:
+        return f"{head}\\mathrm{{{prefix}{unit}}}{tail}"
+    return head + tail
+
+
+def build_prefixed_unit_map():
+    """Every prefix x unit pair, keyed like r'\\kilo\\meter'."""
+    return {
+        prefix + unit: _prefixed_symbol(prefix_symbol, unit_symbol)
+        for prefix, prefix_symbol in PREFIX_SYMBOLS.items()
+        for unit, unit_symbol in PREFIXABLE_UNIT_SYMBOLS.items()
+    }
+
+
+# Built on first use rather than at import, so processes that never map a
+# unit (the web front end, the reloader) do not pay for it
+_prefixed_unit_map = None
+
+
+def get_prefixed_unit_map():
+    global _prefixed_unit_map
+    if _prefixed_unit_map is None:
+        _prefixed_unit_map = build_prefixed_unit_map()
+    return _prefixed_unit_map
+
+
+def __getattr__(name):
+    # units.PREFIXED_UNIT_MAP keeps working as a lazy module attribute
+    if name == "PREFIXED_UNIT_MAP":
+        return get_prefixed_unit_map()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")